@@ -0,0 +1,161 @@
+# app/attachment_import.py
+import os
+import re
+import csv
+import hashlib
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import current_app
+from sqlalchemy import update
+from werkzeug.utils import secure_filename
+from app.models import db, Participant, ImportJob
+from app.scoring import chunked
+from app.cache import bump_data_version
+from app.normalize import normalize_digits
+from app.attachments import add_blob_file, guess_mime_type, temp_upload_path, release_blobs, remove_blob_files
+from app.jobs import report_progress, finish_job, UPLOAD_CHUNK_SIZE
+from app.previews import queue_previews
+
+# Entry types accepted (same as the single attachment form)
+ATTACHMENT_EXTENSIONS = {'jpg', 'jpeg', 'png', 'gif', 'pdf'}
+
+# Entries extracted at the same time
+EXTRACT_WORKERS = int(os.environ.get('ATTACHMENT_EXTRACT_WORKERS', '4'))
+
+# Phones looked up per query
+LOOKUP_BATCH_SIZE = 500
+
+# Archive limits, read from the ZIP directory before anything is extracted (guards against ZIP bombs)
+ZIP_MAX_ENTRIES = int(os.environ.get('ATTACHMENT_ZIP_MAX_ENTRIES', '5000'))
+ZIP_MAX_ENTRY_BYTES = int(os.environ.get('ATTACHMENT_ZIP_MAX_ENTRY_MB', '20')) * 1024 * 1024
+ZIP_MAX_TOTAL_BYTES = int(os.environ.get('ATTACHMENT_ZIP_MAX_TOTAL_MB', '2048')) * 1024 * 1024
+
+# The phone number is the leading run of digits of the entry's file name (e.g. 09121234567_certificate.pdf)
+PHONE_PREFIX = re.compile(r'^\s*(\d{5,15})')
+
+REPORT_COLUMNS = ['فایل', 'شماره تلفن', 'نتیجه']
+ATTACHED_MESSAGE = 'پیوست شد.'
+
+
+def attachment_report_path(job_id):
+    """Per-entry CSV report of an attachment import."""
+    return os.path.join(current_app.config['IMPORT_FOLDER'], f"{job_id}_report.csv")
+
+
+def extract_entry(archive, info, temp_path):
+    """Streams one ZIP entry to temp_path while hashing it (runs on a worker thread). Returns the sha256 hex digest."""
+    digest = hashlib.sha256()
+    with archive.open(info) as source, open(temp_path, 'wb') as out:
+        for chunk in iter(lambda: source.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk); out.write(chunk)
+    return digest.hexdigest()
+
+
+def archive_limit_error(archive):
+    """
+    Checks the entry count and the declared uncompressed sizes of an archive
+    against the ZIP_MAX_* limits. Returns an error message, or None if it may
+    be extracted (zipfile never yields more than an entry's declared size).
+    """
+    infos = archive.infolist()
+    if len(infos) > ZIP_MAX_ENTRIES:
+        return f'آرشیو بیش از {ZIP_MAX_ENTRIES} فایل دارد.'
+    oversized = next((info for info in infos if info.file_size > ZIP_MAX_ENTRY_BYTES), None)
+    if oversized is not None:
+        return f'حجم فایل «{oversized.filename}» پس از استخراج بیش از {ZIP_MAX_ENTRY_BYTES // (1024 * 1024)} مگابایت است.'
+    if sum(info.file_size for info in infos) > ZIP_MAX_TOTAL_BYTES:
+        return f'حجم کل فایل‌های آرشیو پس از استخراج بیش از {ZIP_MAX_TOTAL_BYTES // (1024 * 1024)} مگابایت است.'
+    return None
+
+
+def plan_entries(archive):
+    """
+    Matches archive entries to participants. Returns (matches, report) where
+    matches maps phone -> (ZipInfo, stored name) and report holds one
+    [entry, phone, message] row per entry that will not be attached.
+    """
+    report = []; candidates = {}
+    for info in archive.infolist():
+        if info.is_dir(): continue
+        basename = info.filename.replace('\\', '/').rsplit('/', 1)[-1]
+        if not basename or basename.startswith('.') or info.filename.startswith('__MACOSX/'): continue
+        extension = basename.rsplit('.', 1)[-1].lower() if '.' in basename else ''
+        match = PHONE_PREFIX.match(normalize_digits(basename))
+        if extension not in ATTACHMENT_EXTENSIONS:
+            report.append([info.filename, '', 'نوع فایل مجاز نیست (فقط jpg, png, gif یا pdf).'])
+        elif not match:
+            report.append([info.filename, '', 'نام فایل با شماره تلفن شروع نمی‌شود.'])
+        elif match.group(1) in candidates:
+            report.append([info.filename, match.group(1), f'فایل دیگری برای این شماره در آرشیو وجود دارد ({candidates[match.group(1)][0].filename}).'])
+        else:
+            candidates[match.group(1)] = (info, secure_filename(normalize_digits(basename)) or f"{match.group(1)}.{extension}")
+    # One set-based lookup for all phones named in the archive
+    known = set()
+    for chunk in chunked(list(candidates), LOOKUP_BATCH_SIZE):
+        known.update(row[0] for row in db.session.query(Participant.phone).filter(Participant.phone.in_(chunk)))
+    for phone in [phone for phone in candidates if phone not in known]:
+        report.append([candidates.pop(phone)[0].filename, phone, 'شرکت‌کننده‌ای با این شماره تلفن یافت نشد.'])
+    return candidates, report
+
+
+def run_attachment_import(job_id):
+    """
+    Attaches the files of an uploaded ZIP to participants. Entries are
+    streamed out of the archive on a thread pool (hashed on the way), stored
+    once per content, and all participant rows are updated in one
+    transaction. A per-entry CSV report is written next to the job.
+    """
+    job = db.session.get(ImportJob, job_id)
+    print(f"--- Starting Attachment Import: {job.filename} (job {job_id}) ---")
+    try: archive = zipfile.ZipFile(job.file_path)
+    except zipfile.BadZipFile:
+        finish_job(job_id, 'failed', 'فایل ZIP معتبر نیست یا خراب است.', validation_failed=True); return
+    with archive:
+        limit_error = archive_limit_error(archive)
+        if limit_error:
+            finish_job(job_id, 'failed', limit_error, validation_failed=True); return
+        matches, report = plan_entries(archive)
+        report_progress(job_id, rows_processed=len(report))
+        extracted = {}; temp_paths = {phone: temp_upload_path() for phone in matches}
+        try:
+            with ThreadPoolExecutor(max_workers=EXTRACT_WORKERS, thread_name_prefix='zip-extract') as pool:
+                futures = {pool.submit(extract_entry, archive, info, temp_paths[phone]): phone for phone, (info, _) in matches.items()}
+                for done, future in enumerate(as_completed(futures), 1):
+                    phone = futures[future]; info, name = matches[phone]
+                    try: extracted[phone] = future.result()
+                    except Exception as e: report.append([info.filename, phone, f'خطا در استخراج فایل: {e}'])
+                    if done % 50 == 0: report_progress(job_id, rows_processed=len(report) + len(extracted))
+
+            # --- Store blobs and update every participant in one transaction ---
+            old_blob_ids = []
+            for chunk in chunked(list(extracted), LOOKUP_BATCH_SIZE):
+                old_blob_ids += [row[0] for row in db.session.query(Participant.attachment_blob_id).filter(Participant.phone.in_(chunk))]
+            rows = []; stored = {}; placed = []
+            try:
+                for phone, sha256 in extracted.items():
+                    info, name = matches[phone]
+                    blob = add_blob_file(temp_paths[phone], sha256, guess_mime_type(name), placed=placed); stored[blob.sha256] = blob.mime_type
+                    rows.append({'phone': phone, 'attachment_blob_id': blob.id, 'attachment_name': name})
+                    report.append([info.filename, phone, ATTACHED_MESSAGE])
+                if rows: db.session.execute(update(Participant), rows)
+                stale_paths = release_blobs(old_blob_ids)
+                bump_data_version()
+                db.session.commit()
+            except Exception:
+                # Files this import moved into the store have no committed row; remove them while the hash locks are held
+                for target in placed:
+                    if os.path.exists(target): os.remove(target)
+                db.session.rollback()
+                raise
+            remove_blob_files(stale_paths)
+            for sha256, mime_type in stored.items(): queue_previews(sha256, mime_type)
+        finally:
+            for path in temp_paths.values():
+                if os.path.exists(path): os.remove(path)
+
+    with open(attachment_report_path(job_id), 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.writer(f); writer.writerow(REPORT_COLUMNS); writer.writerows(sorted(report))
+    problems = [f"{entry}: {message}" for entry, _, message in sorted(report) if message != ATTACHED_MESSAGE]
+    print(f"Attachment import attached {len(rows)} file(s); {len(problems)} entr(ies) skipped.")
+    finish_job(job_id, 'succeeded', f'{len(rows)} فایل پیوست شد و {len(problems)} فایل نادیده گرفته شد.',
+               rows_processed=len(report), error_count=len(problems), errors=problems)
@@ -0,0 +1,207 @@
+# app/attachment_reconcile.py
+import os
+import time
+from flask import current_app
+from sqlalchemy import func
+from app.models import db, AttachmentBlob, Participant, Setting
+from app.scoring import chunked
+from app.attachments import release_blobs, remove_blob_files, TEMP_DIR_NAME, PREVIEW_DIR_NAME, PREVIEW_RENDITIONS
+
+# Last scan time (unix seconds) of an incremental reconciliation
+WATERMARK_SETTING_KEY = 'attachment_reconcile_watermark'
+
+# Files removed (or blob rows released) per batch
+RECONCILE_BATCH_SIZE = 500
+
+# Files younger than this may belong to an upload that has not committed yet; they are never reported
+RECONCILE_GRACE_SECONDS = 3600
+
+HEX_DIGITS = frozenset('0123456789abcdef')
+
+
+class ReconcileReport:
+    """Outcome of one scan of the attachment store."""
+    __slots__ = ('orphan_files', 'missing_blobs', 'unreferenced_blobs', 'scanned_shards', 'incremental')
+
+    def __init__(self, incremental):
+        self.orphan_files = {}       # path -> size: files no AttachmentBlob row (or live upload) accounts for
+        self.missing_blobs = []      # (sha256, [phones]): rows whose stored file is gone
+        self.unreferenced_blobs = [] # (blob id, sha256, size): rows no participant uses
+        self.scanned_shards = 0; self.incremental = incremental
+
+    @property
+    def reclaimable_bytes(self):
+        return sum(self.orphan_files.values()) + sum(size for _, _, size in self.unreferenced_blobs)
+
+    @property
+    def is_clean(self):
+        return not (self.orphan_files or self.missing_blobs or self.unreferenced_blobs)
+
+
+def is_shard(name):
+    return len(name) == 2 and set(name) <= HEX_DIGITS
+
+
+def is_blob_path(path, folder):
+    """True for a file of the stored-originals tree (<folder>/ab/cd/<sha256>)."""
+    parts = os.path.relpath(path, folder).split(os.sep)
+    return len(parts) == 3 and is_shard(parts[0]) and is_shard(parts[1]) and len(parts[2]) == 64 and set(parts[2]) <= HEX_DIGITS
+
+
+def scan_shard_tree(root, since, suffix=''):
+    """
+    Walks a two-level shard tree (ab/cd/<sha256><suffix>) with os.scandir.
+    Leaf directories not modified since `since` are skipped: adding or
+    removing a file only touches its own directory. Returns ({sha256: path},
+    leaf shards scanned, leaf shards present, stray file entries).
+    """
+    files = {}; scanned = set(); present = set(); strays = []
+    if not os.path.isdir(root): return files, scanned, present, strays
+    with os.scandir(root) as level1:
+        for first in level1:
+            if not (first.is_dir(follow_symlinks=False) and is_shard(first.name)): continue
+            with os.scandir(first.path) as level2:
+                for second in level2:
+                    if not (second.is_dir(follow_symlinks=False) and is_shard(second.name)): continue
+                    shard = first.name + second.name; present.add(shard)
+                    if since is not None and second.stat().st_mtime < since: continue
+                    scanned.add(shard)
+                    with os.scandir(second.path) as leaf:
+                        for entry in leaf:
+                            if not entry.is_file(follow_symlinks=False): continue
+                            sha256 = entry.name[:-len(suffix)] if suffix and entry.name.endswith(suffix) else entry.name
+                            if len(sha256) == 64 and sha256.startswith(shard) and set(sha256) <= HEX_DIGITS and entry.name == sha256 + suffix:
+                                files[sha256] = entry.path
+                            else: strays.append(entry)
+    return files, scanned, present, strays
+
+
+def get_watermark():
+    setting = db.session.get(Setting, WATERMARK_SETTING_KEY)
+    try: return float(setting.value) if setting and setting.value else None
+    except ValueError: return None
+
+
+def set_watermark(value):
+    setting = db.session.get(Setting, WATERMARK_SETTING_KEY)
+    if setting is None: db.session.add(Setting(key=WATERMARK_SETTING_KEY, value=str(value)))
+    else: setting.value = str(value)
+    db.session.commit()
+
+
+def scan_attachments(full=False):
+    """
+    Diffs the upload folder against the AttachmentBlob table (one query) and
+    returns a ReconcileReport. Unless full, only shard directories modified
+    since the stored watermark are listed, so a run costs a directory listing
+    per changed shard rather than per stored file; stray temp files and
+    files left in the root by the old flat layout are always checked.
+    """
+    folder = current_app.config['UPLOAD_FOLDER']
+    since = None if full else get_watermark()
+    now = time.time(); report = ReconcileReport(incremental=since is not None)
+    def add_orphan(path, stat):
+        if now - stat.st_mtime >= RECONCILE_GRACE_SECONDS: report.orphan_files[path] = stat.st_size
+
+    # Every blob with its number of participants
+    blobs = {sha256: (blob_id, size, users) for blob_id, sha256, size, users in
+             db.session.query(AttachmentBlob.id, AttachmentBlob.sha256, AttachmentBlob.size, func.count(Participant.phone))
+                       .outerjoin(Participant, Participant.attachment_blob_id == AttachmentBlob.id)
+                       .group_by(AttachmentBlob.id, AttachmentBlob.sha256, AttachmentBlob.size)}
+
+    # Stored originals
+    files, scanned, present, strays = scan_shard_tree(folder, since)
+    report.scanned_shards = len(scanned)
+    for sha256, path in files.items():
+        if sha256 not in blobs: add_orphan(path, os.stat(path))
+    for entry in strays: add_orphan(entry.path, entry.stat())
+    gone = {sha256 for sha256 in blobs if (sha256[:4] in scanned or sha256[:4] not in present) and sha256 not in files}
+    # Unused rows are released either way; only files someone still links to count as missing
+    report.unreferenced_blobs = [(blob_id, sha256, 0 if sha256 in gone else size or 0) for sha256, (blob_id, size, users) in blobs.items() if not users]
+    missing = [sha256 for sha256 in gone if blobs[sha256][2]]
+    if missing:
+        phones = {}
+        for chunk in chunked(missing, RECONCILE_BATCH_SIZE):
+            for phone, sha256 in db.session.query(Participant.phone, AttachmentBlob.sha256)\
+                                           .join(AttachmentBlob, Participant.attachment_blob_id == AttachmentBlob.id)\
+                                           .filter(AttachmentBlob.sha256.in_(chunk)):
+                phones.setdefault(sha256, []).append(phone)
+        report.missing_blobs = [(sha256, sorted(phones.get(sha256, []))) for sha256 in sorted(missing)]
+
+    # Preview renditions (only those of known images are kept; renamed renditions are orphans as a whole)
+    preview_root = os.path.join(folder, PREVIEW_DIR_NAME)
+    if os.path.isdir(preview_root):
+        with os.scandir(preview_root) as renditions:
+            for rendition in renditions:
+                if not rendition.is_dir(follow_symlinks=False): add_orphan(rendition.path, rendition.stat()); continue
+                previews, _, _, preview_strays = scan_shard_tree(rendition.path, since, '.jpg')
+                for sha256, path in previews.items():
+                    if rendition.name not in PREVIEW_RENDITIONS or sha256 not in blobs: add_orphan(path, os.stat(path))
+                for entry in preview_strays: add_orphan(entry.path, entry.stat())
+
+    # Abandoned temp uploads and legacy flat files (<phone>_<filename>) no migration picked up
+    temp_dir = os.path.join(folder, TEMP_DIR_NAME)
+    for directory in [temp_dir, folder]:
+        if not os.path.isdir(directory): continue
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False) and not entry.name.startswith('.'): add_orphan(entry.path, entry.stat())
+    return report
+
+
+def remove_empty_dirs(paths, stop):
+    """Removes the directories of deleted files, and their parents, once they are empty (up to stop)."""
+    for directory in sorted({os.path.dirname(path) for path in paths}, key=len, reverse=True):
+        while directory.startswith(stop) and os.path.normpath(directory) != os.path.normpath(stop):
+            try: os.rmdir(directory)
+            except OSError: break
+            directory = os.path.dirname(directory)
+
+
+def delete_orphans(report, echo=print):
+    """
+    Deletes what a report found, in batches of RECONCILE_BATCH_SIZE: orphan
+    files, then unreferenced blob rows with their files (each batch in its
+    own transaction). Rows with a missing file are only reported; their
+    participants need a new upload. Returns (files removed, bytes freed).
+    """
+    folder = current_app.config['UPLOAD_FOLDER']
+    removed = 0; freed = 0; removed_paths = []
+    orphans = sorted(report.orphan_files)
+    for start, chunk in enumerate(chunked(orphans, RECONCILE_BATCH_SIZE)):
+        # Stored originals go through the hash lock: the same content may be uploaded again meanwhile
+        stored = [path for path in chunk if is_blob_path(path, folder)]
+        removed += remove_blob_files(stored)
+        for path in chunk:
+            if path not in stored:
+                try: os.remove(path); removed += 1
+                except FileNotFoundError: pass
+                except OSError as e: echo(f"Error deleting orphan file {path}: {e}")
+            if not os.path.exists(path): freed += report.orphan_files[path]; removed_paths.append(path)
+        echo(f"  removed {min((start + 1) * RECONCILE_BATCH_SIZE, len(orphans))}/{len(orphans)} orphan file(s)")
+    sizes = {sha256: size for _, sha256, size in report.unreferenced_blobs}
+    for chunk in chunked(sorted(blob_id for blob_id, _, _ in report.unreferenced_blobs), RECONCILE_BATCH_SIZE):
+        stale_paths = release_blobs(chunk) # Re-checks references inside the transaction
+        db.session.commit()
+        removed += remove_blob_files(stale_paths); removed_paths += stale_paths
+        freed += sum(sizes.get(os.path.basename(path), 0) for path in stale_paths)
+        echo(f"  released {len(stale_paths)} unreferenced blob(s)")
+    remove_empty_dirs([path for path in removed_paths if os.path.dirname(path) != folder], folder)
+    return removed, freed
+
+
+def reconcile_attachments(full=False, delete=False, echo=print):
+    """
+    Scans (and with delete, cleans) the attachment store. The watermark only
+    advances when a run leaves nothing to report, so findings keep showing on
+    later incremental runs until they are resolved.
+    """
+    started_at = time.time()
+    report = scan_attachments(full=full)
+    if delete and (report.orphan_files or report.unreferenced_blobs):
+        delete_orphans(report, echo)
+        resolved = not report.missing_blobs
+    else:
+        resolved = report.is_clean
+    if resolved: set_watermark(started_at - RECONCILE_GRACE_SECONDS)
+    return report
@@ -0,0 +1,184 @@
+# app/attachments.py
+import os
+import hashlib
+import mimetypes
+from datetime import datetime
+from flask import current_app, request, send_file, Response
+from sqlalchemy import text, update
+from sqlalchemy.exc import IntegrityError
+from app.models import db, dialect_insert, AttachmentBlob, Participant
+from app.jobs import store_upload, new_job_id, UPLOAD_CHUNK_SIZE
+from app.scoring import chunked
+
+# Stored files rechecked (and removed) per transaction
+REMOVE_BATCH_SIZE = 200
+
+# Uploads are written here first (inside UPLOAD_FOLDER, so moving them into the store is a rename)
+TEMP_DIR_NAME = 'tmp'
+
+# Downscaled renditions of image attachments (see app.previews): name -> longest side in pixels
+PREVIEW_DIR_NAME = 'previews'
+PREVIEW_RENDITIONS = {'thumb': 96, 'preview': 1024}
+IMAGE_MIME_TYPES = {'image/jpeg', 'image/png', 'image/gif'}
+
+
+# --- Content-addressed storage ---
+def blob_path(sha256, folder=None):
+    """Location of a stored file: two levels of shard directories, then the full hash."""
+    folder = folder or current_app.config['UPLOAD_FOLDER']
+    return os.path.join(folder, sha256[:2], sha256[2:4], sha256)
+
+
+def preview_path(sha256, rendition, folder=None):
+    """Location of a JPEG rendition of a stored image, sharded like the originals."""
+    folder = folder or current_app.config['UPLOAD_FOLDER']
+    return os.path.join(folder, PREVIEW_DIR_NAME, rendition, sha256[:2], sha256[2:4], f"{sha256}.jpg")
+
+
+def guess_mime_type(filename, fallback=None):
+    return mimetypes.guess_type(filename)[0] or fallback or 'application/octet-stream'
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''): digest.update(chunk)
+    return digest.hexdigest()
+
+
+def temp_upload_path():
+    temp_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], TEMP_DIR_NAME)
+    os.makedirs(temp_dir, exist_ok=True)
+    return os.path.join(temp_dir, new_job_id())
+
+
+def lock_blob_hashes(hashes):
+    """
+    Serializes storing and removing the files of the given hashes until the
+    transaction ends: transaction-level advisory locks on PostgreSQL (taken in
+    sorted order), the database write lock elsewhere (SQLite has only one).
+    """
+    if db.session.get_bind().dialect.name == 'postgresql':
+        for sha256 in sorted(set(hashes)):
+            db.session.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': int(sha256[:15], 16)})
+    else:
+        # A write that changes nothing still takes the lock
+        db.session.execute(update(AttachmentBlob).where(AttachmentBlob.id.is_(None)).values(size=0))
+
+
+def add_blob_file(path, sha256, mime_type, placed=None):
+    """
+    Files a hashed file under its hash and returns its AttachmentBlob (the
+    caller commits). The row is taken first, under the hash lock that
+    remove_blob_files also holds, so a concurrent release cannot unlink the
+    stored copy this upload relies on. The file at path is consumed: moved
+    into the store, or removed when that content is already stored. Targets
+    this call placed are appended to placed, for the caller to remove if its
+    transaction rolls back (before the rollback, while the lock is held).
+    """
+    lock_blob_hashes([sha256])
+    stmt = dialect_insert(AttachmentBlob.__table__)
+    if stmt is not None:
+        db.session.execute(stmt.on_conflict_do_nothing(index_elements=['sha256']),
+                           {'sha256': sha256, 'size': os.path.getsize(path), 'mime_type': mime_type, 'created_at': datetime.utcnow()})
+        blob = AttachmentBlob.query.filter_by(sha256=sha256).with_for_update().one()
+    else:
+        blob = AttachmentBlob.query.filter_by(sha256=sha256).with_for_update().first()
+        if blob is None:
+            blob = AttachmentBlob(sha256=sha256, size=os.path.getsize(path), mime_type=mime_type)
+            try:
+                with db.session.begin_nested(): db.session.add(blob)
+            except IntegrityError:
+                blob = AttachmentBlob.query.filter_by(sha256=sha256).one() # Stored by a concurrent upload
+    # The row exists (and is locked): only now is it safe to drop this copy in favour of the stored one
+    target = blob_path(sha256)
+    if os.path.exists(target): os.remove(path)
+    else:
+        os.makedirs(os.path.dirname(target), exist_ok=True); os.replace(path, target)
+        if placed is not None: placed.append(target)
+    return blob
+
+
+def store_attachment(file, filename):
+    """Streams an uploaded file to a temp file while hashing it, then stores it once per content. Returns its AttachmentBlob."""
+    temp_path = temp_upload_path()
+    try:
+        sha256 = store_upload(file, temp_path)
+        return add_blob_file(temp_path, sha256, guess_mime_type(filename, file.mimetype))
+    finally:
+        if os.path.exists(temp_path): os.remove(temp_path)
+
+
+# --- Releasing blobs ---
+def release_blobs(blob_ids):
+    """
+    Deletes the rows of the given blobs that no participant references any
+    more (caller commits). Returns the paths of their files, to be removed
+    once the transaction has committed.
+    """
+    blob_ids = {blob_id for blob_id in blob_ids if blob_id is not None}
+    if not blob_ids: return []
+    db.session.flush()
+    referenced = {row[0] for row in db.session.query(Participant.attachment_blob_id).filter(Participant.attachment_blob_id.in_(blob_ids)).distinct()}
+    orphans = db.session.query(AttachmentBlob.id, AttachmentBlob.sha256).filter(AttachmentBlob.id.in_(blob_ids - referenced)).all()
+    if not orphans: return []
+    AttachmentBlob.query.filter(AttachmentBlob.id.in_([blob_id for blob_id, _ in orphans])).delete(synchronize_session=False)
+    return [blob_path(sha256) for _, sha256 in orphans]
+
+
+def remove_blob_files(paths):
+    """
+    Removes stored files and their previews (missing ones are ignored), in
+    short transactions of REMOVE_BATCH_SIZE files. Under the hash lock, a file
+    whose AttachmentBlob row exists again (re-uploaded since it was released)
+    is kept. Needs an app context. Returns the number of stored files removed.
+    """
+    removed = 0
+    for chunk in chunked(list(paths), REMOVE_BATCH_SIZE):
+        hashes = {os.path.basename(path): path for path in chunk}
+        try:
+            lock_blob_hashes(hashes)
+            stored = {row[0] for row in db.session.query(AttachmentBlob.sha256).filter(AttachmentBlob.sha256.in_(list(hashes)))}
+            for sha256, path in hashes.items():
+                if sha256 in stored: print(f"Keeping attachment file {path}: stored again since it was released"); continue
+                removed += remove_stored_file(path)
+            db.session.commit() # Releases the lock
+        except Exception:
+            db.session.rollback(); raise
+    return removed
+
+
+def remove_stored_file(path):
+    """Removes one stored file and its previews. Returns 1 if the file was removed."""
+    sha256 = os.path.basename(path); folder = os.path.dirname(os.path.dirname(os.path.dirname(path)))
+    for preview in [preview_path(sha256, rendition, folder) for rendition in PREVIEW_RENDITIONS]:
+        if os.path.exists(preview): os.remove(preview)
+    try:
+        os.remove(path); return 1
+    except FileNotFoundError: pass
+    except OSError as e: print(f"Error deleting attachment file {path}: {e}")
+    return 0
+
+
+# --- Serving ---
+def attachment_response(sha256, mime_type, created_at, download_name):
+    """
+    Response for a stored file with a strong ETag (its hash) and Last-Modified,
+    answering If-None-Match/If-Modified-Since with 304 and byte ranges with
+    206. With ATTACHMENT_SENDFILE_HEADER set, the bytes are left to the front
+    proxy (X-Accel-Redirect to ATTACHMENT_ACCEL_PREFIX, or X-Sendfile with the
+    absolute path), which then also handles ranges.
+    """
+    config = current_app.config; path = blob_path(sha256)
+    header = config.get('ATTACHMENT_SENDFILE_HEADER')
+    if header:
+        response = Response(mimetype=mime_type)
+        response.headers.set('Content-Disposition', 'inline', filename=download_name)
+        relative = os.path.relpath(path, config['UPLOAD_FOLDER']).replace(os.sep, '/')
+        response.headers[header] = config['ATTACHMENT_ACCEL_PREFIX'].rstrip('/') + '/' + relative if header.lower() == 'x-accel-redirect' else path
+        response.set_etag(sha256); response.last_modified = created_at
+    else:
+        response = send_file(path, mimetype=mime_type, download_name=download_name, as_attachment=False,
+                             conditional=True, etag=sha256, last_modified=created_at, max_age=None)
+    response.cache_control.no_cache = None; response.cache_control.private = True; response.cache_control.max_age = config['ATTACHMENT_CACHE_MAX_AGE']
+    return response.make_conditional(request) if header else response
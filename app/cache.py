@@ -0,0 +1,144 @@
+# app/cache.py
+import os
+import time
+import threading
+from collections import OrderedDict
+from sqlalchemy import event
+from sqlalchemy.orm import make_transient_to_detached
+from app.models import db, dialect_insert, VersionCounter, User, Setting
+
+# Bumped by any write to Score, Indicator, Measure, Axis or the results help Setting
+DATA_VERSION_KEY = 'data'
+
+
+# --- Version counters (shared across workers through the database) ---
+def get_version(key=DATA_VERSION_KEY):
+    """Returns the current value of a version counter (0 if it was never bumped)."""
+    return db.session.query(VersionCounter.value).filter(VersionCounter.key == key).scalar() or 0
+
+
+def bump_version(key=DATA_VERSION_KEY):
+    """Increments a version counter inside the caller's transaction (creating it on first use)."""
+    table = VersionCounter.__table__
+    stmt = dialect_insert(table)
+    if stmt is not None:
+        # Upsert: two workers bumping a counter that does not exist yet both succeed
+        stmt = stmt.values(key=key, value=1)
+        db.session.execute(stmt.on_conflict_do_update(index_elements=['key'], set_={'value': table.c.value + 1}))
+        return
+    result = db.session.execute(table.update().where(table.c.key == key).values(value=table.c.value + 1))
+    if not result.rowcount:
+        db.session.execute(table.insert().values(key=key, value=1))
+
+
+def bump_data_version():
+    bump_version(DATA_VERSION_KEY)
+
+
+# --- Bounded in-process LRU cache ---
+class LRUCache:
+    """A small thread-safe LRU mapping; the least recently used entry is evicted when full."""
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TTLCache(LRUCache):
+    """An LRUCache whose entries also expire ttl seconds after they were set."""
+
+    def __init__(self, maxsize=128, ttl=60):
+        super().__init__(maxsize)
+        self.ttl = ttl
+
+    def get(self, key, default=None):
+        entry = super().get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return default
+        return entry[1]
+
+    def set(self, key, value):
+        super().set(key, (time.monotonic() + self.ttl, value))
+
+
+# Computed results pages: (summary_data, chart_data) keyed on the data version
+results_cache = LRUCache(maxsize=512)
+
+
+# --- NEW: Logged-in users (Flask-Login loads one on every authenticated request) ---
+# Other workers see a changed user row after at most this many seconds
+USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', '60'))
+
+# Column values of recently loaded users, keyed by id
+user_cache = TTLCache(maxsize=256, ttl=USER_CACHE_TTL)
+
+
+def load_cached_user(user_id):
+    """
+    Returns the User with the given id, without a query while its cached row
+    is fresh. The instance is detached with every column loaded, so commits
+    in the request do not expire (and reload) it; db.session.merge() it
+    before changing it. The cache holds plain column values, never an
+    instance bound to another request's session.
+    """
+    values = user_cache.get(user_id)
+    if values is None:
+        user = db.session.get(User, user_id)
+        if user is None: return None
+        values = {column.key: getattr(user, column.key) for column in User.__table__.columns}
+        user_cache.set(user_id, values)
+    user = User(**values)
+    make_transient_to_detached(user) # Treated as loaded from the database, with nothing pending
+    return user
+
+
+def forget_user(user_id):
+    user_cache.pop(user_id)
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _forget_changed_user(mapper, connection, user):
+    forget_user(user.id)
+
+
+# --- NEW: Settings read by the results pages ---
+# key -> (data version, value); a Setting write bumps the data version, which invalidates it in every worker
+settings_cache = LRUCache(maxsize=64)
+
+
+def get_setting_value(key, version):
+    """Value of a Setting (None if unset), read from the database at most once per data version."""
+    cached = settings_cache.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    setting = db.session.get(Setting, key)
+    value = setting.value if setting else None
+    settings_cache.set(key, (version, value))
+    return value
@@ -0,0 +1,121 @@
+# app/commands.py
+import os
+import click
+from app.models import db, User
+
+
+# --- Schema setup (run once per deploy: `flask --app "app:create_app()" init-db`) ---
+def create_default_admin():
+    """Creates the initial admin user if no users exist. Returns True if it was created."""
+    if User.query.first(): # Check if any user exists
+        print("ℹ️ Users already exist. Skipping default admin creation.")
+        return False
+    print("ℹ️ No users found. Creating default admin user...")
+    # *** IMPORTANT: Set a STRONG password via the DEFAULT_ADMIN_PASSWORD environment variable ***
+    default_admin_password = os.environ.get('DEFAULT_ADMIN_PASSWORD', 'change_this_default_password')
+    if default_admin_password == 'change_this_default_password':
+         print("⚠️ WARNING: Using a default password for initial admin user because DEFAULT_ADMIN_PASSWORD env var is not set. Please set it or change the password immediately after first login!")
+    admin_user = User(username='admin')
+    admin_user.set_password(default_admin_password) # Hashes the password
+    db.session.add(admin_user)
+    db.session.commit()
+    print(f"✅ Default admin user 'admin' created.")
+    return True
+
+
+def init_database():
+    """Creates/upgrades the database tables (new columns, indexes) and the initial admin user. Needs an app context."""
+    print("Checking/creating database tables...")
+    from app.migrations import upgrade_database
+    changes = upgrade_database()
+    print("Database tables checked/created.")
+    try:
+        create_default_admin()
+    except Exception as e_user:
+        print(f"❌ Error during initial admin user creation check: {e_user}")
+        db.session.rollback() # Rollback in case of error during check/creation
+        raise
+    return changes
+
+
+def register_commands(app):
+    """Adds the maintenance commands to the app's `flask` CLI."""
+
+    # --- NEW: Schema setup moved out of app start-up ---
+    @app.cli.command("init-db")
+    def init_db_command():
+        """Creates or upgrades the database schema and the initial admin user."""
+        try:
+            changes = init_database()
+            click.echo(f"✅ Database ready ({len(changes)} change(s)).")
+        except Exception as e:
+            db.session.rollback()
+            click.echo(f"❌ Error during database setup: {e}")
+            click.echo("ℹ️ Note: Ensure the database server is running and accessible.")
+            raise
+
+    # --- CLI command to rebuild the materialized participant results ---
+    @app.cli.command("rebuild-results")
+    def rebuild_results_command():
+        """Recomputes every participant's stored indicator/axis/overall scores."""
+        from app.scoring import refresh_participant_results
+        try:
+            refreshed_count = refresh_participant_results()
+            db.session.commit()
+            click.echo(f"✅ Rebuilt results for {refreshed_count} participants.")
+        except Exception as e:
+            db.session.rollback()
+            click.echo(f"❌ Error rebuilding results: {e}")
+            raise
+
+    @app.cli.command("rebuild-aggregates")
+    def rebuild_aggregates_command():
+        """Recomputes the running per-item score aggregates from the Score table."""
+        from app.scoring import rebuild_item_aggregates
+        try:
+            item_count = rebuild_item_aggregates()
+            db.session.commit()
+            click.echo(f"✅ Rebuilt aggregates for {item_count} items.")
+        except Exception as e:
+            db.session.rollback()
+            click.echo(f"❌ Error rebuilding aggregates: {e}")
+            raise
+
+    @app.cli.command("upgrade-db")
+    def upgrade_db_command():
+        """Upgrades an existing database in place: new tables, columns and indexes; duplicate scores removed."""
+        from app.migrations import upgrade_database
+        try:
+            changes = upgrade_database()
+            click.echo(f"✅ Database upgraded ({len(changes)} change(s)).")
+        except Exception as e:
+            db.session.rollback()
+            click.echo(f"❌ Error upgrading database: {e}")
+            raise
+
+    # --- CLI command to find (and remove) orphaned or missing attachment files ---
+    @app.cli.command("reconcile-attachments")
+    @click.option('--delete', is_flag=True, help="Delete orphan files and unreferenced blobs (otherwise only report).")
+    @click.option('--full', is_flag=True, help="Scan every shard directory, ignoring the incremental watermark.")
+    def reconcile_attachments_command(delete, full):
+        """Diffs the attachment store on disk against the database."""
+        from app.attachment_reconcile import reconcile_attachments
+        try:
+            report = reconcile_attachments(full=full, delete=delete, echo=click.echo)
+        except Exception as e:
+            db.session.rollback()
+            click.echo(f"❌ Error reconciling attachments: {e}")
+            raise
+        click.echo(f"ℹ️ Scanned {report.scanned_shards} shard directories ({'incremental' if report.incremental else 'full'} scan).")
+        for path, size in sorted(report.orphan_files.items()):
+            click.echo(f"  orphan file: {path} ({size} bytes)")
+        for _, sha256, size in report.unreferenced_blobs:
+            click.echo(f"  unreferenced blob: {sha256} ({size} bytes)")
+        for sha256, phones in report.missing_blobs:
+            click.echo(f"  missing file: {sha256} (participants: {', '.join(phones) or '-'})")
+        if report.is_clean:
+            click.echo("✅ Attachment store is consistent.")
+        else:
+            click.echo(f"{'🗑️ Removed' if delete else '⚠️ Reclaimable'}: {len(report.orphan_files)} orphan file(s), "
+                       f"{len(report.unreferenced_blobs)} unreferenced blob(s), {report.reclaimable_bytes} bytes; "
+                       f"{len(report.missing_blobs)} blob(s) missing their file.")
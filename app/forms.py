@@ -5,27 +5,24 @@ from wtforms.validators import DataRequired, NumberRange, Optional, Regexp
 # --- UPDATED: Import FileField and FileAllowed ---
 from flask_wtf.file import FileField, FileAllowed, FileRequired
 # --- End UPDATED ---
-from app.models import db, Axis, Indicator # Import necessary models for choices
+from app.hierarchy import get_hierarchy # Compiled hierarchy used for choices
 
 # --- Helper Functions to Populate Select Fields ---
 def get_axes_choices():
-    """Fetches all axes for use in SelectFields."""
+    """Returns all axes for use in SelectFields (from the hierarchy snapshot)."""
     choices = [(0, '--- انتخاب محور ---')]
     try:
-        choices.extend([(axis.id, axis.name) for axis in Axis.query.order_by(Axis.name).all()])
+        choices.extend(get_hierarchy().axes_choices)
     except Exception as e:
         print(f"Error fetching axes: {e}")
         pass
     return choices
 
 def get_indicators_choices():
-    """Fetches all indicators for use in SelectFields, including axis name."""
+    """Returns all indicators for use in SelectFields, including axis name (from the hierarchy snapshot)."""
     choices = [(0, '--- انتخاب شاخص ---')]
     try:
-        indicators = db.session.query(Indicator, Axis.name.label('axis_name')) \
-                        .join(Axis, Axis.id == Indicator.axis_id) \
-                        .order_by(Axis.name, Indicator.name).all()
-        choices.extend([(ind.Indicator.id, f"{ind.axis_name} / {ind.Indicator.name}") for ind in indicators])
+        choices.extend(get_hierarchy().indicators_choices)
     except Exception as e:
         print(f"Error fetching indicators: {e}")
         pass
@@ -75,6 +72,8 @@ class UploadForm(FlaskForm):
         DataRequired(message="انتخاب فایل الزامی است."),
         FileAllowed(['xlsx', 'csv'], 'فقط فایل‌های Excel (.xlsx) و CSV (.csv) مجاز هستند!')
     ])
+    # --- NEW: Validate only and download an annotated error report ---
+    dry_run = BooleanField('فقط بررسی فایل (بدون ذخیره) و دریافت گزارش خطاها')
     submit = SubmitField('آپلود و پردازش فایل')
 
 class ParticipantInfoForm(FlaskForm):
@@ -121,3 +120,12 @@ class AttachmentForm(FlaskForm):
     ])
     submit = SubmitField('آپلود پیوست')
 # --- End NEW ---
+
+# --- NEW: Form for a ZIP of attachments for many participants ---
+class AttachmentZipForm(FlaskForm):
+    """Form for uploading one ZIP whose entries are named by participant phone number."""
+    archive = FileField('فایل ZIP پیوست‌ها', validators=[
+        FileRequired(message="انتخاب فایل الزامی است."),
+        FileAllowed(['zip'], 'فقط فایل ZIP مجاز است!')
+    ])
+    submit = SubmitField('آپلود و پردازش فایل')
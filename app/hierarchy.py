@@ -0,0 +1,175 @@
+# app/hierarchy.py
+import threading
+import numpy as np
+from app.models import db, Axis, Indicator, Measure
+from app.cache import get_version, bump_version, DATA_VERSION_KEY
+
+# Bumped by admin routes whenever axes, indicators or measures change
+HIERARCHY_VERSION_KEY = 'hierarchy'
+
+# Bumped only by hierarchy changes that alter scores (weights, activation, adding/removing items), not by renames
+SCORING_VERSION_KEY = 'scoring'
+
+
+# --- Scoreable Item (one score column) ---
+class ScoreableItem:
+    """An active measure or a directly scored indicator, with its precomputed hierarchical name."""
+    __slots__ = ('kind', 'id', 'name', 'label', 'indicator_id', 'axis_id')
+
+    def __init__(self, kind, item_id, name, label, indicator_id, axis_id):
+        self.kind = kind
+        self.id = item_id
+        self.name = name
+        self.label = label
+        self.indicator_id = indicator_id
+        self.axis_id = axis_id
+
+    @property
+    def measure_id(self):
+        return self.id if self.kind == 'measure' else None
+
+    @property
+    def direct_indicator_id(self):
+        return self.id if self.kind == 'indicator' else None
+
+    def __repr__(self):
+        return f'<ScoreableItem {self.kind} {self.id}: {self.label}>'
+
+
+# --- Hierarchy Snapshot ---
+class HierarchySnapshot:
+    """
+    Read-only, array-backed copy of the whole Axis/Indicator/Measure tree.
+
+    Indicators are ordered by (axis_id, id) and measures by (axis_id,
+    indicator_id, id). Parent links are index arrays (-1 when the parent is
+    missing). Scoreable items list the active measures first, then the
+    indicators that allow a direct score.
+    """
+    __slots__ = (
+        'version',
+        'axis_ids', 'axis_names', 'axis_index',
+        'indicator_ids', 'indicator_names', 'indicator_weights', 'indicator_axis',
+        'indicator_active', 'indicator_direct', 'indicator_index',
+        'measure_ids', 'measure_names', 'measure_weights', 'measure_indicator',
+        'measure_active', 'measure_index',
+        'items', 'item_index', 'items_by_label',
+        'axes_choices', 'indicators_choices',
+    )
+
+    def __init__(self, version, axis_rows, indicator_rows, measure_rows):
+        self.version = version
+
+        axis_rows = sorted(axis_rows, key=lambda r: r[0])
+        self.axis_ids = np.array([r[0] for r in axis_rows], dtype=np.int64)
+        self.axis_names = tuple(r[1] for r in axis_rows)
+        self.axis_index = {axis_id: x for x, axis_id in enumerate(self.axis_ids.tolist())}
+
+        indicator_rows = sorted(indicator_rows, key=lambda r: (r[3], r[0]))
+        self.indicator_ids = np.array([r[0] for r in indicator_rows], dtype=np.int64)
+        self.indicator_names = tuple(r[1] for r in indicator_rows)
+        self.indicator_weights = np.array([r[2] for r in indicator_rows], dtype=float)
+        self.indicator_axis = np.array([self.axis_index.get(r[3], -1) for r in indicator_rows], dtype=np.int64)
+        self.indicator_active = np.array([bool(r[4]) for r in indicator_rows], dtype=bool)
+        self.indicator_direct = np.array([bool(r[5]) for r in indicator_rows], dtype=bool)
+        self.indicator_index = {ind_id: k for k, ind_id in enumerate(self.indicator_ids.tolist())}
+
+        indicator_axis_id = {r[0]: r[3] for r in indicator_rows}
+        measure_rows = sorted(measure_rows, key=lambda r: (indicator_axis_id.get(r[3], 0), r[3], r[0]))
+        self.measure_ids = np.array([r[0] for r in measure_rows], dtype=np.int64)
+        self.measure_names = tuple(r[1] for r in measure_rows)
+        self.measure_weights = np.array([r[2] for r in measure_rows], dtype=float)
+        self.measure_indicator = np.array([self.indicator_index.get(r[3], -1) for r in measure_rows], dtype=np.int64)
+        self.measure_active = np.array([bool(r[4]) for r in measure_rows], dtype=bool)
+        self.measure_index = {m_id: j for j, m_id in enumerate(self.measure_ids.tolist())}
+
+        # --- Scoreable items with precomputed hierarchical names ---
+        items = []
+        for j, measure_id in enumerate(self.measure_ids.tolist()):
+            k = self.measure_indicator[j]
+            if not self.measure_active[j] or k < 0 or not self.indicator_active[k]: continue
+            if self.indicator_axis[k] < 0:
+                print(f"Warning: Skipping measure ID {measure_id} due to missing relationship."); continue
+            items.append(ScoreableItem('measure', measure_id, self.measure_names[j], self.measure_label(j),
+                                       int(self.indicator_ids[k]), int(self.axis_ids[self.indicator_axis[k]])))
+        for k, indicator_id in enumerate(self.indicator_ids.tolist()):
+            if not (self.indicator_active[k] and self.indicator_direct[k]): continue
+            if self.indicator_axis[k] < 0:
+                print(f"Warning: Skipping indicator ID {indicator_id} due to missing axis relationship."); continue
+            items.append(ScoreableItem('indicator', indicator_id, self.indicator_names[k], self.indicator_label(k),
+                                       indicator_id, int(self.axis_ids[self.indicator_axis[k]])))
+        self.items = tuple(items)
+        self.item_index = {(item.kind, item.id): i for i, item in enumerate(self.items)}
+        self.items_by_label = {item.label: item for item in self.items}
+
+        # --- Select field choices (same ordering as the old queries) ---
+        self.axes_choices = tuple(sorted(zip(self.axis_ids.tolist(), self.axis_names), key=lambda c: c[1]))
+        indicator_choices = []
+        for k, indicator_id in enumerate(self.indicator_ids.tolist()):
+            x = self.indicator_axis[k]
+            if x < 0: continue
+            indicator_choices.append((self.axis_names[x], self.indicator_names[k], indicator_id))
+        indicator_choices.sort(key=lambda c: (c[0], c[1]))
+        self.indicators_choices = tuple((ind_id, f"{axis_name} / {ind_name}") for axis_name, ind_name, ind_id in indicator_choices)
+
+    def measure_label(self, j):
+        k = self.measure_indicator[j]
+        if k < 0 or self.indicator_axis[k] < 0: return f"خطا: سنجه {self.measure_ids[j]}"
+        return f"{self.axis_names[self.indicator_axis[k]]} / {self.indicator_names[k]} / {self.measure_names[j]}"
+
+    def indicator_label(self, k):
+        if self.indicator_axis[k] < 0: return f"خطا: شاخص {self.indicator_ids[k]}"
+        return f"{self.axis_names[self.indicator_axis[k]]} / {self.indicator_names[k]} (مستقیم)"
+
+    def label_for(self, measure_id=None, indicator_id=None):
+        """Hierarchical name of any Score target (active or not), or None if it no longer exists."""
+        if measure_id is not None:
+            j = self.measure_index.get(measure_id)
+            return self.measure_label(j) if j is not None else None
+        k = self.indicator_index.get(indicator_id)
+        return self.indicator_label(k) if k is not None else None
+
+
+# --- Building and caching the snapshot ---
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+
+def build_hierarchy(version=None):
+    """Builds a fresh snapshot from the database (sees the caller's uncommitted changes)."""
+    axis_rows = db.session.query(Axis.id, Axis.name).all()
+    indicator_rows = db.session.query(Indicator.id, Indicator.name, Indicator.weight, Indicator.axis_id,
+                                      Indicator.is_active, Indicator.allow_direct_score).all()
+    measure_rows = db.session.query(Measure.id, Measure.name, Measure.weight, Measure.indicator_id,
+                                    Measure.is_active).all()
+    return HierarchySnapshot(version, axis_rows, indicator_rows, measure_rows)
+
+
+def get_hierarchy():
+    """
+    Returns the cached snapshot, rebuilding it only when the hierarchy version
+    has moved (i.e. an admin route changed the hierarchy in any worker).
+    Do not call this between bump_hierarchy_version() and the commit that
+    follows it; use build_hierarchy() there instead.
+    """
+    global _snapshot
+    version = get_version(HIERARCHY_VERSION_KEY)
+    snapshot = _snapshot
+    if snapshot is not None and snapshot.version == version:
+        return snapshot
+    with _snapshot_lock:
+        if _snapshot is None or _snapshot.version != version:
+            print(f"Building hierarchy snapshot (version {version})...")
+            _snapshot = build_hierarchy(version)
+        return _snapshot
+
+
+def bump_hierarchy_version():
+    """Marks the hierarchy (and therefore all results) as changed, in the caller's transaction."""
+    bump_version(HIERARCHY_VERSION_KEY)
+    bump_version(DATA_VERSION_KEY)
+
+
+def bump_scoring_version():
+    """Marks every stored participant result as stale, in the caller's transaction."""
+    bump_version(SCORING_VERSION_KEY)
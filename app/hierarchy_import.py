@@ -0,0 +1,171 @@
+# app/hierarchy_import.py
+import numpy as np
+import pandas as pd
+from sqlalchemy import update, exists, and_, case
+from app.models import db, Axis, Indicator, Measure
+
+# Accepted values of the 'سطح' column
+LEVEL_ALIASES = {'محور': 'axis', 'axis': 'axis', 'شاخص': 'indicator', 'indicator': 'indicator', 'سنجه': 'measure', 'measure': 'measure'}
+LEVEL_LABELS = {'axis': 'محور', 'indicator': 'شاخص', 'measure': 'سنجه'}
+
+
+def _stripped_text(column):
+    """Column as stripped text, None where empty."""
+    text = column.astype(str).str.strip().where(column.notna(), '')
+    return text.where(text != '', None)
+
+
+def _weight_error(raw):
+    """Why a weight cell is invalid (same wording as the old row-by-row import), or None."""
+    try:
+        if pd.isna(raw): raise ValueError("مقدار وزن نمی‌تواند خالی باشد.")
+        weight = float(raw)
+        if not (0 <= weight <= 1): raise ValueError("مقدار وزن باید بین 0 و 1 باشد.")
+    except (ValueError, TypeError) as e:
+        return str(e)
+    return None
+
+
+# --- Set-based hierarchy importer ---
+class HierarchyImporter:
+    """
+    Imports a hierarchy sheet (columns level, name, parent_name, weight,
+    description) set-wise: rows are validated with column operations, parents
+    are resolved against the database and earlier rows of the sheet, each
+    level is inserted with one bulk statement, and allow_direct_score is
+    recomputed for all affected indicators with a single UPDATE.
+
+    Rules are those of the old row-by-row import: a parent must already exist
+    or be defined on an earlier row; existing and repeated items are skipped;
+    a measure's parent is the first indicator with that name. Nothing is
+    written when any row is invalid; the caller commits or rolls back.
+    """
+
+    def __init__(self, df):
+        column = lambda name: df[name] if name in df.columns else pd.Series([None] * len(df), index=df.index, dtype=object)
+        self.rows = pd.DataFrame({
+            'row_num': np.arange(len(df)) + 2,
+            'level_raw': column('level').to_numpy(),
+            'level': _stripped_text(column('level')).str.lower().map(LEVEL_ALIASES).to_numpy(),
+            'name': _stripped_text(column('name')).to_numpy(),
+            'parent_raw': column('parent_name').to_numpy(),
+            'parent': _stripped_text(column('parent_name')).to_numpy(),
+            'weight_raw': column('weight').to_numpy(),
+            'description': _stripped_text(column('description')).to_numpy(),
+        })
+        self.errors = [] # (row_num, message)
+        self.items_added_count = 0
+
+    def error(self, rows, make_message):
+        for row in rows.itertuples(index=False):
+            self.errors.append((row.row_num, make_message(row)))
+
+    @property
+    def row_errors(self):
+        return [msg for _, msg in sorted(self.errors, key=lambda e: e[0])]
+
+    def valid_weights(self, rows, level):
+        """Rows of this level whose weight is valid; errors are recorded for the others."""
+        weights = pd.to_numeric(rows['weight_raw'], errors='coerce')
+        ok = weights.between(0, 1)
+        label = LEVEL_LABELS[level]
+        self.error(rows[~ok], lambda r: f"ردیف {r.row_num} ({label} '{r.name}'): مقدار 'وزن' نامعتبر است ('{r.weight_raw}'). خطا: {_weight_error(r.weight_raw)}")
+        return rows[ok].assign(weight=weights[ok].astype(float))
+
+    # --- Validation and parent resolution ---
+    def plan(self):
+        """Resolves every row. Returns (new_axes, new_indicators, new_measures) DataFrames."""
+        rows = self.rows
+        bad_level = rows['level'].isna()
+        self.error(rows[bad_level], lambda r: f"ردیف {r.row_num}: مقدار ستون 'سطح' نامعتبر یا خالی است ('{r.level_raw}'). مقادیر مجاز: محور, شاخص, سنجه.")
+        no_name = ~bad_level & rows['name'].isna()
+        self.error(rows[no_name], lambda r: f"ردیف {r.row_num}: مقدار ستون 'نام' الزامی و نمی‌تواند خالی باشد.")
+        rows = rows[~bad_level & ~no_name]
+
+        # --- Axes ---
+        axes = rows[rows['level'] == 'axis']
+        self.error(axes[axes['parent'].notna()], lambda r: f"ردیف {r.row_num} (محور '{r.name}'): محورها نباید 'نام والد' داشته باشند (مقدار یافت شده: '{r.parent_raw}').")
+        axes = axes[axes['parent'].isna()]
+        existing_axes = dict(db.session.query(Axis.name, Axis.id).all())
+        new_axes = axes[~axes['name'].isin(existing_axes)].drop_duplicates('name')
+        # Row from which each axis can be used as a parent (0: already in the database)
+        axis_available_from = pd.concat([pd.Series(0, index=list(existing_axes), dtype=int),
+                                         pd.Series(new_axes['row_num'].to_numpy(), index=new_axes['name'].to_numpy())])
+
+        # --- Indicators ---
+        indicators = rows[rows['level'] == 'indicator']
+        self.error(indicators[indicators['parent'].isna()], lambda r: f"ردیف {r.row_num} (شاخص '{r.name}'): 'نام والد' (نام محور) الزامی است و نمی‌تواند خالی باشد.")
+        indicators = indicators[indicators['parent'].notna()]
+        parent_from = indicators['parent'].map(axis_available_from)
+        parent_ok = parent_from.notna() & (parent_from < indicators['row_num'])
+        self.error(indicators[~parent_ok], lambda r: f"ردیف {r.row_num} (شاخص '{r.name}'): محور والد '{r.parent}' یافت نشد.")
+        indicators = self.valid_weights(indicators[parent_ok], 'indicator')
+        existing_indicators = pd.DataFrame(
+            db.session.query(Indicator.id, Indicator.name, Axis.name).join(Axis, Indicator.axis_id == Axis.id).order_by(Indicator.id).all(),
+            columns=['id', 'name', 'axis_name'])
+        existing_keys = set(zip(existing_indicators['name'], existing_indicators['axis_name']))
+        is_new = [key not in existing_keys for key in zip(indicators['name'], indicators['parent'])]
+        new_indicators = indicators[is_new].drop_duplicates(['name', 'parent'])
+
+        # --- Measures: the parent is the first indicator with that name (existing ones first) ---
+        measures = rows[rows['level'] == 'measure']
+        self.error(measures[measures['parent'].isna()], lambda r: f"ردیف {r.row_num} (سنجه '{r.name}'): 'نام والد' (نام شاخص) الزامی است و نمی‌تواند خالی باشد.")
+        measures = measures[measures['parent'].notna()]
+        first_existing = existing_indicators.drop_duplicates('name').set_index('name')
+        first_new = new_indicators.drop_duplicates('name').set_index('name')
+        in_db = measures['parent'].isin(first_existing.index)
+        new_parent_row = measures['parent'].map(first_new['row_num'])
+        parent_ok = in_db | (new_parent_row.notna() & (new_parent_row < measures['row_num']))
+        self.error(measures[~parent_ok], lambda r: f"ردیف {r.row_num} (سنجه '{r.name}'): شاخص والد '{r.parent}' یافت نشد.")
+        measures = self.valid_weights(measures[parent_ok], 'measure')
+        in_db = measures['parent'].isin(first_existing.index)
+        measures = measures.assign(
+            parent_indicator_id=measures['parent'].map(first_existing['id']).where(in_db),
+            parent_axis=measures['parent'].map(first_existing['axis_name']).where(in_db, measures['parent'].map(first_new['parent'])))
+        existing_measures = set(db.session.query(Measure.name, Indicator.name, Axis.name)
+                                          .join(Indicator, Measure.indicator_id == Indicator.id).join(Axis, Indicator.axis_id == Axis.id).all())
+        is_new = [key not in existing_measures for key in zip(measures['name'], measures['parent'], measures['parent_axis'])]
+        new_measures = measures[is_new].drop_duplicates(['name', 'parent', 'parent_axis'])
+        return new_axes, new_indicators, new_measures
+
+    # --- Writing ---
+    def run(self):
+        """Validates and, if every row is valid, inserts the new items. Returns the number of items added."""
+        new_axes, new_indicators, new_measures = self.plan()
+        if self.errors: return 0
+
+        if len(new_axes):
+            db.session.execute(Axis.__table__.insert(), [{'name': r.name, 'description': r.description} for r in new_axes.itertuples(index=False)])
+        axis_ids = dict(db.session.query(Axis.name, Axis.id).all())
+
+        if len(new_indicators):
+            db.session.execute(Indicator.__table__.insert(), [
+                {'name': r.name, 'weight': r.weight, 'description': r.description, 'axis_id': axis_ids[r.parent],
+                 'is_active': True, 'allow_direct_score': True} for r in new_indicators.itertuples(index=False)])
+        indicator_ids = {}
+        if len(new_measures):
+            new_parent_axes = {axis_ids[name] for name in new_measures['parent_axis']}
+            for ind_id, name, axis_id in db.session.query(Indicator.id, Indicator.name, Indicator.axis_id)\
+                                                   .filter(Indicator.axis_id.in_(new_parent_axes)).order_by(Indicator.id).all():
+                indicator_ids.setdefault((name, axis_id), ind_id)
+            measure_rows = [{'name': r.name, 'weight': r.weight, 'description': r.description, 'is_active': True,
+                             'indicator_id': int(r.parent_indicator_id) if pd.notna(r.parent_indicator_id) else indicator_ids[(r.parent, axis_ids[r.parent_axis])]}
+                            for r in new_measures.itertuples(index=False)]
+            db.session.execute(Measure.__table__.insert(), measure_rows)
+            update_direct_score_allowance({row['indicator_id'] for row in measure_rows})
+
+        self.items_added_count = len(new_axes) + len(new_indicators) + len(new_measures)
+        print(f"Hierarchy import: {len(new_axes)} axes, {len(new_indicators)} indicators, {len(new_measures)} measures added.")
+        return self.items_added_count
+
+
+def update_direct_score_allowance(indicator_ids):
+    """
+    Recomputes allow_direct_score for the given indicators in one UPDATE:
+    allowed only for an active indicator without active measures.
+    """
+    if not indicator_ids: return
+    has_active_measure = exists().where(and_(Measure.indicator_id == Indicator.id, Measure.is_active == True))
+    db.session.execute(update(Indicator).where(Indicator.id.in_(list(indicator_ids)))
+                       .values(allow_direct_score=case((and_(Indicator.is_active == True, ~has_active_measure), True), else_=False))
+                       .execution_options(synchronize_session=False))
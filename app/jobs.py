@@ -0,0 +1,188 @@
+# app/jobs.py
+import os
+import uuid
+import hashlib
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import update
+from app.models import db, ImportJob
+from app.cache import get_version, DATA_VERSION_KEY
+from app.hierarchy import HIERARCHY_VERSION_KEY
+
+# Background jobs running at the same time in one process
+JOB_WORKERS = int(os.environ.get('IMPORT_JOB_WORKERS', '2'))
+
+# Row errors kept on a job (error_count always has the full number)
+MAX_STORED_ERRORS = 200
+
+# Bytes read per step when streaming an upload to disk or hashing it
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# A running job without a heartbeat for this long was interrupted (e.g. its worker restarted)
+JOB_STALE_AFTER = timedelta(minutes=10)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# Jobs submitted to this process's pool that have not finished (a queued job may wait here well past JOB_STALE_AFTER)
+_submitted_jobs = set()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='import-job')
+        return _executor
+
+
+def new_job_id():
+    return uuid.uuid4().hex
+
+
+# --- Uploaded bytes ---
+def store_upload(file, path):
+    """Streams an uploaded file to path, hashing it on the way. Returns the sha256 hex digest."""
+    digest = hashlib.sha256()
+    with open(path, 'wb') as out:
+        while True:
+            chunk = file.stream.read(UPLOAD_CHUNK_SIZE)
+            if not chunk: break
+            digest.update(chunk); out.write(chunk)
+    return digest.hexdigest()
+
+
+def hash_upload(file):
+    """sha256 hex digest of an uploaded file; the stream is rewound for the caller."""
+    digest = hashlib.sha256()
+    while True:
+        chunk = file.stream.read(UPLOAD_CHUNK_SIZE)
+        if not chunk: break
+        digest.update(chunk)
+    file.stream.seek(0)
+    return digest.hexdigest()
+
+
+# --- Job records ---
+def create_job(job_id, kind, filename, file_path, user_id=None, **fields):
+    """Persists a job, queued unless fields say otherwise (commits)."""
+    job = ImportJob(id=job_id, kind=kind, filename=filename, file_path=file_path,
+                    created_by=int(user_id) if user_id is not None else None, **fields)
+    db.session.add(job); db.session.commit()
+    return job
+
+
+def update_job(job_id, **fields):
+    """Writes job fields on a connection of their own, outside the caller's transaction."""
+    with db.engine.begin() as connection:
+        connection.execute(update(ImportJob.__table__).where(ImportJob.__table__.c.id == job_id).values(**fields))
+
+
+def report_progress(job_id, **fields):
+    """Records running counters (and the heartbeat) while a job works."""
+    update_job(job_id, **fields)
+
+
+def finish_job(job_id, status, message, **fields):
+    """Stores the outcome of a job (errors are capped at MAX_STORED_ERRORS)."""
+    if 'errors' in fields: fields['errors'] = fields['errors'][:MAX_STORED_ERRORS]
+    update_job(job_id, status=status, message=message, finished_at=datetime.utcnow(), **fields)
+    print(f"Job {job_id} {status}: {message}")
+
+
+def requeue_job(job_id, file_path):
+    """Queues an interrupted job again with a fresh copy of its file; it resumes after committed_rows."""
+    job = db.session.get(ImportJob, job_id)
+    if job.file_path and job.file_path != file_path and os.path.exists(job.file_path):
+        os.remove(job.file_path)
+    job.file_path = file_path; job.status = 'queued'; job.message = None; job.finished_at = None
+    db.session.commit()
+    return job
+
+
+def is_stale(job):
+    """
+    True for an unfinished job that will not progress any more: a running
+    job whose heartbeat stopped, or a queued job that no pool of this process
+    is holding and that has waited past JOB_STALE_AFTER (left by a restart).
+    """
+    if job.is_finished: return False
+    if job.status == 'queued':
+        with _executor_lock:
+            if job.id in _submitted_jobs: return False
+    heartbeat = job.updated_at or job.created_at
+    return heartbeat is not None and datetime.utcnow() - heartbeat > JOB_STALE_AFTER
+
+
+def is_resumable(job):
+    """An import that committed some batches and then stopped (crash or restart), not a rejected file."""
+    return job.committed_rows > 0 and not job.validation_failed and (job.status == 'failed' or is_stale(job))
+
+
+def find_previous_job(kind, content_hash):
+    """
+    Decides what to do with an upload whose bytes match the latest earlier
+    job of the same kind. Returns (action, job) where action is:
+      'running' - that job is still working on it;
+      'reuse'   - its outcome still holds (successful and nothing changed
+                  since, or rejected and the hierarchy it was checked against
+                  is unchanged);
+      'resume'  - it stopped part-way and can continue after its last batch;
+      None      - import the file normally.
+    """
+    job = ImportJob.query.filter_by(kind=kind, content_hash=content_hash).order_by(ImportJob.created_at.desc()).first()
+    if job is None: return None, None
+    hierarchy_version = get_version(HIERARCHY_VERSION_KEY)
+    if not job.is_finished and not is_stale(job): return 'running', job
+    if is_resumable(job): return ('resume', job) if job.hierarchy_version == hierarchy_version else (None, None)
+    if job.status == 'succeeded':
+        # A hierarchy upload only depends on the hierarchy; a score upload on all data
+        current = hierarchy_version if kind == 'hierarchy' else get_version(DATA_VERSION_KEY)
+        recorded = job.hierarchy_version if kind == 'hierarchy' else job.data_version
+        if recorded == current: return 'reuse', job
+    elif job.validation_failed and job.hierarchy_version == hierarchy_version:
+        return 'reuse', job
+    return None, None
+
+
+def job_status(job):
+    """JSON-ready state of a job."""
+    status = 'interrupted' if is_stale(job) else job.status
+    return {
+        'id': job.id, 'kind': job.kind, 'status': status, 'filename': job.filename,
+        'rows_processed': job.rows_processed, 'committed_rows': job.committed_rows, 'error_count': job.error_count,
+        'errors': job.errors or [], 'warnings': job.warnings or [], 'message': job.message,
+        'finished': job.is_finished or status == 'interrupted', 'resumable': is_resumable(job),
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+# --- Running jobs ---
+def submit_job(job_id, target):
+    """Runs target(job_id) in the pool, inside an application context."""
+    app = current_app._get_current_object()
+    executor = get_executor()
+    with _executor_lock: _submitted_jobs.add(job_id)
+    return executor.submit(_run_job, app, job_id, target)
+
+
+def _run_job(app, job_id, target):
+    with app.app_context():
+        file_path = db.session.get(ImportJob, job_id).file_path
+        try:
+            update_job(job_id, status='running', started_at=datetime.utcnow())
+            target(job_id)
+        except Exception as e:
+            print(f"Job {job_id} crashed: {e}"); traceback.print_exc()
+            db.session.rollback()
+            finish_job(job_id, 'failed', f'خطای غیرمنتظره در پردازش فایل: {e}')
+        finally:
+            with _executor_lock: _submitted_jobs.discard(job_id)
+            if file_path and os.path.exists(file_path):
+                try: os.remove(file_path)
+                except OSError as e: print(f"Could not remove job file {file_path}: {e}")
+            update_job(job_id, file_path=None)
@@ -0,0 +1,171 @@
+# app/migrations.py
+import os
+import shutil
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import inspect, func, or_, update
+from app.models import db, Participant, ParticipantResult, ItemAggregate, Score
+from app.normalize import normalize_search_text
+from app.attachments import add_blob_file, file_sha256, guess_mime_type, temp_upload_path
+from app.scoring import chunked, rebuild_item_aggregates, refresh_participant_results
+from app.cache import bump_data_version, get_version
+from app.hierarchy import SCORING_VERSION_KEY
+
+# Score ids deleted per statement when removing duplicates
+DELETE_BATCH_SIZE = 500
+
+# Participants whose search name is filled per statement
+BACKFILL_BATCH_SIZE = 1000
+
+
+# --- In-place schema upgrade ---
+def upgrade_database():
+    """
+    Brings an existing SQLite/PostgreSQL database up to the current models:
+    creates missing tables, adds missing columns (filling the derived ones),
+    removes duplicate scores, fills the item aggregates and stored results
+    and creates missing indexes. db.create_all()
+    alone never alters existing tables. Safe to run repeatedly; commits.
+    Returns a list of the changes made.
+    """
+    changes = []
+    db.create_all()
+    changes += add_missing_columns()
+    changes += fill_search_names()
+    changes += migrate_legacy_attachments()
+    changes += remove_duplicate_scores()
+    changes += fill_derived_tables()
+    changes += create_missing_indexes()
+    db.session.commit()
+    for change in changes: print(f"Schema upgrade: {change}")
+    return changes
+
+
+def add_missing_columns():
+    """ALTER TABLE ... ADD COLUMN for model columns the database lacks (nullable or with a scalar default)."""
+    changes = []
+    connection = db.session.connection(); inspector = inspect(connection); dialect = connection.dialect
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name): continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing: continue
+            ddl = f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column.type.compile(dialect=dialect)}'
+            if column.default is not None and column.default.is_scalar:
+                default = db.literal(column.default.arg, column.type).compile(dialect=dialect, compile_kwargs={'literal_binds': True})
+                ddl += f" DEFAULT {default}" + ("" if column.nullable else " NOT NULL")
+            elif not column.nullable:
+                print(f"⚠️ WARNING: Cannot add NOT NULL column {table.name}.{column.name} without a default; skipped.")
+                continue
+            db.session.execute(db.text(ddl))
+            changes.append(f"added column {table.name}.{column.name}")
+    return changes
+
+
+def fill_search_names():
+    """Fills Participant.search_name for rows written before the column existed."""
+    filled = 0
+    while True:
+        rows = db.session.query(Participant.phone, Participant.name).filter(Participant.search_name.is_(None))\
+                         .order_by(Participant.phone).limit(BACKFILL_BATCH_SIZE).all()
+        if not rows: break
+        db.session.execute(update(Participant), [{'phone': phone, 'search_name': normalize_search_text(name)} for phone, name in rows])
+        filled += len(rows)
+    return [f"filled search names for {filled} participant(s)"] if filled else []
+
+
+def migrate_legacy_attachments():
+    """
+    Moves attachments of the old flat layout (participant.attachment_filename,
+    UPLOAD_FOLDER/<phone>_<name>) into the content-addressed store. Each file
+    is copied in, linked and committed before the old file is removed; the
+    old column is left in place but emptied.
+    """
+    connection = db.session.connection()
+    if 'attachment_filename' not in {column['name'] for column in inspect(connection).get_columns('participant')}: return []
+    rows = db.session.execute(db.text("SELECT phone, attachment_filename FROM participant WHERE attachment_filename IS NOT NULL")).all()
+    folder = current_app.config['UPLOAD_FOLDER']; moved = 0; missing = 0
+    for phone, filename in rows:
+        legacy_path = os.path.join(folder, filename)
+        if os.path.isfile(legacy_path):
+            temp_path = temp_upload_path(); shutil.copyfile(legacy_path, temp_path)
+            blob = add_blob_file(temp_path, file_sha256(temp_path), guess_mime_type(filename)); db.session.flush()
+            name = filename[len(phone) + 1:] if filename.startswith(f"{phone}_") else filename
+            db.session.execute(update(Participant).where(Participant.phone == phone).values(attachment_blob_id=blob.id, attachment_name=name))
+            moved += 1
+        else:
+            print(f"⚠️ WARNING: Attachment file {legacy_path} of participant {phone} is missing; link removed.")
+            missing += 1
+        db.session.execute(db.text("UPDATE participant SET attachment_filename = NULL WHERE phone = :phone"), {'phone': phone})
+        db.session.commit()
+        if os.path.isfile(legacy_path): os.remove(legacy_path)
+    if not rows: return []
+    bump_data_version()
+    return [f"moved {moved} attachment file(s) into content-addressed storage" + (f" ({missing} missing on disk)" if missing else "")]
+
+
+def remove_duplicate_scores():
+    """
+    Keeps one Score per (participant, measure) and per (participant, direct
+    indicator): the most recently written one (latest timestamp, then highest
+    id). Aggregates and stored results are rebuilt if anything was removed.
+    """
+    duplicate_keys = db.session.query(Score.participant_phone, Score.measure_id, Score.indicator_id)\
+                               .group_by(Score.participant_phone, Score.measure_id, Score.indicator_id)\
+                               .having(func.count(Score.id) > 1).all()
+    if not duplicate_keys: return []
+    duplicate_keys = set(duplicate_keys); phones = sorted({phone for phone, _, _ in duplicate_keys})
+    candidates = {}
+    for chunk in chunked(phones, DELETE_BATCH_SIZE):
+        rows = db.session.query(Score.id, Score.participant_phone, Score.measure_id, Score.indicator_id, Score.timestamp)\
+                         .filter(Score.participant_phone.in_(chunk)).all()
+        for score_id, phone, measure_id, indicator_id, timestamp in rows:
+            key = (phone, measure_id, indicator_id)
+            if key in duplicate_keys: candidates.setdefault(key, []).append((timestamp or datetime.min, score_id))
+    remove_ids = []
+    for rows in candidates.values():
+        rows.sort()
+        remove_ids.extend(score_id for _, score_id in rows[:-1])
+    for chunk in chunked(remove_ids, DELETE_BATCH_SIZE):
+        Score.query.filter(Score.id.in_(chunk)).delete(synchronize_session=False)
+    rebuild_item_aggregates()
+    refresh_participant_results(phones)
+    bump_data_version()
+    return [f"removed {len(remove_ids)} duplicate score(s) for {len(phones)} participant(s)"]
+
+
+def fill_derived_tables():
+    """
+    Builds ItemAggregate when it is empty but scores exist, and stores results
+    for participants that have none (or one computed before the last scoring
+    change), so requests never have to fill these tables themselves.
+    """
+    changes = []
+    if db.session.query(ItemAggregate.id).first() is None and db.session.query(Score.id).first() is not None:
+        changes.append(f"built aggregates for {rebuild_item_aggregates()} item(s)")
+    scoring_version = get_version(SCORING_VERSION_KEY)
+    phones = [row[0] for row in db.session.query(Participant.phone)
+                                          .outerjoin(ParticipantResult, ParticipantResult.participant_phone == Participant.phone)
+                                          .filter(or_(ParticipantResult.participant_phone.is_(None), ParticipantResult.scoring_version.is_(None),
+                                                      ParticipantResult.scoring_version != scoring_version))
+                                          .order_by(Participant.phone)]
+    if phones:
+        refresh_participant_results(phones)
+        changes.append(f"stored results for {len(phones)} participant(s)")
+    if changes: bump_data_version()
+    return changes
+
+
+def create_missing_indexes():
+    """Creates model indexes that do not exist in the database yet."""
+    changes = []
+    connection = db.session.connection(); inspector = inspect(connection)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name): continue
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing: continue
+            index.create(bind=connection) # No-op for indexes limited to another dialect
+            if index.name in {created['name'] for created in inspect(connection).get_indexes(table.name)}:
+                changes.append(f"created index {index.name}")
+    return changes
@@ -1,13 +1,29 @@
 # app/models.py
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import CheckConstraint
+from sqlalchemy.orm import validates
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
+from app.normalize import normalize_search_text
 
 # Initialize SQLAlchemy extension
 db = SQLAlchemy()
 
+
+# --- Dialect-specific upserts (ON CONFLICT on SQLite and PostgreSQL) ---
+def dialect_insert(table):
+    """Returns a dialect-specific INSERT supporting ON CONFLICT, or None if the database has none."""
+    dialect_name = db.session.get_bind().dialect.name
+    if dialect_name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect_name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return None
+    return insert(table)
+
+
 # --- User Model for Admin Login ---
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -79,14 +95,45 @@ class Measure(db.Model):
         status = "Active" if self.is_active else "Inactive"
         return f'<Measure {self.name} ({status})>'
 
+# --- Attachment Blob Model (content-addressed attachment files) ---
+class AttachmentBlob(db.Model):
+    """
+    One stored attachment file, kept once per content under
+    UPLOAD_FOLDER/<sha256[:2]>/<sha256[2:4]>/<sha256> and shared by every
+    participant whose attachment has the same bytes.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.String(64), unique=True, nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    mime_type = db.Column(db.String(100), nullable=False, default='application/octet-stream')
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<AttachmentBlob {self.sha256[:12]} ({self.size} bytes)>'
+
 # --- Participant Model ---
 class Participant(db.Model):
     phone = db.Column(db.String(15), primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     scores = db.relationship('Score', backref='participant', lazy='dynamic', cascade="all, delete-orphan")
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    # --- NEW: Field to store the attachment filename ---
-    attachment_filename = db.Column(db.String(255), nullable=True) # Store only the filename
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True) # Indexed for the list ordering
+    # --- UPDATED: Attachment stored once per content (see app.attachments); replaces attachment_filename ---
+    attachment_blob_id = db.Column(db.Integer, db.ForeignKey('attachment_blob.id'), nullable=True, index=True)
+    attachment_name = db.Column(db.String(255), nullable=True) # Uploaded (secured) filename, for display and download
+    attachment_blob = db.relationship('AttachmentBlob')
+    result = db.relationship('ParticipantResult', backref='participant', uselist=False, cascade="all, delete-orphan")
+    # --- NEW: Normalized name for indexed prefix search (see app.normalize) ---
+    search_name = db.Column(db.String(100), nullable=True, index=True)
+    __table_args__ = (
+        # PostgreSQL only: prefix searches (LIKE 'p%') need pattern ops under a non-C collation; SQLite uses a range on the plain indexes
+        db.Index('ix_participant_phone_prefix', 'phone', postgresql_ops={'phone': 'text_pattern_ops'}).ddl_if(dialect='postgresql'),
+        db.Index('ix_participant_search_name_prefix', 'search_name', postgresql_ops={'search_name': 'text_pattern_ops'}).ddl_if(dialect='postgresql'),
+    )
+
+    @validates('name')
+    def _set_search_name(self, key, name):
+        self.search_name = normalize_search_text(name)
+        return name
 
     def __repr__(self):
         return f'<Participant {self.name} ({self.phone})>'
@@ -104,6 +151,15 @@ class Score(db.Model):
             '(measure_id IS NOT NULL AND indicator_id IS NULL) OR (measure_id IS NULL AND indicator_id IS NOT NULL)',
             name='score_target_check'
         ),
+        # --- NEW: Lookup indexes and one score per (participant, target) ---
+        # Existing databases get these from app.migrations.upgrade_database()
+        db.Index('ix_score_participant_phone', 'participant_phone'),
+        db.Index('ix_score_measure_id', 'measure_id'),
+        db.Index('ix_score_indicator_id', 'indicator_id'),
+        db.Index('uq_score_participant_measure', 'participant_phone', 'measure_id', unique=True,
+                 sqlite_where=db.text('measure_id IS NOT NULL'), postgresql_where=db.text('measure_id IS NOT NULL')),
+        db.Index('uq_score_participant_indicator', 'participant_phone', 'indicator_id', unique=True,
+                 sqlite_where=db.text('indicator_id IS NOT NULL'), postgresql_where=db.text('indicator_id IS NOT NULL')),
     )
 
     def __repr__(self):
@@ -112,6 +168,104 @@ class Score(db.Model):
         return f'<Score {self.value} for {target_type} {target_id} by Participant {self.participant_phone}>'
 
 
+# --- Participant Result Model (materialized scores) ---
+class ParticipantResult(db.Model):
+    """
+    Computed indicator/axis/overall scores of one participant. Refreshed by
+    app.scoring.refresh_participant_results() when the participant's scores
+    change; a hierarchy change that affects scoring only makes the rows
+    stale (scoring_version). app.scoring.get_participant_result() computes
+    a stale row in memory on read; `flask rebuild-results` and upgrade-db
+    rewrite the stored rows.
+    """
+    participant_phone = db.Column(db.String(15), db.ForeignKey('participant.phone'), primary_key=True)
+    overall_score = db.Column(db.Float, nullable=False, default=0.0)
+    indicator_scores = db.Column(db.JSON, nullable=False, default=dict) # {indicator_id: score}
+    axis_scores = db.Column(db.JSON, nullable=False, default=dict) # {axis_id: score}
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    scoring_version = db.Column(db.Integer, nullable=True) # Scoring version counter the row was computed at
+
+    def __repr__(self):
+        return f'<ParticipantResult {self.participant_phone}: {self.overall_score:.2f}>'
+
+
+# --- Item Aggregate Model (running per-item score statistics) ---
+class ItemAggregate(db.Model):
+    """
+    Running count/sum/sum-of-squares of all scores given to one measure or one
+    directly scored indicator. Updated in the same transaction as Score writes
+    (see app.scoring.apply_score_changes), so global averages are O(items).
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    measure_id = db.Column(db.Integer, nullable=True, unique=True)
+    indicator_id = db.Column(db.Integer, nullable=True, unique=True)
+    score_count = db.Column(db.Integer, nullable=False, default=0)
+    score_sum = db.Column(db.Float, nullable=False, default=0.0)
+    score_sum_sq = db.Column(db.Float, nullable=False, default=0.0)
+
+    @property
+    def mean(self):
+        return self.score_sum / self.score_count if self.score_count else None
+
+    @property
+    def std(self):
+        if not self.score_count: return None
+        variance = self.score_sum_sq / self.score_count - self.mean ** 2
+        return max(variance, 0.0) ** 0.5
+
+    def __repr__(self):
+        target_type = "Measure" if self.measure_id else "Indicator"
+        target_id = self.measure_id if self.measure_id else self.indicator_id
+        return f'<ItemAggregate {target_type} {target_id}: n={self.score_count}>'
+
+
+# --- Version Counter Model ---
+class VersionCounter(db.Model):
+    """Named counters bumped on writes, used as cache keys shared by all workers."""
+    key = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<VersionCounter {self.key}={self.value}>'
+
+
+# --- Import Job Model (background uploads) ---
+class ImportJob(db.Model):
+    """
+    An upload handed off to the background job runner (app.jobs). The uploaded
+    file is kept on disk until the job ends; progress and the outcome are
+    stored here so any worker can report them.
+    """
+    id = db.Column(db.String(32), primary_key=True) # uuid4 hex
+    kind = db.Column(db.String(30), nullable=False, default='scores')
+    status = db.Column(db.String(20), nullable=False, default='queued') # queued | running | succeeded | failed
+    filename = db.Column(db.String(255), nullable=False)
+    file_path = db.Column(db.String(500), nullable=True)
+    rows_processed = db.Column(db.Integer, nullable=False, default=0)
+    error_count = db.Column(db.Integer, nullable=False, default=0)
+    errors = db.Column(db.JSON, nullable=False, default=list)
+    warnings = db.Column(db.JSON, nullable=False, default=list)
+    message = db.Column(db.Text, nullable=True)
+    created_by = db.Column(db.Integer, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    # --- NEW: Re-upload dedupe and resume ---
+    content_hash = db.Column(db.String(64), nullable=True, index=True) # sha256 of the uploaded bytes
+    hierarchy_version = db.Column(db.Integer, nullable=True) # Hierarchy the file was validated against
+    data_version = db.Column(db.Integer, nullable=True) # Data version right after a successful import
+    validation_failed = db.Column(db.Boolean, nullable=False, default=False)
+    committed_rows = db.Column(db.Integer, nullable=False, default=0) # Data rows already committed (resume point)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow) # Heartbeat
+
+    @property
+    def is_finished(self):
+        return self.status in ('succeeded', 'failed')
+
+    def __repr__(self):
+        return f'<ImportJob {self.id} {self.kind} ({self.status})>'
+
+
 # --- Setting Model ---
 class Setting(db.Model):
     key = db.Column(db.String(50), primary_key=True)
@@ -0,0 +1,44 @@
+# app/normalize.py
+import re
+
+# Persian (۰-۹) and Arabic-Indic (٠-٩) digits -> ASCII
+DIGIT_TRANSLATION = str.maketrans('۰۱۲۳۴۵۶۷۸۹٠١٢٣٤٥٦٧٨٩', '01234567890123456789')
+
+# Arabic letter forms typed on non-Persian keyboards -> the Persian letter
+LETTER_TRANSLATION = str.maketrans({
+    'ي': 'ی', 'ى': 'ی', 'ئ': 'ی', 'ك': 'ک', 'ة': 'ه', 'ۀ': 'ه',
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا', 'ؤ': 'و',
+})
+
+# Diacritics (harakat, tanwin, shadda, superscript alef), tatweel, zero-width
+# non-joiner/joiner and direction marks: 'علی‌رضا' and 'علیرضا' match alike
+IGNORED_CHARACTERS = re.compile('[\u064B-\u065F\u0670\u0640\u200C-\u200F]')
+
+# Runs of whitespace collapse to one space
+SPACE_CHARACTERS = re.compile(r'\s+')
+
+# Separators people type inside phone numbers
+PHONE_SEPARATORS = re.compile(r'[\s\-()]+')
+
+
+def normalize_digits(text):
+    """Replaces Persian and Arabic-Indic digits with ASCII digits."""
+    return text.translate(DIGIT_TRANSLATION) if text else text
+
+
+def normalize_search_text(text):
+    """
+    Canonical form of a name for searching: ASCII digits, Persian letter
+    forms, no diacritics or tatweel, single spaces, lower case. Used both for
+    the stored Participant.search_name and for the typed query.
+    """
+    if not text: return ''
+    text = normalize_digits(str(text)).translate(LETTER_TRANSLATION)
+    text = IGNORED_CHARACTERS.sub('', text)
+    return SPACE_CHARACTERS.sub(' ', text).strip().lower()
+
+
+def normalize_phone_query(text):
+    """Typed phone number (or its beginning) with ASCII digits and no separators; None if it is not one."""
+    text = PHONE_SEPARATORS.sub('', normalize_digits(text or ''))
+    return text if text.isdigit() else None
@@ -0,0 +1,68 @@
+# app/previews.py
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from app.attachments import blob_path, preview_path, PREVIEW_RENDITIONS, IMAGE_MIME_TYPES
+
+# Images downscaled at the same time (decoding is CPU-bound; keep this small next to the web workers)
+PREVIEW_WORKERS = int(os.environ.get('PREVIEW_WORKERS', '2'))
+
+# JPEG quality of the renditions
+PREVIEW_QUALITY = 80
+
+_preview_pool = ThreadPoolExecutor(max_workers=PREVIEW_WORKERS, thread_name_prefix='preview')
+
+# Hashes queued or being rendered, so repeated requests for a missing preview do not pile up work
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+def has_preview(mime_type):
+    return mime_type in IMAGE_MIME_TYPES
+
+
+def queue_previews(sha256, mime_type):
+    """Schedules the renditions of a stored image off the request thread. Returns False if it is not an image."""
+    if not has_preview(mime_type): return False
+    with _pending_lock:
+        if sha256 in _pending: return True
+        _pending.add(sha256)
+    _preview_pool.submit(_render_queued, current_app.config['UPLOAD_FOLDER'], sha256)
+    return True
+
+
+def _render_queued(folder, sha256):
+    try: generate_previews(folder, sha256)
+    except Exception as e: print(f"Error generating previews of {sha256}: {e}")
+    finally:
+        with _pending_lock: _pending.discard(sha256)
+
+
+def generate_previews(folder, sha256):
+    """
+    Writes every missing rendition of a stored image as a JPEG no larger than
+    its PREVIEW_RENDITIONS size (EXIF rotation applied). Renditions are keyed
+    by content hash like the originals, so a file shared by several
+    participants is rendered once. Returns the number written.
+    """
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        print("Pillow is not installed; attachment previews are disabled.")
+        return 0
+    source = blob_path(sha256, folder)
+    missing = {name: size for name, size in PREVIEW_RENDITIONS.items() if not os.path.exists(preview_path(sha256, name, folder))}
+    if not missing or not os.path.exists(source): return 0
+    with Image.open(source) as image:
+        image.draft('RGB', (max(missing.values()),) * 2) # Lets JPEG decode at a reduced scale
+        image = ImageOps.exif_transpose(image).convert('RGB')
+        # Largest first, each rendition scaled down from the previous one
+        for name, size in sorted(missing.items(), key=lambda item: -item[1]):
+            image.thumbnail((size, size))
+            target = preview_path(sha256, name, folder); temp_path = f"{target}.{threading.get_ident()}.part"
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            image.save(temp_path, 'JPEG', quality=PREVIEW_QUALITY, optimize=True)
+            os.replace(temp_path, target)
+    print(f"Generated previews of {sha256}: {', '.join(sorted(missing))}")
+    return len(missing)
@@ -0,0 +1,82 @@
+# app/purge.py
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from sqlalchemy import select
+from app.models import db, Participant, ParticipantResult, ItemAggregate, Score
+from app.scoring import apply_score_changes
+from app.cache import bump_data_version
+from app.jobs import report_progress, finish_job
+from app.attachments import release_blobs, remove_blob_files
+
+# Participants removed per transaction (with their scores and results)
+PURGE_BATCH_SIZE = 200
+
+# Attachment files are removed off the purge thread so disk I/O never holds the database lock
+_file_remover = ThreadPoolExecutor(max_workers=1, thread_name_prefix='purge-files')
+
+
+def _remove_files(app, paths):
+    with app.app_context(): return remove_blob_files(paths) # Rechecks the blob rows, so it needs its own session
+
+
+def delete_participant_batch(phones):
+    """
+    Deletes the given participants with their scores and stored results, and
+    folds the removed scores out of the item aggregates, in the caller's
+    transaction. Returns (scores removed, paths of attachment files no
+    participant uses any more, to remove after the commit).
+    """
+    removed_scores = db.session.query(Score.measure_id, Score.indicator_id, Score.value).filter(Score.participant_phone.in_(phones)).all()
+    Score.query.filter(Score.participant_phone.in_(phones)).delete(synchronize_session=False)
+    apply_score_changes([(m_id, i_id, value, None) for m_id, i_id, value in removed_scores])
+    ParticipantResult.query.filter(ParticipantResult.participant_phone.in_(phones)).delete(synchronize_session=False)
+    blob_ids = [row[0] for row in db.session.query(Participant.attachment_blob_id).filter(Participant.phone.in_(phones), Participant.attachment_blob_id.isnot(None))]
+    Participant.query.filter(Participant.phone.in_(phones)).delete(synchronize_session=False)
+    return len(removed_scores), release_blobs(blob_ids)
+
+
+def delete_remaining_scores():
+    """
+    Deletes scores left without a participant (and folds them out of the item
+    aggregates), in batches with a commit after each. Scores of participants
+    added while the purge runs are kept. Returns the number deleted.
+    """
+    deleted = 0
+    while True:
+        rows = db.session.query(Score.id, Score.measure_id, Score.indicator_id, Score.value)\
+                         .filter(~Score.participant_phone.in_(select(Participant.phone))).order_by(Score.id).limit(PURGE_BATCH_SIZE).all()
+        if not rows: return deleted
+        deleted += Score.query.filter(Score.id.in_([row[0] for row in rows])).delete(synchronize_session=False)
+        apply_score_changes([(m_id, i_id, value, None) for _, m_id, i_id, value in rows])
+        db.session.commit()
+
+
+def run_participant_purge(job_id):
+    """
+    Deletes every participant in batches of PURGE_BATCH_SIZE, each in its own
+    short transaction, reporting progress on the ImportJob after every batch.
+    Attachment files of a committed batch are queued for removal in the
+    background; the job finishes once they are gone.
+    """
+    total = db.session.query(Participant.phone).count()
+    print(f"--- Starting purge of {total} participant(s) (job {job_id}) ---")
+    report_progress(job_id, warnings=[f'{total} شرکت‌کننده برای حذف یافت شد.'])
+    participants_deleted = 0; scores_deleted = 0; file_batches = []; app = current_app._get_current_object()
+    while True:
+        phones = [row[0] for row in db.session.query(Participant.phone).order_by(Participant.phone).limit(PURGE_BATCH_SIZE).all()]
+        if not phones: break
+        removed_scores, stale_paths = delete_participant_batch(phones)
+        bump_data_version()
+        db.session.commit()
+        participants_deleted += len(phones); scores_deleted += removed_scores
+        if stale_paths: file_batches.append(_file_remover.submit(_remove_files, app, stale_paths))
+        report_progress(job_id, rows_processed=participants_deleted)
+    scores_deleted += delete_remaining_scores()
+    if db.session.query(Participant.phone).first() is None:
+        # Nothing is left to aggregate; clear what rounding or orphaned rows left behind
+        ItemAggregate.query.delete(synchronize_session=False); ParticipantResult.query.delete(synchronize_session=False)
+        bump_data_version(); db.session.commit()
+    files_deleted = sum(batch.result() for batch in file_batches)
+    print(f"DELETED ALL PARTICIPANTS ({participants_deleted}), SCORES ({scores_deleted}), and ATTACHMENTS ({files_deleted})")
+    finish_job(job_id, 'succeeded', f'تمام {participants_deleted} شرکت‌کننده، {scores_deleted} امتیاز و {files_deleted} فایل پیوست حذف شدند.',
+               rows_processed=participants_deleted)
@@ -2,11 +2,15 @@
 from flask import Blueprint, render_template, redirect, url_for, flash, request, current_app, send_from_directory
 from sqlalchemy.orm import joinedload, load_only
 from sqlalchemy.exc import IntegrityError
-import pandas as pd
 import os
-from flask_login import login_required
+from flask_login import login_required, current_user
+from datetime import datetime
 # Use absolute imports
 from app.models import db, Axis, Indicator, Measure, Setting
+from app.scoring import delete_item_aggregates
+from app.cache import bump_data_version, get_version, settings_cache
+from app.hierarchy import bump_hierarchy_version, bump_scoring_version, HIERARCHY_VERSION_KEY
+from app.jobs import new_job_id, create_job, hash_upload, find_previous_job
 from app.forms import AxisForm, IndicatorForm, MeasureForm, UploadHierarchyForm, HelpTextForm
 import traceback
 
@@ -36,6 +40,17 @@ def update_indicator_direct_score(indicator_id):
     print(f"Indicator '{indicator.name}' (ID: {indicator_id}): allow_direct_score set to {indicator.allow_direct_score}")
 
 
+# --- Helper to call after any change that affects scoring ---
+def hierarchy_changed():
+    """
+    Bumps the hierarchy/data versions and marks every participant's stored
+    results stale (reads compute them afresh until `flask rebuild-results`
+    or the participant's next score write). Call right before commit. Name/description-only edits use bump_hierarchy_version().
+    """
+    bump_hierarchy_version()
+    bump_scoring_version()
+
+
 # --- Combined Hierarchy Management Route ---
 @admin_bp.route('/manage', methods=['GET', 'POST'])
 @login_required
@@ -67,6 +82,7 @@ def manage_hierarchy():
                 new_axis = Axis(name=axis_name_submitted, description=axis_form.description.data)
                 db.session.add(new_axis)
                 flash(f'محور "{new_axis.name}" اضافه شد!', 'success')
+            bump_hierarchy_version()
             db.session.commit()
         except IntegrityError as ie:
              db.session.rollback()
@@ -103,6 +119,8 @@ def manage_hierarchy():
                  if existing_check:
                      raise IntegrityError(f"نام شاخص '{indicator_name}' در این محور تکراری است.", params=None, orig=None)
 
+                 scoring_changed = (indicator.weight != indicator_form.weight.data or indicator.axis_id != parent_axis_obj.id
+                                    or indicator.is_active != is_active_submitted)
                  indicator.name = indicator_name
                  indicator.weight = indicator_form.weight.data
                  indicator.description = indicator_form.description.data
@@ -123,7 +141,11 @@ def manage_hierarchy():
                 new_indicator.allow_direct_score = new_indicator.is_active
                 db.session.add(new_indicator)
                 flash(f'شاخص "{new_indicator.name}" اضافه شد!', 'success')
+                scoring_changed = True
 
+             # Renames and description edits leave the stored results valid
+             if scoring_changed: hierarchy_changed()
+             else: bump_hierarchy_version()
              db.session.commit()
          except IntegrityError as ie:
               db.session.rollback()
@@ -156,6 +178,8 @@ def manage_hierarchy():
                 if existing_check:
                      raise IntegrityError(f"نام سنجه '{measure_name}' در این شاخص تکراری است.", params=None, orig=None)
 
+                scoring_changed = (measure.weight != measure_form.weight.data or measure.indicator_id != parent_indicator_obj.id
+                                   or measure.is_active != is_active_submitted)
                 measure.name = measure_name
                 measure.weight = measure_form.weight.data
                 measure.description = measure_form.description.data
@@ -174,8 +198,12 @@ def manage_hierarchy():
                 )
                 db.session.add(new_measure)
                 flash(f'سنجه "{new_measure.name}" اضافه شد!', 'success')
+                scoring_changed = True
 
             update_indicator_direct_score(parent_indicator_obj.id)
+            # Renames and description edits leave the stored results valid
+            if scoring_changed: hierarchy_changed()
+            else: bump_hierarchy_version()
             db.session.commit()
         except IntegrityError as ie:
             db.session.rollback()
@@ -219,8 +247,18 @@ def upload_hierarchy():
     if form.validate_on_submit():
         file = form.excel_file.data
         print(f"File '{file.filename}' received and validated.")
+        # --- NEW: Identical re-uploads get the earlier outcome while the hierarchy is unchanged ---
+        content_hash = hash_upload(file)
+        action, previous = find_previous_job('hierarchy', content_hash)
+        if action == 'reuse':
+            print(f"Hierarchy upload matches job {previous.id}; reusing its outcome.")
+            flash(f'این فایل قبلاً پردازش شده و ساختار از آن زمان تغییری نکرده است. نتیجه قبلی: {previous.message}', 'info' if previous.status == 'succeeded' else 'danger')
+            return redirect(url_for('admin.manage_hierarchy'))
+        outcome = None # (job status, flash category, message) recorded for later re-uploads
         try:
-            df = pd.read_excel(file, engine='openpyxl', header=0)
+            from app.spreadsheets import SheetReader # pandas/openpyxl load on the first upload, not at worker boot
+            from app.hierarchy_import import HierarchyImporter
+            df = SheetReader(file, file.filename).read_all()
             print(f"Successfully read Excel file. Shape: {df.shape}")
 
             expected_cols_map = {
@@ -243,169 +281,20 @@ def upload_hierarchy():
                  print(f"ERROR: Missing required columns after normalization: {missing_std_cols}. Original missing: {missing_display}")
                  return redirect(url_for('admin.manage_hierarchy'))
 
-            print("Loading existing data into cache...")
-            axes_created = {axis.name: axis for axis in Axis.query.all()}
-            indicators_created = {}
-            for ind in Indicator.query.options(joinedload(Indicator.axis)).all():
-                 if ind.axis:
-                      indicators_created[(ind.name, ind.axis.name)] = ind
-            measures_created = {}
-            for m in Measure.query.options(joinedload(Measure.indicator).joinedload(Indicator.axis)).all():
-                 if m.indicator and m.indicator.axis:
-                      measures_created[(m.name, m.indicator.name, m.indicator.axis.name)] = m
-
-            print(f"Cache loaded: {len(axes_created)} Axes, {len(indicators_created)} Indicators, {len(measures_created)} Measures.")
-
-            row_errors = []
-            items_added_count = 0
-            indicators_to_update_allow_score = set()
-
-            print("Starting row processing...")
-            for index, row in df.iterrows():
-                row_num = index + 2
-                print(f"\n--- Processing Row {row_num} ---")
-                try:
-                    level_raw = row.get('level')
-                    name_raw = row.get('name')
-                    parent_name_raw = row.get('parent_name')
-                    weight_raw = row.get('weight')
-                    description_raw = row.get('description')
-
-                    level = str(level_raw).strip().lower() if pd.notna(level_raw) else None
-                    name = str(name_raw).strip() if pd.notna(name_raw) else None
-                    parent_name = str(parent_name_raw).strip() if pd.notna(parent_name_raw) else None
-                    parent_name = parent_name if parent_name else None
-                    description = str(description_raw).strip() if pd.notna(description_raw) else None
-                    description = description if description else None
-
-                    print(f"Row {row_num} Data: Level='{level}', Name='{name}', Parent='{parent_name}', Weight='{weight_raw}', Desc='{description}'")
-
-                    if not level or level not in ['محور', 'axis', 'شاخص', 'indicator', 'سنجه', 'measure']:
-                        error_msg = f"ردیف {row_num}: مقدار ستون 'سطح' نامعتبر یا خالی است ('{level_raw}'). مقادیر مجاز: محور, شاخص, سنجه."
-                        print(f"ERROR: {error_msg}")
-                        row_errors.append(error_msg)
-                        continue
-                    if not name:
-                        error_msg = f"ردیف {row_num}: مقدار ستون 'نام' الزامی و نمی‌تواند خالی باشد."
-                        print(f"ERROR: {error_msg}")
-                        row_errors.append(error_msg)
-                        continue
-
-                    if level in ['محور', 'axis']:
-                        if parent_name:
-                             error_msg = f"ردیف {row_num} (محور '{name}'): محورها نباید 'نام والد' داشته باشند (مقدار یافت شده: '{parent_name_raw}')."
-                             print(f"ERROR: {error_msg}")
-                             row_errors.append(error_msg)
-                             continue
-                        if name not in axes_created:
-                            print(f"Row {row_num}: Adding Axis '{name}'")
-                            new_axis = Axis(name=name, description=description)
-                            db.session.add(new_axis)
-                            axes_created[name] = new_axis
-                            items_added_count += 1
-                        else:
-                            print(f"Row {row_num}: Skipping existing Axis '{name}'")
-                        continue
-
-                    if level in ['شاخص', 'indicator']:
-                        if not parent_name:
-                            error_msg = f"ردیف {row_num} (شاخص '{name}'): 'نام والد' (نام محور) الزامی است و نمی‌تواند خالی باشد."
-                            print(f"ERROR: {error_msg}")
-                            row_errors.append(error_msg)
-                            continue
-                        if parent_name not in axes_created:
-                            error_msg = f"ردیف {row_num} (شاخص '{name}'): محور والد '{parent_name}' یافت نشد."
-                            print(f"ERROR: {error_msg}")
-                            row_errors.append(error_msg)
-                            continue
-                        try:
-                            if pd.isna(weight_raw): raise ValueError("مقدار وزن نمی‌تواند خالی باشد.")
-                            weight = float(weight_raw)
-                            if not (0 <= weight <= 1): raise ValueError("مقدار وزن باید بین 0 و 1 باشد.")
-                        except (ValueError, TypeError) as e:
-                            error_msg = f"ردیف {row_num} (شاخص '{name}'): مقدار 'وزن' نامعتبر است ('{weight_raw}'). خطا: {e}"
-                            print(f"ERROR: {error_msg}")
-                            row_errors.append(error_msg)
-                            continue
-
-                        indicator_key = (name, parent_name)
-                        if indicator_key not in indicators_created:
-                            print(f"Row {row_num}: Adding Indicator '{name}' under Axis '{parent_name}'")
-                            parent_axis_obj = axes_created[parent_name]
-                            new_indicator = Indicator(name=name, weight=weight, description=description, axis=parent_axis_obj, is_active=True, allow_direct_score=True)
-                            db.session.add(new_indicator)
-                            indicators_created[indicator_key] = new_indicator
-                            items_added_count += 1
-                        else:
-                            print(f"Row {row_num}: Skipping existing Indicator '{name}' under Axis '{parent_name}'")
-                        continue
-
-                    if level in ['سنجه', 'measure']:
-                        if not parent_name:
-                            error_msg = f"ردیف {row_num} (سنجه '{name}'): 'نام والد' (نام شاخص) الزامی است و نمی‌تواند خالی باشد."
-                            print(f"ERROR: {error_msg}")
-                            row_errors.append(error_msg)
-                            continue
-
-                        parent_indicator_obj = None
-                        parent_axis_name_found = None
-                        found_indicator_key = None
-                        for key, ind_obj in indicators_created.items():
-                            ind_name, ax_name = key
-                            if ind_name == parent_name:
-                                parent_indicator_obj = ind_obj
-                                parent_axis_name_found = ax_name
-                                found_indicator_key = key
-                                break
-
-                        if not parent_indicator_obj:
-                             error_msg = f"ردیف {row_num} (سنجه '{name}'): شاخص والد '{parent_name}' یافت نشد."
-                             print(f"ERROR: {error_msg}")
-                             row_errors.append(error_msg)
-                             continue
-                        try:
-                            if pd.isna(weight_raw): raise ValueError("مقدار وزن نمی‌تواند خالی باشد.")
-                            weight = float(weight_raw)
-                            if not (0 <= weight <= 1): raise ValueError("مقدار وزن باید بین 0 و 1 باشد.")
-                        except (ValueError, TypeError) as e:
-                            error_msg = f"ردیف {row_num} (سنجه '{name}'): مقدار 'وزن' نامعتبر است ('{weight_raw}'). خطا: {e}"
-                            print(f"ERROR: {error_msg}")
-                            row_errors.append(error_msg)
-                            continue
-
-                        measure_key = (name, parent_name, parent_axis_name_found)
-                        if measure_key not in measures_created:
-                            print(f"Row {row_num}: Adding Measure '{name}' under Indicator '{parent_name}' (Axis: {parent_axis_name_found})")
-                            new_measure = Measure(name=name, weight=weight, description=description, indicator=parent_indicator_obj, is_active=True)
-                            db.session.add(new_measure)
-                            measures_created[measure_key] = new_measure
-                            items_added_count += 1
-                            indicators_to_update_allow_score.add(parent_indicator_obj.id)
-                        else:
-                             print(f"Row {row_num}: Skipping existing Measure '{name}' under Indicator '{parent_name}' (Axis: {parent_axis_name_found})")
-
-                except Exception as row_e:
-                    error_msg = f"ردیف {row_num}: خطای غیرمنتظره در پردازش - {row_e}"
-                    print(f"ERROR: {error_msg}")
-                    traceback.print_exc()
-                    row_errors.append(error_msg)
-
-            # --- Update allow_direct_score for affected indicators ---
-            if indicators_to_update_allow_score:
-                 print("\nUpdating allow_direct_score for indicators affected by new measures...")
-                 try:
-                      db.session.flush()
-                      for indicator_id in indicators_to_update_allow_score:
-                           update_indicator_direct_score(indicator_id)
-                 except Exception as flush_update_e:
-                      error_msg = f"خطا در به‌روزرسانی وضعیت امتیاز مستقیم شاخص‌ها پس از افزودن سنجه‌ها: {flush_update_e}"
-                      print(f"ERROR: {error_msg}")
-                      traceback.print_exc()
-                      row_errors.append(error_msg)
+            # --- UPDATED: Set-based import (validation, parent resolution and bulk inserts per level) ---
+            importer = HierarchyImporter(df); items_added_count = 0
+            try:
+                items_added_count = importer.run()
+            except Exception as import_e:
+                error_msg = f"خطای غیرمنتظره در پردازش فایل - {import_e}"
+                print(f"ERROR: {error_msg}")
+                traceback.print_exc()
+                importer.errors.append((0, error_msg))
+            row_errors = importer.row_errors
 
 
             # --- Commit or Rollback Transaction ---
-            print("\n--- End of Row Processing ---")
+            print("\n--- End of Hierarchy Import ---")
             print(f"Total items added in this run: {items_added_count}")
             print(f"Total errors found: {len(row_errors)}")
 
@@ -413,8 +302,9 @@ def upload_hierarchy():
                 if items_added_count > 0:
                     try:
                         print("Committing changes...")
+                        hierarchy_changed()
                         db.session.commit()
-                        flash(f'{items_added_count} آیتم جدید با موفقیت از فایل اکسل آپلود و پردازش شد.', 'success')
+                        outcome = ('succeeded', 'success', f'{items_added_count} آیتم جدید با موفقیت از فایل اکسل آپلود و پردازش شد.')
                     except Exception as commit_e:
                         db.session.rollback()
                         flash(f'خطا در ذخیره نهایی اطلاعات در پایگاه داده: {commit_e}', 'danger')
@@ -422,12 +312,12 @@ def upload_hierarchy():
                         traceback.print_exc()
                 else:
                     print("No new items to add, no commit needed.")
-                    flash('هیچ آیتم جدیدی برای افزودن در فایل اکسل یافت نشد (ممکن است تمام آیتم‌ها از قبل وجود داشته باشند).', 'info')
+                    outcome = ('succeeded', 'info', 'هیچ آیتم جدیدی برای افزودن در فایل اکسل یافت نشد (ممکن است تمام آیتم‌ها از قبل وجود داشته باشند).')
             else:
                 print("Errors found, rolling back transaction.")
                 db.session.rollback()
                 error_list_html = "<ul class='text-start ps-4'>" + "".join([f"<li>{err}</li>" for err in row_errors]) + "</ul>"
-                flash(f'خطا در پردازش فایل اکسل. هیچ تغییری ذخیره نشد. خطاها:{error_list_html}', 'danger')
+                outcome = ('failed', 'danger', f'خطا در پردازش فایل اکسل. هیچ تغییری ذخیره نشد. خطاها:{error_list_html}')
 
         except ImportError:
              print("ERROR: Pandas/Openpyxl not installed.")
@@ -439,6 +329,16 @@ def upload_hierarchy():
             db.session.rollback()
             flash(f'خطای غیرمنتظره در آپلود یا پردازش فایل: {e}', 'danger')
 
+        if outcome:
+            status, category, message = outcome
+            flash(message, category)
+            try:
+                create_job(new_job_id(), 'hierarchy', file.filename, None, user_id=current_user.get_id(), content_hash=content_hash,
+                           status=status, message=message, validation_failed=(status == 'failed'),
+                           hierarchy_version=get_version(HIERARCHY_VERSION_KEY), finished_at=datetime.utcnow())
+            except Exception as record_e:
+                db.session.rollback(); print(f"Warning: Could not record hierarchy upload: {record_e}")
+
     else:
         print("ERROR: Form validation failed.")
         for field, errors in form.errors.items():
@@ -482,6 +382,7 @@ def toggle_indicator_active(indicator_id):
         indicator.is_active = not indicator.is_active
         print(f"Toggling indicator '{indicator.name}' to is_active={indicator.is_active}")
         update_indicator_direct_score(indicator.id)
+        hierarchy_changed()
         db.session.commit()
         status = "فعال" if indicator.is_active else "غیرفعال"
         flash(f'وضعیت شاخص "{indicator.name}" به {status} تغییر یافت.', 'success')
@@ -506,6 +407,7 @@ def toggle_measure_active(measure_id):
         measure.is_active = not measure.is_active
         print(f"Toggling measure '{measure.name}' to is_active={measure.is_active}")
         update_indicator_direct_score(parent_indicator_id)
+        hierarchy_changed()
         db.session.commit()
         status = "فعال" if measure.is_active else "غیرفعال"
         flash(f'وضعیت سنجه "{measure.name}" به {status} تغییر یافت.', 'success')
@@ -525,7 +427,11 @@ def delete_axis(axis_id):
     """Deletes an axis and all its descendants."""
     axis = Axis.query.get_or_404(axis_id)
     try:
+        delete_item_aggregates(
+            measure_ids=[m.id for ind in axis.indicators for m in ind.measures],
+            indicator_ids=[ind.id for ind in axis.indicators])
         db.session.delete(axis)
+        hierarchy_changed()
         db.session.commit()
         flash(f'محور "{axis.name}" و تمام زیرمجموعه‌های آن حذف شدند.', 'success')
     except Exception as e:
@@ -540,7 +446,9 @@ def delete_indicator(indicator_id):
     """Deletes an indicator and all its measures."""
     indicator = Indicator.query.get_or_404(indicator_id)
     try:
+        delete_item_aggregates(measure_ids=[m.id for m in indicator.measures], indicator_ids=[indicator.id])
         db.session.delete(indicator)
+        hierarchy_changed()
         db.session.commit()
         flash(f'شاخص "{indicator.name}" و تمام سنجه‌های مرتبط با آن حذف شدند.', 'success')
     except Exception as e:
@@ -556,9 +464,11 @@ def delete_measure(measure_id):
     measure = Measure.query.get_or_404(measure_id)
     parent_indicator_id = measure.indicator_id
     try:
+        delete_item_aggregates(measure_ids=[measure.id])
         db.session.delete(measure)
         print(f"Deleting measure '{measure.name}' (ID: {measure_id})")
         update_indicator_direct_score(parent_indicator_id)
+        hierarchy_changed()
         db.session.commit()
         flash(f'سنجه "{measure.name}" و امتیازات مرتبط با آن حذف شدند.', 'success')
     except IntegrityError as ie:
@@ -630,7 +540,9 @@ def manage_help():
                 setting = Setting(key=setting_key, value=form.help_text.data)
                 db.session.add(setting)
                 print(f"Creating setting '{setting_key}'")
+            bump_data_version()
             db.session.commit()
+            settings_cache.pop(setting_key) # Other workers drop it on the version bump
             flash('متن راهنما با موفقیت ذخیره شد.', 'success')
         except Exception as e:
             db.session.rollback()
@@ -4,6 +4,7 @@ from flask_login import login_user, logout_user, current_user, login_required
 # Use absolute imports
 from app.models import User
 from app.forms import LoginForm
+from app.cache import forget_user
 
 # Create Blueprint for authentication routes
 auth_bp = Blueprint('auth', __name__, url_prefix='/auth')
@@ -22,6 +23,7 @@ def login():
         user = User.query.filter_by(username=username).first()
 
         if user and user.check_password(password):
+            forget_user(user.id) # Later requests reload the row just checked
             login_user(user) # Log the user in
             session.permanent = False # Expire session on browser close
 
@@ -41,6 +43,7 @@ def login():
 @login_required
 def logout():
     """Logs the current user out."""
+    forget_user(current_user.id)
     logout_user()
     flash('شما با موفقیت خارج شدید.', 'info') # Keep logout message
     return redirect(url_for('auth.login'))
@@ -1,18 +1,31 @@
 # app/routes/participants.py
 import os
-import pandas as pd
+import base64
+import zipfile
+import threading
 # --- UPDATED: Import secure_filename, send_from_directory, current_app ---
 from flask import (Blueprint, render_template, request, redirect, url_for,
-                   flash, send_file, send_from_directory, current_app)
+                   flash, send_file, send_from_directory, current_app, jsonify, abort, make_response)
 from werkzeug.utils import secure_filename
 # --- End UPDATED ---
 from io import BytesIO
-from flask_login import login_required
+from flask_login import login_required, current_user
 # Use absolute imports
-from app.models import db, Participant, Measure, Score, Indicator, Axis
+from app.models import db, Participant, AttachmentBlob, ImportJob, Measure, Score, Indicator, Axis
+from app.scoring import refresh_participant_results, apply_score_changes, write_score_rows
+from app.cache import bump_data_version
+from app.hierarchy import get_hierarchy, ScoreableItem
+# --- UPDATED: The spreadsheet modules (pandas/openpyxl) are imported inside the upload and template routes, keeping worker boot light ---
+from app.normalize import normalize_search_text, normalize_phone_query
+from app.jobs import new_job_id, create_job, submit_job, job_status, store_upload, find_previous_job, requeue_job, is_stale
+from app.purge import run_participant_purge
+from app.attachment_import import run_attachment_import, attachment_report_path, archive_limit_error
+from app.attachments import store_attachment, release_blobs, remove_blob_files, blob_path, preview_path, attachment_response, PREVIEW_RENDITIONS
+from app.previews import queue_previews, has_preview
 # --- UPDATED: Import AttachmentForm ---
-from app.forms import ParticipantInfoForm, ScoreForm, UploadForm, AttachmentForm
+from app.forms import ParticipantInfoForm, ScoreForm, UploadForm, AttachmentForm, AttachmentZipForm
 # --- End UPDATED ---
+from sqlalchemy import and_, or_, case, func
 from sqlalchemy.orm import joinedload, undefer
 from wtforms import FloatField
 from wtforms.validators import DataRequired, NumberRange
@@ -23,33 +36,51 @@ import traceback
 participants_bp = Blueprint('participants', __name__, url_prefix='/participants')
 
 # --- Function to get active scoreable items ---
-# (Function remains the same)
 def get_active_scoreable_items():
-    """Fetches active Measures and Indicators allowing direct score."""
-    scoreable_items = []
-    active_indicators = Indicator.query.options(joinedload(Indicator.axis), joinedload(Indicator.measures)).filter(Indicator.is_active == True).order_by(Indicator.axis_id, Indicator.id).all()
-    active_measures = Measure.query.options(joinedload(Measure.indicator).joinedload(Indicator.axis)).filter(Measure.is_active == True).join(Measure.indicator).filter(Indicator.is_active == True).order_by(Indicator.axis_id, Measure.indicator_id, Measure.id).all()
-    measure_indicator_ids = {m.indicator_id for m in active_measures if m.indicator}
-    for measure in active_measures:
-        if measure.indicator and measure.indicator.axis: scoreable_items.append(measure)
-        else: print(f"Warning: Skipping measure ID {measure.id} due to missing relationship.")
-    for indicator in active_indicators:
-        if indicator.allow_direct_score:
-             if indicator.axis: scoreable_items.append(indicator)
-             else: print(f"Warning: Skipping indicator ID {indicator.id} due to missing axis relationship.")
-    return scoreable_items
+    """Returns the active Measures and Indicators allowing direct score, from the hierarchy snapshot."""
+    return list(get_hierarchy().items)
 
 # --- Function to generate unique hierarchical name ---
-# (Function remains the same)
 def get_hierarchical_name(item):
     """Generates a unique name like 'Axis / Indicator / Measure' or 'Axis / Indicator (مستقیم)'."""
-    if isinstance(item, Measure):
-        if item.indicator and item.indicator.axis: return f"{item.indicator.axis.name} / {item.indicator.name} / {item.name}"
-        else: return f"خطا: سنجه {item.id}"
-    elif isinstance(item, Indicator):
-        if item.axis: return f"{item.axis.name} / {item.name} (مستقیم)"
-        else: return f"خطا: شاخص {item.id}"
-    return "آیتم نامشخص"
+    if isinstance(item, ScoreableItem): return item.label
+    hierarchy = get_hierarchy()
+    if isinstance(item, Measure): label = hierarchy.label_for(measure_id=item.id)
+    elif isinstance(item, Indicator): label = hierarchy.label_for(indicator_id=item.id)
+    else: return "آیتم نامشخص"
+    return label or f"خطا: {'سنجه' if isinstance(item, Measure) else 'شاخص'} {item.id}"
+
+# --- NEW: Score form class cached per hierarchy version ---
+class ScoreFormSpec:
+    """The generated score form class and its field-name -> ScoreableItem map for one hierarchy version."""
+    __slots__ = ('version', 'form_class', 'item_name_map', 'items')
+
+    def __init__(self, version, form_class, item_name_map, items):
+        self.version = version; self.form_class = form_class; self.item_name_map = item_name_map; self.items = items
+
+_score_form_spec = None
+_score_form_lock = threading.Lock()
+
+def build_score_form_spec(hierarchy):
+    """Builds a ScoreForm subclass with one FloatField per scoreable item (labels come precomputed from the snapshot)."""
+    class DynamicScoreForm(ScoreForm): pass
+    item_name_map = {}
+    for item in hierarchy.items:
+        field_label = get_hierarchical_name(item); field_name = field_label; item_name_map[field_name] = item
+        if "خطا:" not in field_label: setattr(DynamicScoreForm, field_name, FloatField(field_label, validators=[DataRequired(message="امتیاز الزامی است."), NumberRange(min=0, max=5, message="امتیاز باید بین 0 و 5 باشد.")]))
+        else: print(f"Skipping form field creation for item due to naming error: {item}")
+    return ScoreFormSpec(hierarchy.version, DynamicScoreForm, item_name_map, list(hierarchy.items))
+
+def get_score_form_spec():
+    """Returns the cached ScoreFormSpec, rebuilt only when the hierarchy version moves (admin changes to the hierarchy)."""
+    global _score_form_spec
+    hierarchy = get_hierarchy(); spec = _score_form_spec
+    if spec is not None and spec.version == hierarchy.version: return spec
+    with _score_form_lock:
+        if _score_form_spec is None or _score_form_spec.version != hierarchy.version:
+            print(f"Building score form class (hierarchy version {hierarchy.version})...")
+            _score_form_spec = build_score_form_spec(hierarchy)
+        return _score_form_spec
 
 
 # Combined route for adding new and editing existing participant scores
@@ -66,23 +97,16 @@ def manage_scores(phone=None):
         if not participant: flash(f"شرکت‌کننده‌ای با شماره تلفن {phone} یافت نشد.", "warning"); return redirect(url_for('participants.list_participants'))
         if request.method == 'GET':
             print(f"GET request for existing participant: {participant.name}")
-            scores = Score.query.options(joinedload(Score.scored_measure).joinedload(Measure.indicator).joinedload(Indicator.axis), joinedload(Score.scored_indicator).joinedload(Indicator.axis)).filter_by(participant_phone=phone).all()
-            for score in scores:
-                 item = score.scored_measure if score.measure_id else score.scored_indicator
-                 if item: field_name = get_hierarchical_name(item); existing_scores_dict[field_name] = score.value
-                 else: field_name = f"measure_{score.measure_id}" if score.measure_id else f"indicator_{score.indicator_id}"; existing_scores_dict[field_name] = score.value
+            hierarchy = get_hierarchy()
+            for measure_id, indicator_id, value in db.session.query(Score.measure_id, Score.indicator_id, Score.value).filter_by(participant_phone=phone).all():
+                 field_name = hierarchy.label_for(measure_id, indicator_id) or (f"measure_{measure_id}" if measure_id else f"indicator_{indicator_id}"); existing_scores_dict[field_name] = value
             form_data_for_population = participant
-    try: scoreable_items = get_active_scoreable_items()
-    except Exception as e: flash(f"خطا در بارگذاری سنجه‌ها/شاخص‌های فعال: {e}", "danger"); print(f"Error loading scoreable items: {e}"); traceback.print_exc(); scoreable_items = []
+    try: spec = get_score_form_spec(); DynamicScoreForm = spec.form_class; item_name_map = spec.item_name_map; scoreable_items = spec.items
+    except Exception as e:
+        flash(f"خطا در بارگذاری سنجه‌ها/شاخص‌های فعال: {e}", "danger"); print(f"Error loading scoreable items: {e}"); traceback.print_exc(); scoreable_items = []; item_name_map = {}
+        class DynamicScoreForm(ScoreForm): pass
     participant_form = ParticipantInfoForm(formdata=form_data_for_validation, obj=form_data_for_population)
-    class DynamicScoreForm(ScoreForm): pass
-    item_name_map = {}
-    if scoreable_items:
-        for item in scoreable_items:
-            field_label = get_hierarchical_name(item); field_name = field_label; item_name_map[field_name] = item
-            if "خطا:" not in field_label: setattr(DynamicScoreForm, field_name, FloatField(field_label, validators=[DataRequired(message="امتیاز الزامی است."), NumberRange(min=0, max=5, message="امتیاز باید بین 0 و 5 باشد.")]))
-            else: print(f"Skipping form field creation for item due to naming error: {item}")
-    else:
+    if not scoreable_items:
         if request.method == 'GET' and not phone: flash("هیچ سنجه یا شاخص فعالی برای امتیازدهی یافت نشد.", "warning")
     if request.method == 'POST': score_form = DynamicScoreForm(formdata=request.form)
     elif phone and request.method == 'GET': score_form = DynamicScoreForm(data=existing_scores_dict); print(f"Populating score form with data: {existing_scores_dict}")
@@ -102,22 +126,24 @@ def manage_scores(phone=None):
                  if not participant or participant.phone != submitted_phone: flash("خطا: تلاش برای ویرایش شرکت‌کننده نامعتبر.", "danger"); return redirect(url_for('participants.list_participants'))
                  if participant.name != submitted_name: participant.name = submitted_name
             if not participant: flash("خطای داخلی: اطلاعات شرکت‌کننده یافت نشد.", "danger"); return render_template('participants/add_scores.html', participant_form=participant_form_post, score_form=score_form_post, editing=bool(phone), scoreable_items=scoreable_items, item_name_map=item_name_map)
-            current_participant_phone = participant.phone; print(f"Processing scores for participant: {current_participant_phone}")
+            current_participant_phone = participant.phone; print(f"Processing scores for participant: {current_participant_phone}"); score_changes = []
+            # --- UPDATED: One query for the participant's scores, diff in memory, bulk write of the changed rows ---
+            existing_scores = {(measure_id, indicator_id): (score_id, value) for score_id, measure_id, indicator_id, value in
+                               db.session.query(Score.id, Score.measure_id, Score.indicator_id, Score.value).filter_by(participant_phone=current_participant_phone).all()}
+            now = datetime.utcnow(); score_inserts = []; score_updates = []
             for field_name, item in item_name_map.items():
-                score_value = None; target_measure_id = None; target_indicator_id = None
-                if isinstance(item, Measure): target_measure_id = item.id
-                elif isinstance(item, Indicator): target_indicator_id = item.id
-                else: continue
+                target_measure_id = item.measure_id; target_indicator_id = item.direct_indicator_id
                 if hasattr(score_form_post, field_name): score_value = getattr(score_form_post, field_name).data
                 else: print(f"Warning: Field {field_name} not found in score_form_post during POST."); continue
-                existing_score = Score.query.filter_by(participant_phone=current_participant_phone, measure_id=target_measure_id, indicator_id=target_indicator_id).first()
+                existing_score = existing_scores.get((target_measure_id, target_indicator_id))
                 if existing_score:
-                    if existing_score.value != score_value: existing_score.value = score_value; existing_score.timestamp = datetime.utcnow(); print(f"Updating score for {field_name} to {score_value}")
+                    score_id, old_value = existing_score
+                    if old_value != score_value: score_changes.append((target_measure_id, target_indicator_id, old_value, score_value)); score_updates.append({'id': score_id, 'value': score_value, 'timestamp': now}); print(f"Updating score for {field_name} to {score_value}")
                     else: print(f"Score for {field_name} unchanged ({score_value})")
                 else:
-                    new_score = Score(value=score_value, participant_phone=current_participant_phone, measure_id=target_measure_id, indicator_id=target_indicator_id, timestamp=datetime.utcnow())
-                    db.session.add(new_score); print(f"Adding new score for {field_name}: {score_value}")
-            try: db.session.commit(); flash('اطلاعات و امتیازات با موفقیت ذخیره شدند!', 'success'); return redirect(url_for('participants.list_participants'))
+                    score_inserts.append({'participant_phone': current_participant_phone, 'measure_id': target_measure_id, 'indicator_id': target_indicator_id, 'value': score_value, 'timestamp': now})
+                    score_changes.append((target_measure_id, target_indicator_id, None, score_value)); print(f"Adding new score for {field_name}: {score_value}")
+            try: db.session.flush(); write_score_rows(score_inserts, score_updates); apply_score_changes(score_changes); refresh_participant_results([current_participant_phone]); bump_data_version(); db.session.commit(); flash('اطلاعات و امتیازات با موفقیت ذخیره شدند!', 'success'); return redirect(url_for('participants.list_participants'))
             except Exception as e: db.session.rollback(); flash(f'خطا در ذخیره اطلاعات در پایگاه داده: {e}', 'danger'); print(f"Database commit error: {e}"); traceback.print_exc(); return render_template('participants/add_scores.html', participant_form=participant_form_post, score_form=score_form_post, editing=bool(phone), scoreable_items=scoreable_items, item_name_map=item_name_map)
         else:
              error_messages = [];
@@ -132,83 +158,82 @@ def manage_scores(phone=None):
 @participants_bp.route('/upload-scores', methods=['GET', 'POST'])
 @login_required
 def upload_scores():
-    """Handles uploading scores from an Excel or CSV file. Requires admin login."""
-    # (Code remains the same as previous version)
+    """Queues an uploaded Excel or CSV file for background import. Requires admin login."""
     form = UploadForm()
     if form.validate_on_submit():
+        from app.score_import import run_score_import
         file = form.excel_file.data
-        filename = file.filename
+        if form.dry_run.data: return dry_run_upload(file)
         try:
-            print(f"--- Starting Score Upload: {filename} ---")
-            dtype_spec = {'شماره تلفن': str}
-            if filename.endswith('.xlsx'): df = pd.read_excel(file, engine='openpyxl', header=0, dtype=dtype_spec)
-            elif filename.endswith('.csv'):
-                try: df = pd.read_csv(file, encoding='utf-8', header=0, dtype=dtype_spec)
-                except UnicodeDecodeError: df = pd.read_csv(file, encoding='windows-1256', header=0, dtype=dtype_spec)
-            else: flash('فرمت فایل نامعتبر است. فقط .xlsx یا .csv مجاز است.', 'danger'); return redirect(url_for('participants.upload_scores'))
-            print(f"File read successfully. Shape: {df.shape}"); df.columns = [str(col).strip() for col in df.columns]
-            scoreable_items = get_active_scoreable_items()
-            item_hierarchical_name_to_target = { get_hierarchical_name(item): ('measure' if isinstance(item, Measure) else 'indicator', item.id) for item in scoreable_items if "خطا:" not in get_hierarchical_name(item) }
-            print(f"Scoreable items map (Hierarchical Name -> Target): {item_hierarchical_name_to_target}")
-            required_cols = ['شماره تلفن', 'نام']; missing_required = [col for col in required_cols if col not in df.columns]
-            if missing_required: flash(f'فایل آپلود شده فاقد ستون‌های الزامی است: {", ".join(missing_required)}.', 'danger'); return redirect(url_for('participants.upload_scores'))
-            score_columns_in_file = {}; unknown_columns = []
-            for col_name in df.columns:
-                if col_name in required_cols: continue
-                if col_name in item_hierarchical_name_to_target: score_columns_in_file[col_name] = item_hierarchical_name_to_target[col_name]
-                else: unknown_columns.append(col_name)
-            if not score_columns_in_file: flash('هیچ ستون امتیازی منطبق با نام کامل سنجه‌ها یا شاخص‌های فعال در فایل یافت نشد.', 'warning')
-            if unknown_columns: flash(f'هشدار: ستون‌های زیر نادیده گرفته شدند: {", ".join(unknown_columns)}', 'warning')
-            print(f"Score columns identified in file (using hierarchical names): {score_columns_in_file}")
-            processed_count = 0; error_count = 0; commit_successful = True; row_errors = []
-            for index, row in df.iterrows():
-                row_num = index + 2; row_has_error = False; participant_added_in_loop = False
-                try:
-                    phone_raw = row.get('شماره تلفن'); name_raw = row.get('نام'); phone = str(phone_raw).strip() if pd.notna(phone_raw) else None; name = str(name_raw).strip() if pd.notna(name_raw) else None
-                    if not phone or not name: msg = f"ردیف {row_num}: شماره تلفن ('{phone_raw}') یا نام ('{name_raw}') خالی است."; print(f"Skipping: {msg}"); row_errors.append(msg); error_count += 1; row_has_error = True; continue
-                    if not phone.startswith('0') or not phone.isdigit(): msg = f"ردیف {row_num}: فرمت شماره تلفن '{phone}' نامعتبر است."; print(f"Skipping: {msg}"); row_errors.append(msg); error_count += 1; row_has_error = True; continue
-                    participant = Participant.query.get(phone)
-                    if not participant: participant = Participant(phone=phone, name=name); db.session.add(participant); participant_added_in_loop = True; print(f"Row {row_num}: Adding participant {name} ({phone})")
-                    elif participant.name != name: participant.name = name; print(f"Row {row_num}: Updating name for {phone} to {name}")
-                    for col_name, target_info in score_columns_in_file.items():
-                        target_type, target_id = target_info; score_raw = row.get(col_name)
-                        if pd.isna(score_raw) or str(score_raw).strip() == '': continue
-                        try:
-                            score_value = float(score_raw)
-                            if not (0 <= score_value <= 5): msg = f"ردیف {row_num}, ستون '{col_name}': امتیاز {score_value} خارج از محدوده مجاز (0-5) است."; print(f"Error: {msg}"); row_errors.append(msg); error_count += 1; row_has_error = True; continue
-                            target_measure_id = target_id if target_type == 'measure' else None; target_indicator_id = target_id if target_type == 'indicator' else None
-                            existing_score = Score.query.filter_by(participant_phone=phone, measure_id=target_measure_id, indicator_id=target_indicator_id).first()
-                            if existing_score:
-                                if existing_score.value != score_value: existing_score.value = score_value; existing_score.timestamp = datetime.utcnow(); print(f"Row {row_num}, Col '{col_name}': Updating score to {score_value}")
-                            else: new_score = Score(value=score_value, participant_phone=phone, measure_id=target_measure_id, indicator_id=target_indicator_id, timestamp=datetime.utcnow()); db.session.add(new_score); print(f"Row {row_num}, Col '{col_name}': Adding score {score_value}")
-                        except (ValueError, TypeError): msg = f"ردیف {row_num}, ستون '{col_name}': فرمت امتیاز '{score_raw}' نامعتبر است (باید عدد باشد)."; print(f"Error: {msg}"); row_errors.append(msg); error_count += 1; row_has_error = True; continue
-                    if not row_has_error: processed_count += 1
-                except Exception as row_e: msg = f"ردیف {row_num}: خطای غیرمنتظره در پردازش ردیف - {row_e}"; print(f"Critical error: {msg}"); traceback.print_exc(); row_errors.append(msg); error_count += 1; row_has_error = True; commit_successful = False; break
-            print(f"\n--- Upload Finished --- Processed: {processed_count}, Errors: {error_count}")
-            if commit_successful and error_count == 0:
-                 if processed_count > 0 or participant_added_in_loop:
-                     try: db.session.commit(); flash(f'{processed_count} ردیف با موفقیت پردازش و ذخیره شد.', 'success')
-                     except Exception as commit_error: db.session.rollback(); flash(f'خطا در ذخیره نهایی: {commit_error}', 'danger'); print(f"Final commit error: {commit_error}")
-                 else: flash('تغییری برای ذخیره یافت نشد.', 'info')
-            else:
-                 db.session.rollback(); error_list_html = "<ul class='text-start ps-4' style='max-height: 200px; overflow-y: auto;'>" + "".join([f"<li>{err}</li>" for err in row_errors]) + "</ul>"; flash(f'پردازش فایل با {error_count} خطا مواجه شد. هیچ تغییری ذخیره نشد. خطاها:{error_list_html}', 'danger')
-            return redirect(url_for('participants.list_participants'))
-        except ImportError: flash('خطا: کتابخانه pandas و openpyxl را نصب کنید.', 'danger'); return redirect(url_for('participants.upload_scores'))
+            # The import runs in the background; keep the file until the job is done
+            job_id = new_job_id(); extension = os.path.splitext(file.filename)[1].lower()
+            file_path = os.path.join(current_app.config['IMPORT_FOLDER'], f"{job_id}{extension}"); content_hash = store_upload(file, file_path)
+            action, previous = find_previous_job('scores', content_hash)
+            if action in ('running', 'reuse'):
+                os.remove(file_path); print(f"Score upload '{file.filename}' matches job {previous.id} ({action})")
+                flash('این فایل هم‌اکنون در حال پردازش است.' if action == 'running' else 'این فایل قبلاً پردازش شده و از آن زمان تغییری در داده‌ها ایجاد نشده است؛ نتیجه قبلی نمایش داده می‌شود.', 'info')
+                return redirect(url_for('participants.import_job', job_id=previous.id))
+            if action == 'resume':
+                requeue_job(previous.id, file_path); submit_job(previous.id, run_score_import); print(f"Resuming job {previous.id} after row {previous.committed_rows}")
+                flash(f'پردازش قبلی این فایل نیمه‌کاره مانده بود و از ردیف {previous.committed_rows + 2} ادامه می‌یابد.', 'info')
+                return redirect(url_for('participants.import_job', job_id=previous.id))
+            create_job(job_id, 'scores', file.filename, file_path, user_id=current_user.get_id(), content_hash=content_hash)
+            submit_job(job_id, run_score_import); print(f"Score upload '{file.filename}' queued as job {job_id}")
+            return redirect(url_for('participants.import_job', job_id=job_id))
         except Exception as e: db.session.rollback(); flash(f'خطای غیرمنتظره در پردازش فایل: {e}', 'danger'); print(f"File processing error: {e}"); traceback.print_exc(); return redirect(url_for('participants.upload_scores'))
     return render_template('participants/upload_scores.html', form=form)
 
 
+# --- NEW: Dry run of a score upload (validation report only) ---
+def dry_run_upload(file):
+    """Validates an uploaded file without saving anything; sends an annotated report if it has problems."""
+    from app.spreadsheets import SheetReader, DEFAULT_BATCH_SIZE
+    from app.score_import import match_score_columns, build_dry_run_report, PHONE_COLUMN, REQUIRED_COLUMNS
+    try:
+        print(f"--- Dry run of score upload: {file.filename} ---")
+        try: reader = SheetReader(file, file.filename, batch_size=DEFAULT_BATCH_SIZE, text_columns=[PHONE_COLUMN])
+        except ValueError as format_e: flash(str(format_e), 'danger'); return redirect(url_for('participants.upload_scores'))
+        missing_required = [col for col in REQUIRED_COLUMNS if col not in reader.columns]
+        if missing_required: flash(f'فایل آپلود شده فاقد ستون‌های الزامی است: {", ".join(missing_required)}.', 'danger'); return redirect(url_for('participants.upload_scores'))
+        score_columns, unknown_columns = match_score_columns(reader.columns)
+        report, summary = build_dry_run_report(reader, score_columns, unknown_columns); print(f"Dry run summary: {summary}")
+        if summary['error_count'] or summary['duplicate_rows'] or unknown_columns:
+            report_name = f"report_{os.path.splitext(file.filename)[0]}.xlsx"
+            return send_file(report, download_name=report_name, as_attachment=True, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        if not score_columns: flash('هیچ ستون امتیازی منطبق با نام کامل سنجه‌ها یا شاخص‌های فعال در فایل یافت نشد.', 'warning')
+        flash(f'فایل بررسی شد و خطایی نداشت ({summary["total_rows"]} ردیف). برای ذخیره، آن را بدون گزینه «فقط بررسی» آپلود کنید.', 'success')
+    except Exception as e: flash(f'خطای غیرمنتظره در بررسی فایل: {e}', 'danger'); print(f"Dry run error: {e}"); traceback.print_exc()
+    return redirect(url_for('participants.upload_scores'))
+
+
+# --- NEW: Background import job page and progress endpoint ---
+@participants_bp.route('/import-jobs/<string:job_id>')
+@login_required
+def import_job(job_id):
+    """Shows the progress and outcome of a background job (score upload or participant purge)."""
+    job = db.session.get(ImportJob, job_id)
+    if not job: flash('کار آپلود مورد نظر یافت نشد.', 'warning'); return redirect(url_for('participants.upload_scores'))
+    return render_template('participants/import_job.html', job=job_status(job))
+
+@participants_bp.route('/import-jobs/<string:job_id>/progress')
+@login_required
+def import_job_progress(job_id):
+    """JSON progress of a background job (polled by the job page)."""
+    job = db.session.get(ImportJob, job_id)
+    if not job: return jsonify({'error': 'not found'}), 404
+    return jsonify(job_status(job))
+
+
 # --- Route to Download Score Template ---
 @participants_bp.route('/download-score-template')
 @login_required
 def download_score_template():
     """Generates and serves an Excel template for score uploads. Requires admin login."""
-    # (Code remains the same as previous version)
+    import pandas as pd
     try:
         print("--- Generating Score Template ---")
-        scoreable_items = get_active_scoreable_items(); headers = ['شماره تلفن', 'نام']; hierarchical_item_names = []
-        for item in scoreable_items: h_name = get_hierarchical_name(item);
-        if "خطا:" not in h_name and h_name not in hierarchical_item_names: hierarchical_item_names.append(h_name)
+        scoreable_items = get_active_scoreable_items(); headers = ['شماره تلفن', 'نام']
+        hierarchical_item_names = list(dict.fromkeys(item.label for item in scoreable_items if "خطا:" not in item.label))
         headers.extend(sorted(hierarchical_item_names)); print(f"Template Headers: {headers}"); df = pd.DataFrame(columns=headers)
         sample_data = {h: '' for h in headers}; sample_data['شماره تلفن'] = '09123456789'; sample_data['نام'] = 'نام نمونه'
         for name in hierarchical_item_names: sample_data[name] = 0.0
@@ -222,17 +247,125 @@ def download_score_template():
     except Exception as e: print(f"Error generating score template: {e}"); traceback.print_exc(); flash("خطا در تولید فایل نمونه اکسل.", "danger"); return redirect(url_for('participants.list_participants'))
 
 
+# --- NEW: Keyset pagination and search for the participants list ---
+PARTICIPANTS_PER_PAGE = 15
+MAX_PARTICIPANTS_PER_PAGE = 100
+
+def encode_cursor(participant):
+    """Opaque position just after a participant in the (created_at desc, phone desc) ordering."""
+    created = participant.created_at.isoformat() if participant.created_at else ''
+    return base64.urlsafe_b64encode(f"{created}|{participant.phone}".encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """(created_at or None, phone) from encode_cursor(); raises ValueError for a malformed cursor."""
+    created, phone = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode().split('|', 1)
+    return (datetime.fromisoformat(created) if created else None), phone
+
+def prefix_filter(column, prefix):
+    """
+    column starts with prefix: LIKE 'prefix%' (served by the text_pattern_ops
+    indexes on PostgreSQL), or on SQLite, whose LIKE ignores case and skips
+    indexes, the equivalent range on the column's index.
+    """
+    if db.session.get_bind().dialect.name == 'sqlite':
+        return and_(column >= prefix, column < prefix[:-1] + chr(ord(prefix[-1]) + 1))
+    pattern = prefix.replace('/', '//').replace('%', '/%').replace('_', '/_') + '%' # One constant pattern the planner can match to the index
+    return column.like(pattern, escape='/')
+
+def participants_page(search='', after=None, before=None, per_page=PARTICIPANTS_PER_PAGE):
+    """
+    One page of participants, newest first. search matches the beginning of
+    the phone number (digits in any script) or of the normalized name; after /
+    before are decoded cursors: the page follows / precedes that position.
+    Returns (participants, next_cursor or None, prev_cursor or None).
+    """
+    query = Participant.query.options(joinedload(Participant.attachment_blob))
+    if search:
+        phone_prefix = normalize_phone_query(search); name_prefix = normalize_search_text(search)
+        if phone_prefix: query = query.filter(prefix_filter(Participant.phone, phone_prefix))
+        elif name_prefix: query = query.filter(prefix_filter(Participant.search_name, name_prefix))
+    if before:
+        # Walk backwards from the cursor (reverse ordering, rows ahead of it), then show them in list order
+        created_at, phone = before
+        if created_at is None: query = query.filter(or_(Participant.created_at.isnot(None), Participant.phone > phone))
+        else: query = query.filter(or_(Participant.created_at > created_at, and_(Participant.created_at == created_at, Participant.phone > phone)))
+        rows = query.order_by(Participant.created_at.asc().nulls_first(), Participant.phone.asc()).limit(per_page + 1).all()
+        if len(rows) <= per_page: return participants_page(search, per_page=per_page) # Reached the start: show a full first page
+        rows = rows[:per_page][::-1]
+        return rows, encode_cursor(rows[-1]), encode_cursor(rows[0])
+    if after:
+        created_at, phone = after
+        if created_at is None: query = query.filter(Participant.created_at.is_(None), Participant.phone < phone)
+        else: query = query.filter(or_(Participant.created_at < created_at, and_(Participant.created_at == created_at, Participant.phone < phone), Participant.created_at.is_(None)))
+    rows = query.order_by(Participant.created_at.desc().nulls_last(), Participant.phone.desc()).limit(per_page + 1).all()
+    next_cursor = encode_cursor(rows[per_page - 1]) if len(rows) > per_page else None
+    rows = rows[:per_page]
+    prev_cursor = encode_cursor(rows[0]) if after and rows else None
+    return rows, next_cursor, prev_cursor
+
+
+# --- NEW: Score completion of a page of participants (one grouped query) ---
+def score_completion(phones):
+    """
+    {phone: (scored items, last score timestamp)} for the given participants,
+    counting only scores of currently active scoreable items. Participants
+    without any score are absent. Compare with len(get_hierarchy().items).
+    """
+    if not phones: return {}
+    items = get_hierarchy().items
+    measure_ids = [item.id for item in items if item.kind == 'measure']; indicator_ids = [item.id for item in items if item.kind == 'indicator']
+    is_active_item = or_(Score.measure_id.in_(measure_ids), Score.indicator_id.in_(indicator_ids))
+    rows = db.session.query(Score.participant_phone, func.count(case((is_active_item, 1))), func.max(Score.timestamp))\
+                     .filter(Score.participant_phone.in_(phones)).group_by(Score.participant_phone).all()
+    return {phone: (scored, last_scored) for phone, scored, last_scored in rows}
+
+
 # --- Route to view list of participants ---
 @participants_bp.route('/list')
 @login_required
 def list_participants():
-     """Displays a paginated list of participants. Requires admin login."""
-     page = request.args.get('page', 1, type=int)
+     """Displays the participants list, one keyset page at a time, with search. Requires admin login."""
+     search = request.args.get('q', '', type=str).strip()
+     cursor = request.args.get('after', '', type=str); back_cursor = request.args.get('before', '', type=str)
+     participants = None; next_cursor = None; prev_cursor = None; has_participants = False; completion = {}
      try:
-          participants_pagination = Participant.query.order_by(Participant.created_at.desc()).paginate(page=page, per_page=15, error_out=False)
+          after = decode_cursor(cursor) if cursor else None; before = decode_cursor(back_cursor) if back_cursor else None
+     except ValueError:
+          flash("نشانی صفحه نامعتبر است؛ لیست از ابتدا نمایش داده می‌شود.", "warning"); return redirect(url_for('participants.list_participants', q=search or None))
+     try:
+          participants, next_cursor, prev_cursor = participants_page(search, after, before)
+          has_participants = bool(participants) or db.session.query(Participant.phone).first() is not None
+          completion = score_completion([p.phone for p in participants])
      except Exception as e:
-         flash(f"خطا در بارگذاری لیست شرکت‌کنندگان: {e}", "danger"); print(f"Error loading participants list: {e}"); traceback.print_exc(); participants_pagination = None
-     return render_template('participants/list.html', participants_pagination=participants_pagination)
+         flash(f"خطا در بارگذاری لیست شرکت‌کنندگان: {e}", "danger"); print(f"Error loading participants list: {e}"); traceback.print_exc()
+     return render_template('participants/list.html', participants=participants, next_cursor=next_cursor, prev_cursor=prev_cursor, search=search,
+                            first_page=not prev_cursor, has_participants=has_participants, completion=completion, scoreable_count=len(get_hierarchy().items))
+
+# --- NEW: JSON list for incremental loading ---
+@participants_bp.route('/list/data')
+@login_required
+def list_participants_data():
+    """JSON page of participants: ?q=<search>&after=<next_cursor> (or &before=<prev_cursor>)&limit=<n>."""
+    search = request.args.get('q', '', type=str).strip()
+    cursor = request.args.get('after', '', type=str); back_cursor = request.args.get('before', '', type=str)
+    limit = min(max(request.args.get('limit', PARTICIPANTS_PER_PAGE, type=int), 1), MAX_PARTICIPANTS_PER_PAGE)
+    try: after = decode_cursor(cursor) if cursor else None; before = decode_cursor(back_cursor) if back_cursor else None
+    except ValueError: return jsonify({'error': 'invalid cursor'}), 400
+    participants, next_cursor, prev_cursor = participants_page(search, after, before, limit)
+    completion = score_completion([p.phone for p in participants]); scoreable_count = len(get_hierarchy().items)
+    rows = []
+    for p in participants:
+        scored, last_scored = completion.get(p.phone, (0, None))
+        rows.append({
+            'phone': p.phone, 'name': p.name, 'created_at': p.created_at.isoformat() if p.created_at else None,
+            'has_attachment': p.attachment_blob_id is not None,
+            'thumbnail_url': url_for('participants.view_attachment_preview', phone=p.phone, blob_hash=p.attachment_blob.sha256, rendition='thumb')
+                             if p.attachment_blob and has_preview(p.attachment_blob.mime_type) else None,
+            'scored_items': scored, 'scoreable_items': scoreable_count, 'last_scored_at': last_scored.isoformat() if last_scored else None,
+            'results_url': url_for('results.participant_summary', phone=p.phone),
+            'edit_url': url_for('participants.manage_scores', phone=p.phone),
+        })
+    return jsonify({'participants': rows, 'next_cursor': next_cursor, 'prev_cursor': prev_cursor})
 
 # --- Route to Delete Participant ---
 @participants_bp.route('/<string:phone>/delete', methods=['POST'])
@@ -243,20 +376,16 @@ def delete_participant(phone):
     participant = Participant.query.get_or_404(phone)
     participant_name = participant.name
     try:
-        # --- NEW: Delete associated attachment file before deleting participant ---
-        if participant.attachment_filename:
-            try:
-                filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], participant.attachment_filename)
-                if os.path.exists(filepath):
-                    os.remove(filepath)
-                    print(f"Deleted attachment file: {filepath}")
-            except Exception as file_e:
-                print(f"Error deleting attachment file {participant.attachment_filename}: {file_e}")
-                # Optionally flash a warning, but proceed with participant deletion
-                flash(f'هشدار: خطا در حذف فایل پیوست برای {participant_name}.', 'warning')
-        # --- End NEW ---
+        blob_id = participant.attachment_blob_id
+        removed_scores = db.session.query(Score.measure_id, Score.indicator_id, Score.value).filter(Score.participant_phone == phone).all()
+        # Scores go first, so the aggregates are updated against a Score table that no longer holds them
+        Score.query.filter(Score.participant_phone == phone).delete(synchronize_session=False); db.session.flush()
+        apply_score_changes([(m_id, i_id, value, None) for m_id, i_id, value in removed_scores])
         db.session.delete(participant)
+        stale_paths = release_blobs([blob_id]) # The attachment file goes too unless another participant shares it
+        bump_data_version()
         db.session.commit()
+        remove_blob_files(stale_paths)
         flash(f'شرکت‌کننده "{participant_name}" و تمام اطلاعات او حذف شدند.', 'success')
     except Exception as e:
         db.session.rollback(); flash(f'خطا در حذف "{participant_name}": {e}', 'danger'); print(f"Error deleting {phone}: {e}"); traceback.print_exc()
@@ -266,29 +395,15 @@ def delete_participant(phone):
 @participants_bp.route('/delete-all', methods=['POST'])
 @login_required
 def delete_all_participants():
-    """Deletes ALL participants and their scores/attachments. Requires admin login."""
+    """Queues a background purge of ALL participants and their scores/attachments. Requires admin login."""
     try:
-        # --- NEW: Delete all attachment files first ---
-        participants_with_attachments = Participant.query.filter(Participant.attachment_filename.isnot(None)).all()
-        deleted_files_count = 0
-        for participant in participants_with_attachments:
-            if participant.attachment_filename:
-                try:
-                    filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], participant.attachment_filename)
-                    if os.path.exists(filepath):
-                        os.remove(filepath)
-                        deleted_files_count += 1
-                except Exception as file_e:
-                    print(f"Error deleting attachment file {participant.attachment_filename} during delete-all: {file_e}")
-                    # Log error but continue
-        print(f"Deleted {deleted_files_count} attachment files during delete-all.")
-        # --- End NEW ---
-
-        num_scores_deleted = db.session.query(Score).delete()
-        num_participants_deleted = db.session.query(Participant).delete()
-        db.session.commit()
-        flash(f'تمام {num_participants_deleted} شرکت‌کننده، {num_scores_deleted} امتیاز و {deleted_files_count} فایل پیوست حذف شدند.', 'success')
-        print(f"DELETED ALL PARTICIPANTS ({num_participants_deleted}), SCORES ({num_scores_deleted}), and ATTACHMENTS ({deleted_files_count})")
+        running = ImportJob.query.filter(ImportJob.kind == 'purge', ImportJob.status.in_(['queued', 'running'])).order_by(ImportJob.created_at.desc()).first()
+        if running and not is_stale(running):
+            flash('حذف شرکت‌کنندگان هم‌اکنون در حال انجام است.', 'info'); return redirect(url_for('participants.import_job', job_id=running.id))
+        # --- UPDATED: Deletes run in short batches in the background; files are removed off the request ---
+        job_id = new_job_id(); create_job(job_id, 'purge', '', None, user_id=current_user.get_id())
+        submit_job(job_id, run_participant_purge); print(f"Purge of all participants queued as job {job_id}")
+        return redirect(url_for('participants.import_job', job_id=job_id))
     except Exception as e:
         db.session.rollback(); flash(f'خطا در حذف تمام شرکت‌کنندگان: {e}', 'danger'); print(f"Error deleting all: {e}"); traceback.print_exc()
     return redirect(url_for('participants.list_participants'))
@@ -299,12 +414,9 @@ def delete_all_participants():
 def get_participant_scores(phone):
     """Fetches scores for a specific participant, grouped by hierarchical name."""
     try:
-        scores = Score.query.filter_by(participant_phone=phone).options(joinedload(Score.scored_measure).joinedload(Measure.indicator).joinedload(Indicator.axis), joinedload(Score.scored_indicator).joinedload(Indicator.axis)).all()
-        score_dict = {}
-        for score in scores:
-             item = score.scored_measure if score.measure_id else score.scored_indicator
-             if item: field_name = get_hierarchical_name(item); score_dict[field_name] = score.value
-             else: field_name = f"measure_{score.measure_id}" if score.measure_id else f"indicator_{score.indicator_id}"; score_dict[field_name] = score.value
+        hierarchy = get_hierarchy(); score_dict = {}
+        for measure_id, indicator_id, value in db.session.query(Score.measure_id, Score.indicator_id, Score.value).filter_by(participant_phone=phone).all():
+             field_name = hierarchy.label_for(measure_id, indicator_id) or (f"measure_{measure_id}" if measure_id else f"indicator_{indicator_id}"); score_dict[field_name] = value
         return score_dict
     except Exception as e: print(f"Error fetching scores for participant {phone}: {e}"); traceback.print_exc(); return {}
 
@@ -327,28 +439,16 @@ def manage_attachment(phone):
                  flash('نام فایل نامعتبر است.', 'danger')
                  return redirect(url_for('participants.manage_attachment', phone=phone))
 
-            # Add phone number prefix for uniqueness (optional but good practice)
-            filename = f"{phone}_{filename}"
-            save_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-
-            # Delete old file if it exists and is different
-            if participant.attachment_filename and participant.attachment_filename != filename:
-                old_filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], participant.attachment_filename)
-                if os.path.exists(old_filepath):
-                    try:
-                        os.remove(old_filepath)
-                        print(f"Deleted old attachment: {old_filepath}")
-                    except Exception as e:
-                        print(f"Error deleting old attachment {old_filepath}: {e}")
-                        flash('خطا در حذف فایل پیوست قبلی.', 'warning')
-
-            # Save the new file
-            file.save(save_path)
-            print(f"Saved new attachment: {save_path}")
-
-            # Update participant record
-            participant.attachment_filename = filename
+            # --- UPDATED: Streamed to a temp file while hashing, stored once per content in a hash-sharded tree ---
+            blob = store_attachment(file, filename)
+            old_blob_id = participant.attachment_blob_id
+            participant.attachment_blob = blob; participant.attachment_name = filename
+            stale_paths = release_blobs([old_blob_id]) if old_blob_id != blob.id else []
+            bump_data_version() # Results pages show the attachment
             db.session.commit()
+            remove_blob_files(stale_paths)
+            queue_previews(blob.sha256, blob.mime_type) # --- NEW: Thumbnails are rendered in the background ---
+            print(f"Saved attachment for {phone}: {blob.sha256} ({blob.size} bytes, {blob.mime_type})")
             flash('فایل پیوست با موفقیت آپلود شد.', 'success')
 
         except Exception as e:
@@ -368,23 +468,20 @@ def manage_attachment(phone):
 def delete_attachment(phone):
     """Deletes the attachment for a participant."""
     participant = Participant.query.get_or_404(phone)
-    filename = participant.attachment_filename
 
-    if not filename:
+    if not participant.attachment_blob_id:
         flash('این شرکت‌کننده فایل پیوستی ندارد.', 'info')
         return redirect(url_for('participants.manage_attachment', phone=phone))
 
     try:
-        filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-        if os.path.exists(filepath):
-            os.remove(filepath)
-            print(f"Deleted attachment file: {filepath}")
-        else:
-            print(f"Attachment file not found on disk, but removing DB record: {filepath}")
-
-        # Remove filename from database record
-        participant.attachment_filename = None
+        # The stored file is removed only when no other participant shares it
+        blob_id = participant.attachment_blob_id
+        participant.attachment_blob_id = None; participant.attachment_name = None
+        stale_paths = release_blobs([blob_id])
+        bump_data_version()
         db.session.commit()
+        remove_blob_files(stale_paths)
+        print(f"Deleted attachment of {phone} (files removed: {len(stale_paths)})")
         flash('فایل پیوست با موفقیت حذف شد.', 'success')
 
     except Exception as e:
@@ -396,34 +493,94 @@ def delete_attachment(phone):
     return redirect(url_for('participants.manage_attachment', phone=phone))
 
 
+# --- NEW: Bulk attachments from one ZIP (background job) ---
+@participants_bp.route('/upload-attachments', methods=['GET', 'POST'])
+@login_required
+def upload_attachments():
+    """Queues a ZIP of attachments named by participant phone number for background import. Requires admin login."""
+    form = AttachmentZipForm()
+    if form.validate_on_submit():
+        file = form.archive.data
+        try:
+            job_id = new_job_id(); file_path = os.path.join(current_app.config['IMPORT_FOLDER'], f"{job_id}.zip")
+            content_hash = store_upload(file, file_path)
+            # Archives over the entry/size limits are refused before a job is queued
+            try:
+                with zipfile.ZipFile(file_path) as archive: limit_error = archive_limit_error(archive)
+            except zipfile.BadZipFile: limit_error = 'فایل ZIP معتبر نیست یا خراب است.'
+            if limit_error:
+                os.remove(file_path); flash(f'خطا: {limit_error}', 'danger'); return redirect(url_for('participants.upload_attachments'))
+            create_job(job_id, 'attachments', file.filename, file_path, user_id=current_user.get_id(), content_hash=content_hash)
+            submit_job(job_id, run_attachment_import); print(f"Attachment ZIP '{file.filename}' queued as job {job_id}")
+            return redirect(url_for('participants.import_job', job_id=job_id))
+        except Exception as e: db.session.rollback(); flash(f'خطای غیرمنتظره در پردازش فایل: {e}', 'danger'); print(f"ZIP upload error: {e}"); traceback.print_exc(); return redirect(url_for('participants.upload_attachments'))
+    return render_template('participants/upload_attachments.html', form=form)
+
+@participants_bp.route('/import-jobs/<string:job_id>/report')
+@login_required
+def import_job_report(job_id):
+    """Per-entry CSV report of a finished attachment import."""
+    path = attachment_report_path(job_id)
+    if not os.path.isfile(path): flash('گزارشی برای این کار یافت نشد.', 'warning'); return redirect(url_for('participants.import_job', job_id=job_id))
+    return send_file(path, mimetype='text/csv', as_attachment=True, download_name=f"attachments_report_{job_id[:8]}.csv")
+
+
 # --- Route to serve uploaded files ---
-# Note: No @login_required here, access control might be needed if files are sensitive
-# For now, anyone with the filename can access it.
-@participants_bp.route('/view-attachment/<filename>')
-def view_attachment(filename):
-    """Serves the uploaded attachment file."""
-    # Basic security: Use secure_filename again to prevent directory traversal attempts
-    # Although the filename stored in DB should already be secured.
-    filename = secure_filename(filename)
-    print(f"Attempting to serve file: {filename} from {current_app.config['UPLOAD_FOLDER']}")
+# Note: No @login_required here (participants open their own certificate from their results page).
+# The URL carries the content hash, so it cannot be guessed from the phone number alone.
+@participants_bp.route('/attachment/<string:phone>/<string:blob_hash>')
+def view_attachment(phone, blob_hash):
+    """Serves a participant's stored attachment file."""
     try:
-        # send_from_directory is safer for serving files
-        return send_from_directory(current_app.config['UPLOAD_FOLDER'], filename, as_attachment=False) # Set as_attachment=True to force download
+        row = db.session.query(Participant.attachment_name, AttachmentBlob.sha256, AttachmentBlob.mime_type, AttachmentBlob.created_at)\
+                        .join(AttachmentBlob, Participant.attachment_blob_id == AttachmentBlob.id)\
+                        .filter(Participant.phone == phone, AttachmentBlob.sha256 == blob_hash).first()
+        path = blob_path(row.sha256) if row else None
+        if not path or not os.path.isfile(path): raise FileNotFoundError(blob_hash)
+        # --- UPDATED: Strong ETag / Last-Modified, 304 and Range support, optional hand-off to the front proxy ---
+        return attachment_response(row.sha256, row.mime_type, row.created_at, row.attachment_name or row.sha256)
     except FileNotFoundError:
         flash('فایل مورد نظر یافت نشد.', 'danger')
-        # Redirect somewhere sensible, maybe participant list or login
         if current_user.is_authenticated:
              return redirect(url_for('participants.list_participants'))
         else:
-             # If not logged in, maybe redirect to participant login?
-             # This depends on how you want to handle broken links for non-logged-in users.
-             return redirect(url_for('participant_view.my_results_login')) # Or main.index/auth.login
+             return redirect(url_for('participant_view.my_results_login'))
     except Exception as e:
         flash(f'خطا در نمایش فایل: {e}', 'danger')
-        print(f"Error serving file {filename}: {e}")
+        print(f"Error serving attachment {blob_hash} of {phone}: {e}")
         if current_user.is_authenticated:
              return redirect(url_for('participants.list_participants'))
         else:
              return redirect(url_for('participant_view.my_results_login'))
 
+# --- NEW: Downscaled renditions of image attachments (see app.previews) ---
+@participants_bp.route('/attachment/<string:phone>/<string:blob_hash>/<string:rendition>')
+def view_attachment_preview(phone, blob_hash, rendition):
+    """Serves a cached JPEG rendition of a participant's image attachment; 404 (queued) while it is being generated."""
+    if rendition not in PREVIEW_RENDITIONS: abort(404)
+    row = db.session.query(AttachmentBlob.sha256, AttachmentBlob.mime_type)\
+                    .join(Participant, Participant.attachment_blob_id == AttachmentBlob.id)\
+                    .filter(Participant.phone == phone, AttachmentBlob.sha256 == blob_hash).first()
+    if not row or not has_preview(row.mime_type): abort(404)
+    path = preview_path(row.sha256, rendition)
+    if not os.path.isfile(path):
+        # Images stored before previews existed (or whose rendering was lost) are rendered on first request
+        queue_previews(row.sha256, row.mime_type)
+        response = make_response('', 404); response.headers['Retry-After'] = '5'
+        return response
+    response = send_file(path, mimetype='image/jpeg', conditional=True, etag=f"{row.sha256}-{rendition}", max_age=None)
+    response.cache_control.no_cache = None; response.cache_control.private = True; response.cache_control.max_age = current_app.config['ATTACHMENT_CACHE_MAX_AGE']
+    return response
+
+# Links of the old flat layout (<phone>_<filename>) keep working
+@participants_bp.route('/view-attachment/<filename>')
+def view_legacy_attachment(filename):
+    """Redirects an old attachment link to the participant's stored file."""
+    phone, _, name = secure_filename(filename).partition('_')
+    participant = Participant.query.get(phone)
+    if participant and participant.attachment_blob and participant.attachment_name == name:
+        return redirect(url_for('participants.view_attachment', phone=phone, blob_hash=participant.attachment_blob.sha256))
+    flash('فایل مورد نظر یافت نشد.', 'danger')
+    return redirect(url_for('participants.list_participants') if current_user.is_authenticated else url_for('participant_view.my_results_login'))
+
 # --- End NEW Attachment Routes ---
@@ -0,0 +1,331 @@
+# app/score_import.py
+import pandas as pd
+import numpy as np
+from datetime import datetime
+from io import BytesIO
+from sqlalchemy import update
+from app.models import db, dialect_insert, Participant, Score, ImportJob
+from app.scoring import chunked, apply_score_changes, refresh_participant_results, write_score_rows
+from app.cache import bump_data_version, get_version
+from app.hierarchy import get_hierarchy, HIERARCHY_VERSION_KEY
+from app.spreadsheets import SheetReader, DEFAULT_BATCH_SIZE
+from app.jobs import report_progress, finish_job, update_job
+from app.normalize import normalize_search_text
+
+PHONE_COLUMN = 'شماره تلفن'
+NAME_COLUMN = 'نام'
+REQUIRED_COLUMNS = [PHONE_COLUMN, NAME_COLUMN]
+
+# Phones bound into one IN clause when prefetching
+PREFETCH_BATCH_SIZE = 500
+
+
+# --- Vectorized validation ---
+class FrameValidation:
+    """
+    Outcome of validate_frame() for one frame: cleaned phones/names, a float
+    matrix of the score cells (NaN when blank or invalid), validity masks and
+    (offset, column position, message) error tuples in row/column order
+    (column position -1 for phone/name errors).
+    """
+    __slots__ = ('first_row_num', 'phones', 'names', 'row_valid', 'rows_ok', 'values', 'cell_valid', 'messages')
+
+    def __init__(self, first_row_num, phones, names, row_valid, rows_ok, values, cell_valid, messages):
+        self.first_row_num = first_row_num
+        self.phones = phones
+        self.names = names
+        self.row_valid = row_valid
+        self.rows_ok = rows_ok
+        self.values = values
+        self.cell_valid = cell_valid
+        self.messages = messages
+
+
+def _stripped_text(column):
+    """Column as stripped text, '' where empty."""
+    return column.astype(str).str.strip().where(column.notna(), '')
+
+
+def validate_frame(df, score_columns, first_row_num=2):
+    """
+    Checks a whole frame with column operations: phone/name presence, phone
+    format, numeric coercion and the 0-5 range of every score column. Score
+    cells are not checked on rows whose phone or name is invalid.
+    """
+    phones = _stripped_text(df[PHONE_COLUMN]); names = _stripped_text(df[NAME_COLUMN])
+    has_identity = ((phones != '') & (names != '')).to_numpy()
+    phone_format_ok = (phones.str.startswith('0') & phones.str.isdigit()).to_numpy()
+    row_valid = has_identity & phone_format_ok
+    row_count = len(df); columns = list(score_columns); messages = []
+
+    for offset in np.flatnonzero(~has_identity):
+        messages.append((offset, -1, f"ردیف {first_row_num + offset}: شماره تلفن ('{df[PHONE_COLUMN].iloc[offset]}') یا نام ('{df[NAME_COLUMN].iloc[offset]}') خالی است."))
+    for offset in np.flatnonzero(has_identity & ~phone_format_ok):
+        messages.append((offset, -1, f"ردیف {first_row_num + offset}: فرمت شماره تلفن '{phones.iloc[offset]}' نامعتبر است."))
+
+    values = np.full((row_count, len(columns)), np.nan); cell_valid = np.zeros((row_count, len(columns)), dtype=bool)
+    for c, col_name in enumerate(columns):
+        raw = df[col_name]
+        if pd.api.types.is_numeric_dtype(raw.dtype) and not pd.api.types.is_bool_dtype(raw.dtype):
+            blank = raw.isna(); numeric = raw.astype(float)
+        else:
+            text = raw.astype(str).str.strip()
+            blank = raw.isna() | (text == '')
+            numeric = pd.to_numeric(text.where(~blank), errors='coerce').astype(float)
+        blank = blank.to_numpy(); numeric = numeric.to_numpy()
+        in_range = (numeric >= 0) & (numeric <= 5)
+        invalid = ~blank & np.isnan(numeric)
+        out_of_range = ~blank & ~np.isnan(numeric) & ~in_range
+        for offset in np.flatnonzero(invalid & row_valid):
+            messages.append((offset, c, f"ردیف {first_row_num + offset}, ستون '{col_name}': فرمت امتیاز '{raw.iloc[offset]}' نامعتبر است (باید عدد باشد)."))
+        for offset in np.flatnonzero(out_of_range & row_valid):
+            messages.append((offset, c, f"ردیف {first_row_num + offset}, ستون '{col_name}': امتیاز {numeric[offset]} خارج از محدوده مجاز (0-5) است."))
+        values[:, c] = np.where(in_range, numeric, np.nan)
+        cell_valid[:, c] = in_range & row_valid
+
+    messages.sort(key=lambda m: (m[0], m[1]))
+    cell_errors = np.zeros(row_count, dtype=bool)
+    for offset, c, _ in messages:
+        if c >= 0: cell_errors[offset] = True
+    return FrameValidation(first_row_num, phones.tolist(), names.tolist(), row_valid, row_valid & ~cell_errors,
+                           values, cell_valid, messages)
+
+
+# --- Set-based score importer ---
+class ScoreImporter:
+    """
+    Imports score rows set-wise: a frame of rows is parsed and validated in
+    memory, existing participants/scores for its phones are prefetched in a
+    few queries, and only the differences are written with bulk statements.
+
+    Frames are fed one batch at a time (see app.spreadsheets.SheetReader), so
+    memory stays flat. Nothing is committed here: like the old row-by-row
+    import, any row error means the caller must roll back the whole upload.
+    """
+
+    def __init__(self, score_columns):
+        self.score_columns = score_columns # {column name: ('measure'|'indicator', id)}
+        self.processed_count = 0
+        self.error_count = 0
+        self.row_errors = []
+        self.participants_written = 0
+        self.scores_written = 0
+
+    def error(self, msg):
+        print(f"Error: {msg}")
+        self.row_errors.append(msg); self.error_count += 1
+
+    # --- Parsing / validation ---
+    def parse_frame(self, df, first_row_num=2):
+        """
+        Validates a frame. Returns ({phone: name}, {(phone, measure_id, indicator_id): value})
+        for the valid cells; later rows win over earlier ones for the same phone.
+        """
+        validation = validate_frame(df, self.score_columns, first_row_num)
+        for _, _, msg in validation.messages: self.error(msg)
+        self.processed_count += int(validation.rows_ok.sum())
+        targets = [(target_id if target_type == 'measure' else None, target_id if target_type == 'indicator' else None)
+                   for target_type, target_id in self.score_columns.values()]
+        participants = {}; scores = {}
+        phones = validation.phones; names = validation.names
+        for offset in np.flatnonzero(validation.row_valid): participants[phones[offset]] = names[offset]
+        for offset, c in zip(*np.nonzero(validation.cell_valid)):
+            scores[(phones[offset],) + targets[c]] = float(validation.values[offset, c])
+        return participants, scores
+
+    # --- Writing ---
+    def write(self, participants, scores):
+        """Prefetches existing rows for the frame's phones, diffs in memory and applies bulk statements."""
+        phones = list(participants)
+        score_changes = []
+        existing_names = {}; existing_scores = {}
+        for chunk in chunked(phones, PREFETCH_BATCH_SIZE):
+            existing_names.update(db.session.query(Participant.phone, Participant.name).filter(Participant.phone.in_(chunk)).all())
+            score_rows = db.session.query(Score.id, Score.participant_phone, Score.measure_id, Score.indicator_id, Score.value)\
+                                   .filter(Score.participant_phone.in_(chunk)).order_by(Score.id).all()
+            for score_id, phone, measure_id, indicator_id, value in score_rows:
+                existing_scores.setdefault((phone, measure_id, indicator_id), (score_id, value))
+
+        participant_rows = [{'phone': phone, 'name': name, 'search_name': normalize_search_text(name)} for phone, name in participants.items() if existing_names.get(phone) != name]
+        self.write_participants(participant_rows, existing_names)
+
+        now = datetime.utcnow(); score_inserts = []; score_updates = []
+        for (phone, measure_id, indicator_id), value in scores.items():
+            existing = existing_scores.get((phone, measure_id, indicator_id))
+            if existing is None:
+                score_inserts.append({'participant_phone': phone, 'measure_id': measure_id, 'indicator_id': indicator_id, 'value': value, 'timestamp': now})
+                score_changes.append((measure_id, indicator_id, None, value))
+            elif existing[1] != value:
+                score_updates.append({'id': existing[0], 'value': value, 'timestamp': now})
+                score_changes.append((measure_id, indicator_id, existing[1], value))
+        self.write_scores(score_inserts, score_updates)
+
+        # Derived rows are updated per frame so nothing grows with the file size
+        apply_score_changes(score_changes)
+        refresh_participant_results(phones)
+        self.participants_written += len(participant_rows); self.scores_written += len(score_inserts) + len(score_updates)
+
+    def write_participants(self, rows, existing_names):
+        if not rows: return
+        stmt = dialect_insert(Participant.__table__)
+        if stmt is not None:
+            stmt = stmt.on_conflict_do_update(index_elements=['phone'], set_={'name': stmt.excluded.name, 'search_name': stmt.excluded.search_name})
+            db.session.execute(stmt, rows)
+            return
+        new_rows = [row for row in rows if row['phone'] not in existing_names]
+        changed_rows = [row for row in rows if row['phone'] in existing_names]
+        if new_rows: db.session.execute(Participant.__table__.insert(), [dict(row, created_at=datetime.utcnow()) for row in new_rows])
+        if changed_rows: db.session.execute(update(Participant), changed_rows)
+
+    def write_scores(self, inserts, updates):
+        write_score_rows(inserts, updates)
+
+    def process_frame(self, df, first_row_num=2):
+        participants, scores = self.parse_frame(df, first_row_num)
+        if self.error_count: return # The upload will be rolled back; skip writing
+        self.write(participants, scores)
+
+    def finish(self):
+        """Marks the data as changed (caller commits)."""
+        bump_data_version()
+        print(f"Score import wrote {self.participants_written} participant row(s) and {self.scores_written} score row(s).")
+
+
+def match_score_columns(columns):
+    """Maps file columns to active scoreable items by hierarchical name. Returns (score_columns, unknown_columns)."""
+    targets = {item.label: (item.kind, item.id) for item in get_hierarchy().items if "خطا:" not in item.label}
+    score_columns = {}; unknown_columns = []
+    for col_name in columns:
+        if col_name in REQUIRED_COLUMNS: continue
+        if col_name in targets: score_columns[col_name] = targets[col_name]
+        else: unknown_columns.append(col_name)
+    return score_columns, unknown_columns
+
+
+# --- Dry run: validation report without touching the database ---
+REPORT_RESULT_COLUMN = 'نتیجه بررسی'
+REPORT_ERROR_FILL = 'FFC7CE'
+REPORT_WARNING_FILL = 'FFEB9C'
+
+
+def build_dry_run_report(reader, score_columns, unknown_columns):
+    """
+    Validates every frame of the reader and writes an annotated copy of the
+    sheet (invalid cells in red, repeated phones in yellow, one result column
+    per row) plus a summary sheet. Returns (BytesIO workbook, summary dict).
+    """
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import PatternFill
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('گزارش بررسی'); summary_sheet = workbook.create_sheet('خلاصه')
+    sheet.sheet_view.rightToLeft = True; summary_sheet.sheet_view.rightToLeft = True
+    error_fill = PatternFill('solid', fgColor=REPORT_ERROR_FILL); warning_fill = PatternFill('solid', fgColor=REPORT_WARNING_FILL)
+    sheet.append(reader.columns + [REPORT_RESULT_COLUMN])
+
+    column_positions = {col_name: i for i, col_name in enumerate(reader.columns)}
+    phone_position = column_positions[PHONE_COLUMN]; name_position = column_positions[NAME_COLUMN]
+    score_positions = [column_positions[col_name] for col_name in score_columns]
+    summary = {'total_rows': 0, 'valid_rows': 0, 'error_count': 0, 'error_rows': 0, 'duplicate_rows': 0, 'unknown_columns': list(unknown_columns)}
+    first_row_of_phone = {}
+
+    for first_row_num, df in reader.frames():
+        validation = validate_frame(df, score_columns, first_row_num)
+        row_nums = pd.Series(np.arange(first_row_num, first_row_num + len(df)))
+        phones = pd.Series(validation.phones).where(validation.row_valid)
+        # First row of each (valid) phone, from earlier frames or this one
+        first_rows = row_nums.groupby(phones).transform('min')
+        first_rows = phones.map(first_row_of_phone).fillna(first_rows).fillna(row_nums).astype(int).to_numpy()
+        duplicate = validation.row_valid & (first_rows != row_nums.to_numpy())
+        for phone, row_num in zip(phones[validation.row_valid], row_nums[validation.row_valid]): first_row_of_phone.setdefault(phone, row_num)
+
+        row_messages = {}; error_cells = {}
+        for offset, c, msg in validation.messages:
+            row_messages.setdefault(offset, []).append(msg)
+            error_cells.setdefault(offset, set()).update([phone_position, name_position] if c < 0 else [score_positions[c]])
+
+        records = df.astype(object).where(df.notna(), None).to_numpy().tolist()
+        for offset, record in enumerate(records):
+            notes = list(row_messages.get(offset, []))
+            if duplicate[offset]: notes.append(f"شماره تلفن تکراری است (ردیف {first_rows[offset]})؛ مقادیر آخرین ردیف ذخیره می‌شود.")
+            if not notes: sheet.append(record + [None]); continue
+            cells = []
+            for position, value in enumerate(record):
+                cell = WriteOnlyCell(sheet, value=value)
+                if position in error_cells.get(offset, ()): cell.fill = error_fill
+                elif position == phone_position and duplicate[offset]: cell.fill = warning_fill
+                cells.append(cell)
+            result_cell = WriteOnlyCell(sheet, value=' | '.join(notes)); result_cell.fill = error_fill if offset in row_messages else warning_fill
+            sheet.append(cells + [result_cell])
+
+        summary['total_rows'] += len(df); summary['valid_rows'] += int(validation.rows_ok.sum())
+        summary['error_count'] += len(validation.messages); summary['error_rows'] += len(row_messages)
+        summary['duplicate_rows'] += int(duplicate.sum())
+
+    summary_sheet.append(['تعداد کل ردیف‌ها', summary['total_rows']])
+    summary_sheet.append(['ردیف‌های بدون خطا', summary['valid_rows']])
+    summary_sheet.append(['ردیف‌های دارای خطا', summary['error_rows']])
+    summary_sheet.append(['تعداد خطاها', summary['error_count']])
+    summary_sheet.append(['ردیف‌های با شماره تلفن تکراری', summary['duplicate_rows']])
+    summary_sheet.append(['ستون‌های ناشناخته (نادیده گرفته می‌شوند)', ', '.join(summary['unknown_columns']) or '-'])
+
+    output = BytesIO(); workbook.save(output); output.seek(0)
+    return output, summary
+
+
+# --- Background job entry point (see app.jobs) ---
+def run_score_import(job_id):
+    """
+    Imports the uploaded file of an ImportJob. The whole file is validated
+    first, so nothing is written when any row is invalid; rows are then
+    committed batch by batch with a checkpoint on the job (committed_rows), so
+    an interrupted import resumes after its last committed batch.
+    """
+    job = db.session.get(ImportJob, job_id)
+    resume_from = job.committed_rows; rows_before = job.rows_processed if resume_from else 0
+    update_job(job_id, hierarchy_version=get_version(HIERARCHY_VERSION_KEY))
+    print(f"--- Starting Score Upload: {job.filename} (job {job_id}{f', resuming after row {resume_from + 1}' if resume_from else ''}) ---")
+
+    with open(job.file_path, 'rb') as file:
+        def open_reader():
+            file.seek(0)
+            return SheetReader(file, job.filename, batch_size=DEFAULT_BATCH_SIZE, text_columns=[PHONE_COLUMN])
+
+        try: reader = open_reader()
+        except ValueError as format_e: return finish_job(job_id, 'failed', str(format_e), validation_failed=True)
+        print(f"File opened for streaming ({reader.kind}). Columns: {len(reader.columns)}")
+        missing_required = [col for col in REQUIRED_COLUMNS if col not in reader.columns]
+        if missing_required: return finish_job(job_id, 'failed', f'فایل آپلود شده فاقد ستون‌های الزامی است: {", ".join(missing_required)}.', validation_failed=True)
+        score_columns, unknown_columns = match_score_columns(reader.columns); warnings = []
+        if not score_columns: warnings.append('هیچ ستون امتیازی منطبق با نام کامل سنجه‌ها یا شاخص‌های فعال در فایل یافت نشد.')
+        if unknown_columns: warnings.append(f'هشدار: ستون‌های زیر نادیده گرفته شدند: {", ".join(unknown_columns)}')
+        if warnings: update_job(job_id, warnings=warnings)
+        print(f"Score columns identified in file (using hierarchical names): {score_columns}")
+
+        # --- Pass 1: validate everything (skipped when resuming; the file passed before) ---
+        if not resume_from:
+            validator = ScoreImporter(score_columns)
+            for first_row_num, df in reader.frames():
+                validator.parse_frame(df, first_row_num=first_row_num)
+                report_progress(job_id, rows_processed=validator.processed_count, error_count=validator.error_count)
+            if validator.error_count:
+                print(f"\n--- Upload Rejected --- Errors: {validator.error_count}")
+                return finish_job(job_id, 'failed', f'پردازش فایل با {validator.error_count} خطا مواجه شد. هیچ تغییری ذخیره نشد.', validation_failed=True,
+                                  rows_processed=validator.processed_count, error_count=validator.error_count, errors=validator.row_errors)
+            reader = open_reader()
+
+        # --- Pass 2: write and commit one batch at a time ---
+        importer = ScoreImporter(score_columns)
+        for first_row_num, df in reader.frames():
+            start = first_row_num - 2; end = start + len(df)
+            if end <= resume_from: continue
+            if start < resume_from: df = df.iloc[resume_from - start:]; first_row_num += resume_from - start
+            importer.process_frame(df, first_row_num=first_row_num); importer.finish()
+            db.session.execute(update(ImportJob).where(ImportJob.id == job_id).values(committed_rows=end, rows_processed=rows_before + importer.processed_count))
+            db.session.commit()
+
+    processed_count = rows_before + importer.processed_count
+    print(f"\n--- Upload Finished --- Processed: {processed_count}")
+    message = f'{processed_count} ردیف با موفقیت پردازش و ذخیره شد.' if processed_count else 'تغییری برای ذخیره یافت نشد.'
+    return finish_job(job_id, 'succeeded', message, rows_processed=processed_count, error_count=0, errors=[], data_version=get_version())
@@ -0,0 +1,341 @@
+# app/scoring.py
+import numpy as np
+from datetime import datetime
+from sqlalchemy import func, update
+from app.models import db, dialect_insert, Score, Participant, ParticipantResult, ItemAggregate
+from app.cache import get_version
+from app.hierarchy import get_hierarchy, SCORING_VERSION_KEY
+
+# Participants scored (and phones bound into one IN clause) per batch
+RESULT_BATCH_SIZE = 500
+
+
+def chunked(items, size):
+    """Yields successive slices of a list."""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+# --- Bulk score writes (shared by the score form and the spreadsheet import) ---
+def write_score_rows(inserts, updates):
+    """
+    Writes Score rows in bulk, in the caller's transaction. updates: dicts with
+    id, value and timestamp (ORM bulk update by primary key); inserts: full row
+    dicts, upserted against the unique (participant, target) indexes where the
+    dialect supports it, one statement per target kind.
+    """
+    if updates: db.session.execute(update(Score), updates)
+    if not inserts: return
+    if dialect_insert(Score.__table__) is None:
+        db.session.execute(Score.__table__.insert(), inserts); return
+    # Upsert against the unique (participant, target) indexes, one statement per target kind
+    for target_column in ('measure_id', 'indicator_id'):
+        rows = [row for row in inserts if row[target_column] is not None]
+        if not rows: continue
+        stmt = dialect_insert(Score.__table__)
+        stmt = stmt.on_conflict_do_update(index_elements=['participant_phone', target_column],
+                                          index_where=Score.__table__.c[target_column].isnot(None),
+                                          set_={'value': stmt.excluded.value, 'timestamp': stmt.excluded.timestamp})
+        db.session.execute(stmt, rows)
+
+
+# --- Scoring Model: active hierarchy flattened into aggregation matrices ---
+class ScoringModel:
+    """
+    Holds the active hierarchy as dense arrays so that scores for any number
+    of participants can be aggregated with a few matrix products.
+
+    Columns of a score matrix are the scoreable items of the hierarchy
+    snapshot (active measures first, then indicators that allow a direct score).
+    """
+
+    def __init__(self, hierarchy):
+        self.hierarchy = hierarchy
+        self.indicator_positions = np.flatnonzero(hierarchy.indicator_active & (hierarchy.indicator_axis >= 0))
+        self.indicator_ids = hierarchy.indicator_ids[self.indicator_positions].tolist()
+        self.indicator_index = {ind_id: k for k, ind_id in enumerate(self.indicator_ids)}
+
+        self.item_keys = [(item.kind, item.id) for item in hierarchy.items]
+        self.item_index = hierarchy.item_index
+
+        # item -> indicator weights. A direct-score indicator only uses its own
+        # direct score, so measures under it (if any) get no weight.
+        item_columns = np.array([self.indicator_index[item.indicator_id] for item in hierarchy.items], dtype=np.int64)
+        item_weights = np.array([
+            (0.0 if hierarchy.indicator_direct[self.indicator_positions[item_columns[i]]]
+             else hierarchy.measure_weights[hierarchy.measure_index[item.id]]) if item.kind == 'measure' else 1.0
+            for i, item in enumerate(hierarchy.items)], dtype=float)
+        self.item_to_indicator = np.zeros((len(self.item_keys), len(self.indicator_ids)))
+        if len(self.item_keys):
+            self.item_to_indicator[np.arange(len(self.item_keys)), item_columns] = item_weights
+
+        # indicator -> axis weights
+        indicator_axis = hierarchy.indicator_axis[self.indicator_positions]
+        axis_positions = np.unique(indicator_axis)
+        self.axis_ids = hierarchy.axis_ids[axis_positions].tolist()
+        self.axis_names = {int(hierarchy.axis_ids[x]): hierarchy.axis_names[x] for x in axis_positions}
+        self.indicator_names = [hierarchy.indicator_names[pos] for pos in self.indicator_positions]
+        self.indicator_weights = hierarchy.indicator_weights[self.indicator_positions]
+        self.indicator_axis_ids = hierarchy.axis_ids[indicator_axis].tolist()
+        self.indicator_to_axis = np.zeros((len(self.indicator_ids), len(self.axis_ids)))
+        if len(self.indicator_ids):
+            self.indicator_to_axis[np.arange(len(self.indicator_ids)), np.searchsorted(axis_positions, indicator_axis)] = self.indicator_weights
+
+    @classmethod
+    def load(cls, hierarchy=None):
+        """Returns the model for the given (default: current cached) hierarchy snapshot."""
+        global _model_cache
+        hierarchy = hierarchy or get_hierarchy()
+        cached = _model_cache
+        if cached is not None and cached.hierarchy is hierarchy:
+            return cached
+        model = cls(hierarchy)
+        if hierarchy.version is not None:
+            _model_cache = model
+        return model
+
+    def column_for(self, measure_id, indicator_id):
+        """Returns the score-matrix column for a Score target, or None if it is not scoreable."""
+        if measure_id is not None:
+            return self.item_index.get(('measure', measure_id))
+        return self.item_index.get(('indicator', indicator_id))
+
+    # --- Aggregation ---
+    def indicator_scores(self, values):
+        """
+        values: (participants x items) array with NaN for missing scores.
+        Only items that actually have a score take part in the weighting.
+        """
+        values = np.atleast_2d(values)
+        scored = ~np.isnan(values)
+        weighted_sum = np.where(scored, values, 0.0) @ self.item_to_indicator
+        total_weight = scored.astype(float) @ self.item_to_indicator
+        return np.divide(weighted_sum, total_weight, out=np.zeros_like(weighted_sum), where=total_weight > 0)
+
+    def axis_scores(self, indicator_scores):
+        total_weight = self.indicator_to_axis.sum(axis=0)
+        weighted_sum = indicator_scores @ self.indicator_to_axis
+        return np.divide(weighted_sum, total_weight, out=np.zeros_like(weighted_sum), where=total_weight > 0)
+
+    def overall_scores(self, indicator_scores):
+        total_weight = self.indicator_weights.sum()
+        if total_weight <= 0:
+            return np.zeros(indicator_scores.shape[0])
+        return (indicator_scores @ self.indicator_weights) / total_weight
+
+    # --- Presentation ---
+    def build_axes(self, indicator_row):
+        """Builds the 'axes' list used by the results templates for one row of indicator scores."""
+        axes_dict = {}
+        for k, indicator_id in enumerate(self.indicator_ids):
+            axis_id = self.indicator_axis_ids[k]
+            axis_data = axes_dict.setdefault(axis_id, {
+                'id': axis_id, 'name': self.axis_names[axis_id],
+                'indicators': [], 'total_weighted_score': 0.0, 'total_weight': 0.0
+            })
+            score = float(indicator_row[k]); weight = float(self.indicator_weights[k])
+            axis_data['indicators'].append({'id': indicator_id, 'name': self.indicator_names[k], 'score': score, 'weight': weight})
+            axis_data['total_weighted_score'] += score * weight
+            axis_data['total_weight'] += weight
+
+        axes = []
+        for axis_data in axes_dict.values():
+            axis_data['axis_score'] = (axis_data['total_weighted_score'] / axis_data['total_weight']) if axis_data['total_weight'] > 0 else 0.0
+            axis_data['indicators'].sort(key=lambda x: x['name'])
+            axes.append(axis_data)
+        axes.sort(key=lambda x: x['name'])
+        return axes
+
+
+_model_cache = None
+
+
+# --- Loading scores into the dense matrix ---
+def build_score_matrix(model, phones, score_rows):
+    """
+    Places score rows (participant_phone, measure_id, indicator_id, value) into
+    a dense (len(phones) x items) matrix. Missing scores are NaN.
+    """
+    values = np.full((len(phones), len(model.item_keys)), np.nan)
+    row_index = {phone: r for r, phone in enumerate(phones)}
+    rows, cols, vals = [], [], []
+    for phone, measure_id, indicator_id, value in score_rows:
+        r = row_index.get(phone)
+        c = model.column_for(measure_id, indicator_id)
+        if r is None or c is None: continue
+        rows.append(r); cols.append(c); vals.append(value)
+    if rows:
+        values[np.array(rows), np.array(cols)] = np.array(vals, dtype=float)
+    return values
+
+
+def query_item_aggregates():
+    """
+    Per-item mean/count of all scores, read from the running ItemAggregate
+    table (filled by upgrade-db/init-db and kept up to date by the score
+    writes; never rebuilt here). Returns rows of (measure_id, indicator_id, mean, count).
+    """
+    aggregates = ItemAggregate.query.all()
+    return [(agg.measure_id, agg.indicator_id, agg.mean, agg.score_count) for agg in aggregates]
+
+
+# --- Running per-item aggregates ---
+def rebuild_item_aggregates():
+    """
+    Recomputes ItemAggregate from the Score table with a single GROUP BY
+    (portable across SQLite and PostgreSQL). The caller commits.
+    """
+    ItemAggregate.query.delete(synchronize_session=False)
+    grouped = db.session.query(Score.measure_id, Score.indicator_id, func.count(Score.id),
+                               func.sum(Score.value), func.sum(Score.value * Score.value))\
+                        .group_by(Score.measure_id, Score.indicator_id).all()
+    rows = [{'measure_id': measure_id, 'indicator_id': indicator_id, 'score_count': count,
+             'score_sum': float(total or 0.0), 'score_sum_sq': float(total_sq or 0.0)}
+            for measure_id, indicator_id, count, total, total_sq in grouped]
+    if rows:
+        db.session.execute(ItemAggregate.__table__.insert(), rows)
+    print(f"Rebuilt item aggregates for {len(rows)} item(s).")
+    return len(rows)
+
+
+def apply_score_changes(changes):
+    """
+    Folds Score writes into the running ItemAggregate rows, in the caller's
+    transaction. changes: iterable of (measure_id, indicator_id, old_value, new_value)
+    where old_value is None for an insert and new_value is None for a delete.
+    Call it after the Score rows themselves have been written or deleted.
+    """
+    deltas = {}
+    for measure_id, indicator_id, old_value, new_value in changes:
+        if old_value == new_value: continue
+        key = (measure_id, indicator_id)
+        d_count, d_sum, d_sum_sq = deltas.get(key, (0, 0.0, 0.0))
+        if old_value is not None:
+            d_count -= 1; d_sum -= old_value; d_sum_sq -= old_value * old_value
+        if new_value is not None:
+            d_count += 1; d_sum += new_value; d_sum_sq += new_value * new_value
+        deltas[key] = (d_count, d_sum, d_sum_sq)
+    if not deltas: return
+
+    if db.session.query(ItemAggregate.id).first() is None:
+        # Never populated (or just purged): seed from the Score table as it is
+        # now, which already holds these changes; the deltas are dropped.
+        rebuild_item_aggregates()
+        return
+    table = ItemAggregate.__table__
+    rows = [{'measure_id': measure_id, 'indicator_id': indicator_id, 'score_count': d_count, 'score_sum': d_sum, 'score_sum_sq': d_sum_sq}
+            for (measure_id, indicator_id), (d_count, d_sum, d_sum_sq) in deltas.items()]
+    if dialect_insert(table) is not None:
+        # Upsert: a concurrent writer creating the same item's row turns into an increment instead of a unique violation
+        for target_column, target_rows in (('measure_id', [row for row in rows if row['measure_id'] is not None]),
+                                           ('indicator_id', [row for row in rows if row['measure_id'] is None])):
+            if not target_rows: continue
+            stmt = dialect_insert(table)
+            stmt = stmt.on_conflict_do_update(index_elements=[target_column], set_={
+                'score_count': table.c.score_count + stmt.excluded.score_count,
+                'score_sum': table.c.score_sum + stmt.excluded.score_sum,
+                'score_sum_sq': table.c.score_sum_sq + stmt.excluded.score_sum_sq})
+            db.session.execute(stmt, target_rows)
+        return
+    # No ON CONFLICT support: update the rows that exist (looked up for these items only), insert the rest
+    inserts = []
+    for row in rows:
+        target = (table.c.measure_id == row['measure_id']) if row['measure_id'] is not None else (table.c.indicator_id == row['indicator_id'])
+        result = db.session.execute(table.update().where(target).values(
+            score_count=table.c.score_count + row['score_count'],
+            score_sum=table.c.score_sum + row['score_sum'],
+            score_sum_sq=table.c.score_sum_sq + row['score_sum_sq']))
+        if not result.rowcount: inserts.append(row)
+    if inserts:
+        db.session.execute(table.insert(), inserts)
+
+
+def delete_item_aggregates(measure_ids=(), indicator_ids=()):
+    """Drops the running aggregates of deleted measures/indicators (their scores are gone too)."""
+    if measure_ids:
+        ItemAggregate.query.filter(ItemAggregate.measure_id.in_(list(measure_ids))).delete(synchronize_session=False)
+    if indicator_ids:
+        ItemAggregate.query.filter(ItemAggregate.indicator_id.in_(list(indicator_ids))).delete(synchronize_session=False)
+
+
+def item_means(model, aggregate_rows):
+    """Places per-item means (measure_id, indicator_id, mean, count) into an items vector (NaN when unscored)."""
+    means = np.full(len(model.item_keys), np.nan)
+    for measure_id, indicator_id, mean, count in aggregate_rows:
+        c = model.column_for(measure_id, indicator_id)
+        if c is None or not count: continue
+        means[c] = float(mean)
+    return means
+
+
+def score_participants(model, phones=None):
+    """
+    Computes indicator, axis and overall scores for the given participants
+    (all participants with scores when phones is None).
+    Returns (phones, indicator_scores, axis_scores, overall_scores).
+    """
+    query = db.session.query(Score.participant_phone, Score.measure_id, Score.indicator_id, Score.value)
+    if phones is not None:
+        query = query.filter(Score.participant_phone.in_(phones))
+    score_rows = query.all()
+    if phones is None:
+        phones = sorted({row[0] for row in score_rows})
+    values = build_score_matrix(model, list(phones), score_rows)
+    indicator_scores = model.indicator_scores(values)
+    return list(phones), indicator_scores, model.axis_scores(indicator_scores), model.overall_scores(indicator_scores)
+
+
+# --- Materialized participant results ---
+def compute_result_rows(model, phones, scoring_version):
+    """ParticipantResult column values (one dict per participant) computed from the current Score rows."""
+    phones, indicator_scores, axis_scores, overall_scores = score_participants(model, phones)
+    now = datetime.utcnow()
+    return [{
+        'participant_phone': phone,
+        'overall_score': float(overall_scores[r]),
+        'indicator_scores': {str(ind_id): float(indicator_scores[r, k]) for k, ind_id in enumerate(model.indicator_ids)},
+        'axis_scores': {str(axis_id): float(axis_scores[r, x]) for x, axis_id in enumerate(model.axis_ids)},
+        'updated_at': now,
+        'scoring_version': scoring_version
+    } for r, phone in enumerate(phones)]
+
+
+def refresh_participant_results(phones=None, model=None):
+    """
+    Recomputes and stores ParticipantResult rows for the given participants
+    (every participant when phones is None). Runs inside the caller's
+    transaction; the caller commits. A model passed in must be at least as
+    new as the scoring version read here.
+    Returns the number of participants refreshed.
+    """
+    db.session.flush()
+    scoring_version = get_version(SCORING_VERSION_KEY) # Read before the model, so the rows never claim a newer version
+    model = model or ScoringModel.load()
+    if phones is None:
+        phones = [row[0] for row in db.session.query(Participant.phone).order_by(Participant.phone).all()]
+        ParticipantResult.query.delete(synchronize_session=False)
+    else:
+        phones = list(dict.fromkeys(phones))
+        for chunk in chunked(phones, RESULT_BATCH_SIZE):
+            ParticipantResult.query.filter(ParticipantResult.participant_phone.in_(chunk)).delete(synchronize_session=False)
+
+    for chunk in chunked(phones, RESULT_BATCH_SIZE):
+        rows = compute_result_rows(model, chunk, scoring_version)
+        if rows:
+            db.session.execute(ParticipantResult.__table__.insert(), rows)
+    print(f"Refreshed materialized results for {len(phones)} participant(s).")
+    return len(phones)
+
+
+def get_participant_result(phone):
+    """
+    Returns the stored ParticipantResult for a participant. If it is missing
+    or older than the last hierarchy change affecting scores, an unsaved one
+    is computed for this read only; the stored rows are rewritten by score
+    writes, upgrade-db and `flask rebuild-results`, never by a read.
+    """
+    result = db.session.get(ParticipantResult, phone)
+    scoring_version = get_version(SCORING_VERSION_KEY)
+    if result is None or result.scoring_version != scoring_version:
+        result = ParticipantResult(**compute_result_rows(ScoringModel.load(), [phone], scoring_version)[0])
+    return result
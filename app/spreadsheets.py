@@ -0,0 +1,120 @@
+# app/spreadsheets.py
+import codecs
+import pandas as pd
+
+# Rows handed to the importer (and flushed to the database) at a time
+DEFAULT_BATCH_SIZE = 1000
+
+# Bytes read per step when sniffing a CSV's encoding
+ENCODING_PROBE_BLOCK = 1024 * 1024
+
+
+def detect_csv_encoding(stream):
+    """
+    Returns 'utf-8' if the whole stream decodes as UTF-8, else 'windows-1256'
+    (the fallback the upload form has always used). Reads in blocks, then rewinds.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    encoding = 'utf-8'
+    try:
+        while True:
+            block = stream.read(ENCODING_PROBE_BLOCK)
+            if not block:
+                decoder.decode(b'', final=True)
+                break
+            decoder.decode(block)
+    except UnicodeDecodeError:
+        encoding = 'windows-1256'
+    stream.seek(0)
+    return encoding
+
+
+def _as_text(value):
+    """Cell value as text the way pandas' dtype=str renders it (integral floats without '.0')."""
+    if value is None: return None
+    if isinstance(value, float) and value.is_integer(): return str(int(value))
+    return str(value)
+
+
+# --- Streaming sheet reader ---
+class SheetReader:
+    """
+    Reads an uploaded .xlsx or .csv in fixed-size row batches so memory stays
+    flat regardless of file size: openpyxl read-only row iteration for Excel,
+    pandas chunked reading for CSV.
+
+    columns: stripped header names. frames(): yields (first_row_num, DataFrame)
+    where first_row_num is the spreadsheet row number of the frame's first row.
+    """
+
+    def __init__(self, file, filename, batch_size=DEFAULT_BATCH_SIZE, text_columns=()):
+        self.file = file
+        self.filename = filename.lower()
+        self.batch_size = batch_size
+        self.text_columns = set(text_columns)
+        if self.filename.endswith('.xlsx'):
+            self.kind = 'xlsx'
+        elif self.filename.endswith('.csv'):
+            self.kind = 'csv'
+        else:
+            raise ValueError('فرمت فایل نامعتبر است. فقط .xlsx یا .csv مجاز است.')
+        self.columns = []
+        self._open()
+
+    def _open(self):
+        if self.kind == 'xlsx':
+            from openpyxl import load_workbook
+            self._workbook = load_workbook(self.file, read_only=True, data_only=True)
+            self._rows = self._workbook.worksheets[0].iter_rows(values_only=True)
+            header = next(self._rows, ())
+            self.columns = [str(col).strip() if col is not None else f'Unnamed: {i}' for i, col in enumerate(header)]
+        else:
+            self._encoding = detect_csv_encoding(self.file)
+            self._chunks = pd.read_csv(self.file, encoding=self._encoding, header=0,
+                                       dtype={col: str for col in self.text_columns}, chunksize=self.batch_size)
+            self._first_chunk = next(self._chunks, None)
+            if self._first_chunk is not None:
+                self.columns = [str(col).strip() for col in self._first_chunk.columns]
+
+    def frames(self):
+        if self.kind == 'xlsx':
+            yield from self._xlsx_frames()
+        else:
+            yield from self._csv_frames()
+
+    def _csv_frames(self):
+        first_row_num = 2
+        chunk = self._first_chunk
+        while chunk is not None:
+            chunk.columns = self.columns
+            yield first_row_num, chunk
+            first_row_num += len(chunk)
+            chunk = next(self._chunks, None)
+
+    def _xlsx_frames(self):
+        width = len(self.columns)
+        text_positions = [i for i, col in enumerate(self.columns) if col in self.text_columns]
+        batch = []; pending_blank = []; first_row_num = 2
+        try:
+            for row in self._rows:
+                row = list(row[:width]) + [None] * (width - len(row))
+                if all(value is None for value in row):
+                    # Trailing blank rows are dropped, like pandas.read_excel does
+                    pending_blank.append(row); continue
+                if pending_blank:
+                    batch.extend(pending_blank); pending_blank = []
+                for i in text_positions:
+                    row[i] = _as_text(row[i])
+                batch.append(row)
+                if len(batch) >= self.batch_size:
+                    yield first_row_num, pd.DataFrame(batch, columns=self.columns)
+                    first_row_num += len(batch); batch = []
+            if batch:
+                yield first_row_num, pd.DataFrame(batch, columns=self.columns)
+        finally:
+            self._workbook.close()
+
+    def read_all(self):
+        """Whole sheet as one DataFrame (for small sheets such as the hierarchy)."""
+        frames = [df for _, df in self.frames()]
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=self.columns)
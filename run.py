@@ -5,8 +5,13 @@ import os
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 try:
-    # تلاش برای وارد کردن app
-    from app import app
+    # تلاش برای ساختن app
+    # --- UPDATED: Application factory; the schema is set up explicitly (as `flask init-db` does) ---
+    from app import create_app
+    from app.commands import init_database
+    app = create_app()
+    with app.app_context():
+        init_database()
     print("✅ فایل app با موفقیت وارد شد.")
 
     if __name__ == '__main__':
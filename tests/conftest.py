@@ -0,0 +1,88 @@
+# tests/conftest.py
+import pytest
+from sqlalchemy import func
+from app import create_app
+from app.models import db, User, Axis, Indicator, Measure, Participant, Score, ItemAggregate
+from app.commands import init_database
+from app.attachments import add_blob_file, file_sha256, temp_upload_path
+import app.cache as cache
+import app.hierarchy as hierarchy
+import app.scoring as scoring
+import app.routes.participants as participants_routes
+
+
+def reset_process_caches():
+    """Per-process caches are keyed by version counters, which restart at 0 in every test database."""
+    hierarchy._snapshot = None; scoring._model_cache = None; participants_routes._score_form_spec = None
+    cache.results_cache.clear(); cache.settings_cache.clear(); cache.user_cache.clear()
+
+
+@pytest.fixture
+def app(tmp_path):
+    """App bound to a fresh SQLite database and upload folder under tmp_path, inside an app context."""
+    upload_folder = tmp_path / 'uploads'; import_folder = tmp_path / 'imports'
+    upload_folder.mkdir(); import_folder.mkdir()
+    app = create_app({
+        'TESTING': True, 'WTF_CSRF_ENABLED': False,
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'test.db'}",
+        'UPLOAD_FOLDER': str(upload_folder), 'IMPORT_FOLDER': str(import_folder),
+    })
+    reset_process_caches()
+    with app.app_context():
+        init_database()
+        yield app
+        db.session.remove()
+    reset_process_caches()
+
+
+@pytest.fixture
+def client(app):
+    """Test client logged in as the default admin."""
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(User.query.filter_by(username='admin').one().id); session['_fresh'] = True
+    return client
+
+
+@pytest.fixture
+def items(app):
+    """
+    One axis with an indicator of two measures and a directly scored
+    indicator. Returns {name: Measure or Indicator}.
+    """
+    axis = Axis(name='محور')
+    scored = Indicator(name='شاخص', weight=0.6, axis=axis, is_active=True, allow_direct_score=False)
+    direct = Indicator(name='مستقیم', weight=0.4, axis=axis, is_active=True, allow_direct_score=True)
+    first = Measure(name='سنجه ۱', weight=0.5, indicator=scored); second = Measure(name='سنجه ۲', weight=0.5, indicator=scored)
+    db.session.add_all([axis, scored, direct, first, second]); db.session.commit()
+    return {'axis': axis, 'indicator': scored, 'direct': direct, 'm1': first, 'm2': second}
+
+
+def save_scores(client, phone, name, values, edit=False):
+    """Posts the score form for a participant. values maps each scoreable item's label to a score."""
+    data = {'phone': phone, 'name': name}; data.update(values)
+    response = client.post(f'/participants/scores/{phone}' if edit else '/participants/scores', data=data)
+    assert response.status_code == 302, response.get_data(as_text=True)[:500]
+    return response
+
+
+def score_labels():
+    """Labels of the scoreable items (the score form's field names), keyed by (measure_id, direct indicator_id)."""
+    return {(item.measure_id, item.direct_indicator_id): item.label for item in hierarchy.get_hierarchy().items}
+
+
+def aggregate_mismatches():
+    """Items whose ItemAggregate row differs from a fresh GROUP BY over Score (empty when the running totals are right)."""
+    truth = {(m_id, i_id): (count, round(total, 9)) for m_id, i_id, count, total in
+             db.session.query(Score.measure_id, Score.indicator_id, func.count(Score.id), func.sum(Score.value))
+                       .group_by(Score.measure_id, Score.indicator_id)}
+    stored = {(agg.measure_id, agg.indicator_id): (agg.score_count, round(agg.score_sum, 9))
+              for agg in ItemAggregate.query if agg.score_count}
+    return {key: (truth.get(key), stored.get(key)) for key in set(truth) | set(stored) if truth.get(key) != stored.get(key)}
+
+
+def store_file(content, mime_type='application/pdf'):
+    """Stores bytes as an attachment blob (uncommitted) and returns the AttachmentBlob."""
+    path = temp_upload_path()
+    with open(path, 'wb') as f: f.write(content)
+    return add_blob_file(path, file_sha256(path), mime_type)
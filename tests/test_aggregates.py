@@ -0,0 +1,48 @@
+# tests/test_aggregates.py
+from app.models import db, Score, ItemAggregate
+from app.scoring import apply_score_changes, query_item_aggregates, write_score_rows
+from tests.conftest import save_scores, score_labels, aggregate_mismatches
+
+
+def fill(client, phones):
+    labels = list(score_labels().values())
+    for n, phone in enumerate(phones):
+        save_scores(client, phone, f'نفر {n}', {label: (n + k) % 5 + 1 for k, label in enumerate(labels)})
+
+
+def test_score_form_writes_keep_aggregates_exact(client, items):
+    fill(client, ['0911', '0912', '0913'])
+    assert not aggregate_mismatches()
+    labels = list(score_labels().values())
+    save_scores(client, '0912', 'نفر 1', {label: 2.5 for label in labels}, edit=True)
+    assert not aggregate_mismatches()
+
+
+def test_delete_participant_from_empty_aggregates(client, items):
+    fill(client, ['0911', '0912'])
+    ItemAggregate.query.delete(); db.session.commit() # State of a database whose scores predate the table
+    assert client.post('/participants/0911/delete').status_code == 302
+    assert ItemAggregate.query.count() and not aggregate_mismatches()
+
+
+def test_delete_participant_updates_aggregates(client, items):
+    fill(client, ['0911', '0912', '0913'])
+    assert client.post('/participants/0912/delete').status_code == 302
+    assert not aggregate_mismatches()
+    assert Score.query.filter_by(participant_phone='0912').count() == 0
+
+
+def test_apply_score_changes_creates_missing_item_rows(client, items):
+    fill(client, ['0911'])
+    direct = items['direct'].id
+    Score.query.filter_by(indicator_id=direct).delete(); ItemAggregate.query.filter_by(indicator_id=direct).delete(); db.session.commit()
+    write_score_rows([{'participant_phone': '0911', 'measure_id': None, 'indicator_id': direct, 'value': 4.0}], [])
+    apply_score_changes([(None, direct, None, 4.0)]); db.session.commit()
+    assert not aggregate_mismatches()
+
+
+def test_query_item_aggregates_does_not_write(client, items):
+    fill(client, ['0911'])
+    ItemAggregate.query.delete(); db.session.commit()
+    assert query_item_aggregates() == []
+    assert ItemAggregate.query.count() == 0
@@ -0,0 +1,82 @@
+# tests/test_attachment_import.py
+import io
+import os
+import hashlib
+import zipfile
+import pytest
+from app.models import db, AttachmentBlob, ImportJob, Participant
+from app.attachments import blob_path, TEMP_DIR_NAME
+from app.jobs import create_job, new_job_id
+import app.attachment_import as attachment_import
+from tests.conftest import store_file
+
+
+def make_zip(entries):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, content in entries: archive.writestr(name, content)
+    buffer.seek(0)
+    return buffer
+
+
+def import_zip(app, entries):
+    """Runs an attachment import job for the entries synchronously. Returns the finished ImportJob."""
+    job_id = new_job_id(); path = os.path.join(app.config['IMPORT_FOLDER'], f'{job_id}.zip')
+    with open(path, 'wb') as f: f.write(make_zip(entries).getvalue())
+    create_job(job_id, 'attachments', 'a.zip', path)
+    attachment_import.run_attachment_import(job_id)
+    db.session.expire_all()
+    return db.session.get(ImportJob, job_id)
+
+
+@pytest.fixture
+def participants(app):
+    """09120000001 already has an attachment; 09120000002 has none."""
+    old = store_file(b'%PDF old'); db.session.flush()
+    db.session.add_all([Participant(phone='09120000001', name='یک', attachment_blob_id=old.id, attachment_name='old.pdf'),
+                        Participant(phone='09120000002', name='دو')])
+    db.session.commit()
+    return old
+
+
+def test_import_attaches_and_releases_replaced_blob(app, participants):
+    old_path = blob_path(participants.sha256)
+    job = import_zip(app, [('09120000001_new.pdf', b'%PDF new'), ('09120000002_doc.pdf', b'%PDF new'), ('09129999999_x.pdf', b'%PDF x')])
+    assert job.status == 'succeeded' and job.error_count == 1 # 09129999999 is not a participant
+    new_sha = hashlib.sha256(b'%PDF new').hexdigest()
+    assert {p.phone: p.attachment_blob.sha256 for p in Participant.query} == {'09120000001': new_sha, '09120000002': new_sha}
+    assert [blob.sha256 for blob in AttachmentBlob.query] == [new_sha]
+    assert os.path.exists(blob_path(new_sha)) and not os.path.exists(old_path)
+
+
+def test_failed_import_rolls_back_rows_and_stored_files(app, participants, monkeypatch):
+    def fail(): raise RuntimeError('commit failed')
+    monkeypatch.setattr(attachment_import, 'bump_data_version', fail)
+    with pytest.raises(RuntimeError):
+        import_zip(app, [('09120000001_new.pdf', b'%PDF new'), ('09120000002_doc.pdf', b'%PDF other')])
+    db.session.expire_all()
+    assert db.session.get(Participant, '09120000001').attachment_blob_id == participants.id and db.session.get(Participant, '09120000002').attachment_blob_id is None
+    assert [blob.sha256 for blob in AttachmentBlob.query] == [participants.sha256]
+    assert os.path.exists(blob_path(participants.sha256))
+    for content in [b'%PDF new', b'%PDF other']: assert not os.path.exists(blob_path(hashlib.sha256(content).hexdigest()))
+    assert not os.listdir(os.path.join(app.config['UPLOAD_FOLDER'], TEMP_DIR_NAME))
+
+
+@pytest.mark.parametrize('limit, value, entries', [
+    ('ZIP_MAX_ENTRIES', 2, [(f'0912000000{n}_x.pdf', b'x') for n in range(3)]),
+    ('ZIP_MAX_ENTRY_BYTES', 10, [('09120000001_x.pdf', b'\0' * 11)]),
+    ('ZIP_MAX_TOTAL_BYTES', 10, [('09120000001_x.pdf', b'x' * 6), ('09120000002_x.pdf', b'y' * 6)]),
+])
+def test_archive_limits(app, participants, monkeypatch, limit, value, entries):
+    monkeypatch.setattr(attachment_import, limit, value)
+    with zipfile.ZipFile(make_zip(entries)) as archive: assert attachment_import.archive_limit_error(archive)
+    job = import_zip(app, entries)
+    assert job.status == 'failed' and AttachmentBlob.query.count() == 1
+
+
+def test_upload_refuses_archive_over_limits(client, app, monkeypatch):
+    monkeypatch.setattr(attachment_import, 'ZIP_MAX_ENTRY_BYTES', 1024)
+    response = client.post('/participants/upload-attachments', data={'archive': (make_zip([('09120000001_x.pdf', b'\0' * 4096)]), 'a.zip')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 302 and response.headers['Location'].endswith('/participants/upload-attachments')
+    assert ImportJob.query.count() == 0 and not os.listdir(app.config['IMPORT_FOLDER'])
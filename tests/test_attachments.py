@@ -0,0 +1,53 @@
+# tests/test_attachments.py
+import io
+import os
+from app.models import db, AttachmentBlob, Participant
+from app.attachments import blob_path, release_blobs, remove_blob_files, TEMP_DIR_NAME
+from tests.conftest import store_file
+
+
+def add_participants(*phones):
+    db.session.add_all([Participant(phone=phone, name=f'نفر {phone}') for phone in phones]); db.session.commit()
+
+
+def test_same_content_is_stored_once(app):
+    first = store_file(b'same bytes'); second = store_file(b'same bytes'); db.session.commit()
+    assert first.id == second.id and AttachmentBlob.query.count() == 1
+    assert os.path.exists(blob_path(first.sha256))
+    assert not os.listdir(os.path.join(app.config['UPLOAD_FOLDER'], TEMP_DIR_NAME)) # Both temp copies consumed
+
+
+def test_release_only_unreferenced_blobs(app):
+    add_participants('0911', '0912')
+    blob = store_file(b'shared'); db.session.flush()
+    for phone in ['0911', '0912']: db.session.get(Participant, phone).attachment_blob_id = blob.id
+    db.session.commit()
+    db.session.get(Participant, '0911').attachment_blob_id = None
+    assert release_blobs([blob.id]) == [] # Still used by 0912
+    db.session.get(Participant, '0912').attachment_blob_id = None
+    assert release_blobs([blob.id]) == [blob_path(blob.sha256)]
+    db.session.commit()
+    assert AttachmentBlob.query.count() == 0
+
+
+def test_removal_keeps_a_file_stored_again_after_release(app):
+    blob = store_file(b'back again'); db.session.commit()
+    path = blob_path(blob.sha256)
+    stale_paths = release_blobs([blob.id]); db.session.commit()
+    store_file(b'back again'); db.session.commit() # Re-uploaded before the released file was removed
+    assert remove_blob_files(stale_paths) == 0 and os.path.exists(path)
+    assert release_blobs([AttachmentBlob.query.one().id]) == [path]; db.session.commit()
+    assert remove_blob_files([path]) == 1 and not os.path.exists(path)
+
+
+def test_deleting_participants_releases_shared_file_last(client):
+    add_participants('0911', '0912')
+    for phone in ['0911', '0912']:
+        response = client.post(f'/participants/manage-attachment/{phone}', data={'attachment': (io.BytesIO(b'%PDF shared'), 'doc.pdf')},
+                               content_type='multipart/form-data')
+        assert response.status_code == 302
+    blob = AttachmentBlob.query.one(); path = blob_path(blob.sha256)
+    assert client.post('/participants/0911/delete').status_code == 302
+    assert os.path.exists(path) and AttachmentBlob.query.count() == 1
+    assert client.post('/participants/0912/delete').status_code == 302
+    assert not os.path.exists(path) and AttachmentBlob.query.count() == 0
@@ -0,0 +1,66 @@
+# tests/test_pagination.py
+from datetime import datetime, timedelta
+import pytest
+from app.models import db, Participant
+
+NAMES = ['علی', 'علیرضا', 'زهرا', 'Sara']
+
+
+@pytest.fixture
+def participants(app):
+    """23 participants: distinct and tied creation times, plus a few without one (listed last)."""
+    start = datetime(2024, 1, 1)
+    rows = []
+    for n in range(23):
+        created_at = None if n % 7 == 3 else start + timedelta(hours=n // 3) # Groups of three share a timestamp
+        rows.append(Participant(phone=f'0912{n:07d}', name=NAMES[n % len(NAMES)], created_at=created_at))
+    db.session.add_all(rows); db.session.commit()
+    return sorted(rows, key=lambda p: (p.created_at is None, -(p.created_at or start).timestamp(), [-ord(ch) for ch in p.phone]))
+
+
+def page(client, **args):
+    response = client.get('/participants/list/data', query_string=args)
+    assert response.status_code == 200
+    data = response.get_json()
+    return [row['phone'] for row in data['participants']], data['next_cursor'], data['prev_cursor']
+
+
+@pytest.mark.parametrize('limit', [1, 4, 5, 23, 50])
+def test_forward_then_back_round_trip(client, participants, limit):
+    pages = []; cursor = None
+    while True:
+        phones, cursor, prev_cursor = page(client, limit=limit, **({'after': cursor} if cursor else {}))
+        pages.append((phones, prev_cursor))
+        if not cursor: break
+    assert [phone for phones, _ in pages for phone in phones] == [p.phone for p in participants]
+    assert pages[0][1] is None and all(prev_cursor for _, prev_cursor in pages[1:])
+
+    back = [pages[-1][0]]; prev_cursor = pages[-1][1]
+    while prev_cursor:
+        phones, _, prev_cursor = page(client, limit=limit, before=prev_cursor)
+        back.append(phones)
+    assert back[::-1] == [phones for phones, _ in pages]
+
+
+def test_previous_page_near_the_start_is_a_full_first_page(client, participants):
+    _, next_cursor, _ = page(client, limit=2)
+    _, _, prev_cursor = page(client, limit=2, after=next_cursor) # Cursor of the second page's first row
+    phones, _, prev_cursor = page(client, limit=5, before=prev_cursor) # Only two rows precede it
+    assert phones == [p.phone for p in participants[:5]] and prev_cursor is None
+
+
+def test_list_renders_previous_and_next_links(client, participants):
+    _, next_cursor, _ = page(client, limit=15)
+    html = client.get('/participants/list', query_string={'after': next_cursor}).get_data(as_text=True)
+    assert 'before=' in html and 'قبلی' in html
+    assert client.get('/participants/list', query_string={'before': 'not a cursor'}).status_code == 302
+    assert client.get('/participants/list/data', query_string={'before': 'not a cursor'}).status_code == 400
+
+
+def test_prefix_search_pages(client, participants):
+    phones, _, _ = page(client, q='۰۹۱۲۰۰۰۰۰۱', limit=50) # Persian digits
+    assert sorted(phones) == sorted(p.phone for p in participants if p.phone.startswith('0912000001'))
+    phones, _, _ = page(client, q='علی', limit=50)
+    assert sorted(phones) == sorted(p.phone for p in participants if p.name.startswith('علی'))
+    phones, _, _ = page(client, q='sa', limit=50)
+    assert sorted(phones) == sorted(p.phone for p in participants if p.name == 'Sara')
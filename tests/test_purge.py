@@ -0,0 +1,52 @@
+# tests/test_purge.py
+import os
+import pytest
+from sqlalchemy import text
+from app.models import db, Participant, ParticipantResult, ItemAggregate, Score, ImportJob
+from app.attachments import blob_path
+from app.jobs import create_job, new_job_id
+import app.purge as purge
+from tests.conftest import save_scores, score_labels, aggregate_mismatches, store_file
+
+
+@pytest.fixture
+def population(client, items, monkeypatch):
+    """Seven scored participants, three of them sharing two attachment files; purges run in batches of 3."""
+    monkeypatch.setattr(purge, 'PURGE_BATCH_SIZE', 3)
+    labels = list(score_labels().values())
+    phones = [f'091200000{n:02d}' for n in range(7)]
+    for n, phone in enumerate(phones):
+        save_scores(client, phone, f'نفر {n}', {label: (n + k) % 5 + 1 for k, label in enumerate(labels)})
+    for n, phone in enumerate(phones[:3]):
+        db.session.get(Participant, phone).attachment_blob_id = store_file(b'file %d' % (n % 2)).id
+    db.session.commit()
+    return phones
+
+
+def test_batch_delete_from_empty_aggregates(population):
+    ItemAggregate.query.delete(); db.session.commit()
+    removed, _ = purge.delete_participant_batch(population[:3]); db.session.commit()
+    assert removed == 3 * len(score_labels()) and not aggregate_mismatches()
+
+
+def test_remaining_scores_only_removes_orphans(population):
+    live = Score.query.filter_by(participant_phone=population[1]).count()
+    # A score whose participant row is gone (SQLite does not enforce the foreign key here)
+    db.session.execute(text("UPDATE score SET participant_phone = 'gone' WHERE id = (SELECT min(id) FROM score WHERE participant_phone = :phone)"),
+                       {'phone': population[0]})
+    db.session.commit()
+    assert purge.delete_remaining_scores() == 1
+    assert Score.query.filter_by(participant_phone='gone').count() == 0
+    assert Score.query.filter_by(participant_phone=population[1]).count() == live
+    assert not aggregate_mismatches()
+
+
+def test_purge_job_removes_everything(population):
+    paths = [blob_path(p.attachment_blob.sha256) for p in Participant.query.filter(Participant.attachment_blob_id.isnot(None))]
+    assert all(os.path.exists(path) for path in paths)
+    job_id = new_job_id(); create_job(job_id, 'purge', '', None)
+    purge.run_participant_purge(job_id)
+    db.session.expire_all()
+    assert db.session.get(ImportJob, job_id).status == 'succeeded'
+    assert Participant.query.count() == Score.query.count() == ParticipantResult.query.count() == ItemAggregate.query.count() == 0
+    assert not any(os.path.exists(path) for path in paths)
@@ -0,0 +1,63 @@
+# tests/test_results.py
+import pytest
+from app.models import db, ParticipantResult, Measure
+from app.cache import get_version
+from app.hierarchy import SCORING_VERSION_KEY
+from app.scoring import ScoringModel, compute_result_rows, get_participant_result
+from tests.conftest import save_scores, score_labels
+
+
+def expected_overall(phone):
+    return compute_result_rows(ScoringModel.load(), [phone], None)[0]['overall_score']
+
+
+@pytest.fixture
+def scored(client, items):
+    labels = score_labels()
+    save_scores(client, '0911', 'الف', {label: 5 for label in labels.values()})
+    save_scores(client, '0912', 'ب', {labels[(items['m1'].id, None)]: 1, labels[(items['m2'].id, None)]: 3, labels[(None, items['direct'].id)]: 2})
+    return items
+
+
+def edit_measure(client, measure, **changes):
+    data = {'measure-id': measure.id, 'measure-name': measure.name, 'measure-indicator_id': measure.indicator_id,
+            'measure-weight': measure.weight, 'measure-description': '', 'measure-submit_measure': 'y'}
+    if measure.is_active: data['measure-is_active'] = 'y'
+    data.update(changes)
+    assert client.post('/admin/manage', data=data).status_code == 302
+
+
+def test_score_writes_store_current_results(scored):
+    for phone in ['0911', '0912']:
+        result = db.session.get(ParticipantResult, phone)
+        assert result.scoring_version == get_version(SCORING_VERSION_KEY)
+        assert result.overall_score == pytest.approx(expected_overall(phone))
+
+
+def test_scoring_change_marks_results_stale_and_reads_do_not_write(client, scored):
+    stored = db.session.get(ParticipantResult, '0912').overall_score
+    assert client.post(f"/admin/measure/{scored['m1'].id}/toggle-active").status_code == 302
+    assert get_version(SCORING_VERSION_KEY) == 1
+    result = get_participant_result('0912')
+    assert result.overall_score == pytest.approx(expected_overall('0912'))
+    assert result.overall_score != pytest.approx(stored)
+    db.session.rollback()
+    row = db.session.get(ParticipantResult, '0912')
+    assert row.overall_score == stored and row.scoring_version == 0
+    assert client.get('/results/participant/0912').status_code == 200
+
+
+def test_rename_keeps_stored_results_valid(client, scored):
+    edit_measure(client, scored['m1'], **{'measure-name': 'نام تازه'})
+    assert db.session.get(Measure, scored['m1'].id).name == 'نام تازه'
+    assert get_version(SCORING_VERSION_KEY) == 0
+    edit_measure(client, scored['m1'], **{'measure-weight': 0.25})
+    assert get_version(SCORING_VERSION_KEY) == 1
+
+
+def test_next_score_write_refreshes_stale_row(client, scored):
+    assert client.post(f"/admin/measure/{scored['m2'].id}/toggle-active").status_code == 302
+    labels = score_labels()
+    save_scores(client, '0912', 'ب', {label: 4 for label in labels.values()}, edit=True)
+    result = db.session.get(ParticipantResult, '0912')
+    assert result.scoring_version == 1 and result.overall_score == pytest.approx(expected_overall('0912'))